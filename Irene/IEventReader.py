@@ -3,6 +3,10 @@ Irene Event Reader: Implements the interface KEventReader
 """
 from ROOT import *
 from KEventReader import KEventReader
+import ROOT
+import time
+import threading
+import Queue
 
 gSystem.Load("libirene")
 
@@ -10,22 +14,73 @@ class IEventReader(KEventReader):
     """
     Implements the interface KEventReader for Irene 
     JJ, Spring, 2014
+
+    Optionally the events are read through the TTree cache, only the listed
+    sub-branches of the event branch are read, and the next events are read
+    ahead on a background thread so that reading and fitting overlap
     """
 
-    def __init__(self,pathToFile,gsEvtTree = "EVENT",gsEvtBranch = "EventBranch"):
+    def __init__(self,pathToFile,gsEvtTree = "EVENT",gsEvtBranch = "EventBranch",
+                 cacheSize=0,branches=None,prefetch=0):
     	"""
     	Constructor
+        cacheSize: size in bytes of the TTree read cache (0 = no cache)
+        branches: patterns of the sub-branches of gsEvtBranch that are read
+        (None = the whole branch)
+        prefetch: number of events read ahead on a background thread (0 =
+        read each event when it is requested)
     	"""
 
         KEventReader.__init__(self,pathToFile)
     	
         self.fFile = TFile.Open(self.pathToFile)
         self.fEvtTree = self.fFile.Get(gsEvtTree)
+        self.gsEvtBranch = gsEvtBranch
+
+        if branches:
+            branches = self.__SelectBranches(branches)
+        if cacheSize > 0:
+            self.fEvtTree.SetCacheSize(cacheSize)
+            for branch in (branches or [gsEvtBranch+"*"]):
+                self.fEvtTree.AddBranchToCache(branch,True)
 
         self.ievt =irene.Event()  #create an irene event
         self.fEvtTree.SetBranchAddress(gsEvtBranch, self.ievt)
         self.numberOfBytesRead = 0
         self.totalNumberOfBytesRead =0
+        self.readLatency = 0.
+        self.totalReadLatency = 0.
+
+        # Read-ahead: the events are read into a ring of prefetch+2 events
+        #  (those in the queue, the one being read and the one returned last)
+        self.prefetch = prefetch
+        self.thread = None
+        if prefetch > 0:
+            if hasattr(ROOT,"EnableThreadSafety"): ROOT.EnableThreadSafety()
+            try:
+                TTree.GetEntry._threaded = True   # release the GIL while reading
+            except AttributeError:
+                pass
+            self.buffers = [irene.Event() for i in range(prefetch+2)]
+            self.nfilled = 0
+
+
+    def __SelectBranches(self,branches):
+        """
+        Reads only the sub-branches that match branches. If one of them is
+        not in the tree the whole event branch is read. Returns the branches
+        read
+        """
+        for branch in branches:
+            if not self.fEvtTree.FindBranch(branch.rstrip("*")):
+                print "IEventReader: no branch {0} in {1}, reading all of {2}".format(
+                    branch,self.pathToFile,self.gsEvtBranch)
+                return None
+
+        self.fEvtTree.SetBranchStatus("*",0)
+        for branch in branches:
+            self.fEvtTree.SetBranchStatus(branch,1)
+        return branches
 
 
     def NumberOfEvents(self):
@@ -37,12 +92,73 @@ class IEventReader(KEventReader):
     def ReadEvent(self,eventNumber):
         """
         Reads event number and returns a handle to the event  
+        (the event is valid until the next call)
         """
+        t0 = time.time()
+        if self.prefetch > 0 and eventNumber < self.NumberOfEvents():
+            ievt,self.numberOfBytesRead = self.__NextEvent(eventNumber)
+        else:
+            ievt = self.ievt
+            self.numberOfBytesRead= self.fEvtTree.GetEntry(eventNumber)
         self.eventNumber = eventNumber
-        self.numberOfBytesRead= self.fEvtTree.GetEntry(eventNumber)
         self.totalNumberOfBytesRead+=self.numberOfBytesRead
+        self.readLatency = time.time()-t0
+        self.totalReadLatency+=self.readLatency
+
+        return ievt  #return handle to irene event
+
+    def __NextEvent(self,eventNumber):
+        """
+        Takes event eventNumber from the read-ahead queue. The read-ahead
+        restarts at eventNumber if it is not the next event of the queue
+        """
+        if self.thread is None or self.nextEvent != eventNumber:
+            self.__StopPrefetch()
+            self.queue = Queue.Queue(self.prefetch)
+            self.stop = threading.Event()
+            self.thread = threading.Thread(target=self.__Prefetch,
+                                           args=(eventNumber,self.queue,self.stop))
+            self.thread.daemon = True
+            self.thread.start()
+
+        number,ievt,nbytes = self.queue.get()
+        self.nextEvent = number+1
+        if isinstance(nbytes,Exception):
+            self.__StopPrefetch()
+            raise nbytes
+        return ievt,nbytes
 
-        return self.ievt  #return handle to irene event
+    def __Prefetch(self,start,queue,stop):
+        """
+        Reads the events from start on into queue (on the read-ahead thread)
+        until the end of the file or until stop is set
+        """
+        for eventNumber in xrange(start,self.NumberOfEvents()):
+            ievt = self.buffers[self.nfilled % len(self.buffers)]
+            self.nfilled += 1
+            try:
+                self.fEvtTree.SetBranchAddress(self.gsEvtBranch, ievt)
+                nbytes = self.fEvtTree.GetEntry(eventNumber)
+            except Exception as error:
+                # (raised by ReadEvent when it gets to this event)
+                nbytes = error
+            while not stop.is_set():
+                try:
+                    queue.put((eventNumber,ievt,nbytes),timeout=0.1)
+                    break
+                except Queue.Full:
+                    pass
+            if stop.is_set(): return
+
+    def __StopPrefetch(self):
+        """
+        Stops the read-ahead thread
+        """
+        if self.thread is not None:
+            self.stop.set()
+            self.thread.join()
+            self.thread = None
+            self.fEvtTree.SetBranchAddress(self.gsEvtBranch, self.ievt)
 
     def NumberOfBytesRead(self):
         return self.numberOfBytesRead
@@ -50,6 +166,16 @@ class IEventReader(KEventReader):
     def TotalNumberOfBytesRead(self):
         return self.totalNumberOfBytesRead
 
+    def ReadLatency(self):
+        """
+        Time in seconds that the last ReadEvent waited for its event (with
+        read-ahead, only the part of the read not overlapped with the fit)
+        """
+        return self.readLatency
+
+    def TotalReadLatency(self):
+        return self.totalReadLatency
+
     def EventNumber(self):
         return self.eventNumber
 
@@ -57,5 +183,6 @@ class IEventReader(KEventReader):
         """
         Closes the file  
         """
+        self.__StopPrefetch()
         self.fFile.Close();
     	
\ No newline at end of file
@@ -0,0 +1,261 @@
+"""
+Irene hit cache: the hits and properties of the particles that IParticle
+selects (the most energetic primary electron, and the second one for the
+double-beta events) of every event of an Irene file, extracted once (with
+ROOT) to a store (see KStore) next to the file, <file>.khc.
+
+The fits then read the events from the cache (IHitCacheReader, which
+implements KEventReader) and need no ROOT: the hits of an event are views of
+the memory-mapped cache.
+
+python IHitCache.py -i <inputFile> -d <inputDir> -s <event start> -e <event end> -o <cache>
+"""
+import sys,getopt
+import os
+import time
+import numpy as np
+
+from KEventReader import KEventReader
+from KStore import KStore, KStoreWriter, ChunkFromRows
+import IParam as ip
+
+from KLog import *
+#create logger
+lgx =logging.getLogger("IHitCache")
+lgx.setLevel(logging.INFO)
+lgx.addHandler(ch)
+
+# Columns of the part table (one row per selected particle) and of the
+# hits tables (hits1, hits2: one row per hit of particle 1, 2)
+PART_COLUMNS = [("npart","<i8"),("pdg","<i8"),("mass","<f8"),
+                ("energy","<f8"),("momentum","<f8"),
+                ("vertex","(3,)<f8"),("decayVertex","(3,)<f8"),("p3","(3,)<f8"),
+                ("trackLength","<f8")]
+HIT_COLUMNS = [("hit","(4,)<f8")]
+NPARTS = 2
+
+# Names of the particles (the cache keeps their PDG code)
+PDG_NAMES = {11: "e-", -11: "e+", 22: "gamma"}
+
+
+def CacheFileName(pathToFile):
+    """
+    The hit cache of the Irene file pathToFile
+    """
+    return os.path.splitext(pathToFile)[0]+".khc"
+
+
+def OpenEvents(pathToFile,events=None):
+    """
+    The event reader of pathToFile: its hit cache if pathToFile is a cache
+    or has one (and ip.HitCache) that is not older than the file and has
+    the events (a list, any by default), else the Irene file itself (ROOT)
+    """
+    for fname in (pathToFile,CacheFileName(pathToFile)):
+        if ip.HitCache and fname.endswith(".khc") and os.path.isfile(fname):
+            if fname != pathToFile and os.path.isfile(pathToFile) and \
+               os.path.getmtime(fname) < os.path.getmtime(pathToFile):
+                lgx.warning("-- The hit cache {0} is older than {1}: not used".format(
+                    fname,pathToFile))
+                continue
+            reader = IHitCacheReader(fname)
+            missing = [event for event in (events or []) if event not in reader.store]
+            if fname != pathToFile and missing:
+                lgx.warning("-- The hit cache {0} does not have {1} of the events: not used".format(
+                    fname,len(missing)))
+                reader.CloseFile()
+                continue
+            lgx.info("-- Reading the events from the hit cache {0}".format(fname))
+            return reader
+
+    from IEventReader import IEventReader
+    return IEventReader(pathToFile,cacheSize=ip.ReadCache,branches=ip.ReadBranches,
+                        prefetch=ip.Prefetch)
+
+
+def ConvertEvents(pathToFile,fname,events=None,chunkSize=1000):
+    """
+    Extracts the selected particles of the events (all of them by default)
+    of the Irene file pathToFile to the cache fname. The events that cannot
+    be read are cached without particles (reading them from the cache fails)
+    """
+    from IEventReader import IEventReader
+    from IParticle import ParticleRecord
+
+    eventReader = IEventReader(pathToFile,cacheSize=ip.ReadCache,branches=ip.ReadBranches,
+                               prefetch=ip.Prefetch)
+    if events is None:
+        events = range(eventReader.NumberOfEvents())
+
+    writer = KStoreWriter(fname,[("part",PART_COLUMNS)]+
+                          [("hits{0}".format(npart),HIT_COLUMNS)
+                           for npart in range(1,NPARTS+1)],mode="w")
+    rows = []
+    for event in events:
+        try:
+            ievt = eventReader.ReadEvent(event)
+            tables = {"part":dict((name,[]) for name,dtype in PART_COLUMNS)}
+            for npart in range(1,NPARTS+1):
+                # (a single-electron event has no second particle)
+                try:
+                    record = ParticleRecord(ievt,npart)
+                except AttributeError:
+                    continue
+                record["npart"] = npart
+                for name,dtype in PART_COLUMNS:
+                    tables["part"][name].append(record[name])
+                tables["hits{0}".format(npart)] = {"hit":record["hits"]}
+        except Exception as error:
+            lgx.warning("-- Event {0} cached without particles: {1}".format(event,error))
+            tables = {}
+
+        rows.append((event,tables))
+        if len(rows) == chunkSize:
+            writer.WriteChunk(ChunkFromRows(rows)); rows = []
+            lgx.info("-- Cached events up to {0}".format(event))
+
+    writer.WriteChunk(ChunkFromRows(rows))
+    writer.Close()
+    eventReader.CloseFile()
+
+
+class ICachedEvent(object):
+    """
+    An event of the hit cache (what IHitCacheReader.ReadEvent returns, in
+    place of the Irene event)
+    """
+
+    def __init__(self,store,eventNumber):
+        self.store = store
+        self.eventNumber = eventNumber
+        self.part = store.Table(eventNumber,"part")
+
+    def Particle(self,npart=1):
+        """
+        The properties and true hits of the (npart)th selected particle, as
+        returned by IParticle.ParticleRecord (the arrays are views of the
+        cache)
+        """
+        rows = np.flatnonzero(self.part["npart"] == npart)
+        if len(rows) == 0:
+            raise IOError("event {0} has no particle {1} in the cache".format(
+                self.eventNumber,npart))
+
+        record = dict((name,column[rows[0]]) for name,column in self.part.items())
+        record["pdg"] = int(record["pdg"])
+        record["name"] = PDG_NAMES.get(record["pdg"],"pdg{0}".format(record["pdg"]))
+        record["hits"] = self.store.Table(self.eventNumber,"hits{0}".format(npart))["hit"]
+        return record
+
+
+class IHitCacheReader(KEventReader):
+    """
+    Implements the interface KEventReader with a hit cache
+    """
+
+    def __init__(self,pathToFile):
+        """
+        Constructor
+        """
+        KEventReader.__init__(self,pathToFile)
+
+        self.store = KStore(pathToFile)
+        self.eventNumber = None
+        self.numberOfBytesRead = 0
+        self.totalNumberOfBytesRead = 0
+        self.readLatency = 0.
+        self.totalReadLatency = 0.
+
+    def NumberOfEvents(self):
+        """
+        Returns the number of events of the file, as far as the cache has
+        them: the last event number in the cache + 1
+        """
+        events = self.store.Tracks()
+        return events[-1]+1 if events else 0
+
+    def ReadEvent(self,eventNumber):
+        """
+        Reads event number and returns a handle to the event
+        """
+        t0 = time.time()
+        if eventNumber not in self.store:
+            raise IOError("event {0} is not in the hit cache {1}".format(
+                eventNumber,self.pathToFile))
+
+        self.eventNumber = eventNumber
+        ievt = ICachedEvent(self.store,eventNumber)
+        if len(ievt.part["npart"]) == 0:
+            raise IOError("event {0} could not be read when the hit cache {1} was made".format(
+                eventNumber,self.pathToFile))
+        self.numberOfBytesRead = sum(column.nbytes for column in ievt.part.values())
+        for npart in range(1,NPARTS+1):
+            self.numberOfBytesRead += self.store.Table(eventNumber,"hits{0}".format(npart))["hit"].nbytes
+        self.totalNumberOfBytesRead+=self.numberOfBytesRead
+        self.readLatency = time.time()-t0
+        self.totalReadLatency+=self.readLatency
+
+        return ievt
+
+    def NumberOfBytesRead(self):
+        return self.numberOfBytesRead
+
+    def TotalNumberOfBytesRead(self):
+        return self.totalNumberOfBytesRead
+
+    def ReadLatency(self):
+        return self.readLatency
+
+    def TotalReadLatency(self):
+        return self.totalReadLatency
+
+    def EventNumber(self):
+        return self.eventNumber
+
+    def CloseFile(self):
+        """
+        Closes the file
+        """
+        self.store = None
+
+
+def main(argv):
+
+    inputFile = ip.inputFile
+    inputDir = ip.inputDir
+    fname = ""
+    sevt = ""; eevt = ""
+    try:
+        opts, args = getopt.getopt(argv,"hi:d:s:e:o:",["ifile=","idir=","sevt=","eevt=","ofile="])
+    except getopt.GetoptError:
+        print 'IHitCache -i <inputFile> -d <inputDir> -s <event start> -e <event end> -o <cache>'
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print 'IHitCache -i <inputFile> -d <inputDir> -s <event start> -e <event end> -o <cache>'
+            sys.exit()
+        elif opt in ("-i", "--ifile"):
+            inputFile = arg
+        elif opt in ("-d", "--idir"):
+            inputDir = arg
+        elif opt in ("-s", "--sevt"):
+            sevt = arg
+        elif opt in ("-e", "--eevt"):
+            eevt = arg
+        elif opt in ("-o", "--ofile"):
+            fname = arg
+
+    pathToFile = inputDir+'/'+inputFile
+    if fname == "":
+        fname = CacheFileName(pathToFile)
+    events = None
+    if sevt != "" and eevt != "":
+        events = range(int(sevt),int(eevt))
+
+    print "-- Caching the events of {0} in {1}".format(pathToFile,fname)
+    ConvertEvents(pathToFile,fname,events)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -3,17 +3,18 @@ Main driver: a file with event and calls the user-supplied method:
 """
 
 
-from IEventReader import IEventReader
+from IHitCache import OpenEvents
 from IParticle import IParticle
-from KTrackFitter import KTrackFitter
+from KTrackFitter import KTrackFitter, FitBatch
 from KFWolinFilter import KFWolinFilter
-from TDrawHits import TDrawHits
-from MPLDrawHits import MPLDrawHits
 import IParam as ip
 import sys,getopt
 import numpy as np
 
-from KFBase import KFVector
+from KFBase import KFVector, Random
+from KFitStore import KFitStoreWriter, FitFileName
+from KPipeline import KPipeline, KStage
+from KJournal import KJournal, JournalFileName
 from KLog import *
 #create logger
 lgx =logging.getLogger("IMain")
@@ -30,37 +31,31 @@ fit_outdir="/data4/NEXT/users/jrenner/kalmanfilter/out/ifit"
 
 def main(argv):
     
-    pathToFile,sevt,eevt,itrk_name,bbevt,rev_trk = GetArguments(argv)
+    pathToFile,sevt,eevt,itrk_name,bbevt,rev_trk,bidir,resume = GetArguments(argv)
 
-    print "-- Got args.  pathToFile = {0}, sevt = {1}, eevt = {2}, itrk_name = {3}, bbevt = {4}, rev_trk = {5}".format(pathToFile,sevt,eevt,itrk_name,bbevt,rev_trk);
+    print "-- Got args.  pathToFile = {0}, sevt = {1}, eevt = {2}, itrk_name = {3}, bbevt = {4}, rev_trk = {5}, bidir = {6}, resume = {7}".format(pathToFile,sevt,eevt,itrk_name,bbevt,rev_trk,bidir,resume);
 
-    if(rev_trk):
+    if(bidir):
+        print "\n\n-- WORKING ON FORWARD AND REVERSED TRACKS --\n\n"
+    elif(rev_trk):
         print "\n\n-- WORKING ON REVERSED TRACKS --\n\n"
-        #fnb_trk = "{0}/rev/".format(trk_outdir)
-        fnb_fit = "{0}/{1}/rev/".format(fit_outdir,itrk_name)
+
+    fnb_fit,fnb_rfit = FitDirectories("{0}/{1}".format(fit_outdir,itrk_name),rev_trk,bidir)
+
+    # The events fitted are committed to the journal of the run; a resumed
+    #  run fits only the events that the journal does not have, a new run
+    #  starts its fit stores anew.
+    journal = KJournal(JournalFileName(fnb_fit,itrk_name),resume)
+    if(resume):
+        journal.Restore(FitStores(fnb_fit,fnb_rfit,itrk_name,bidir))
     else:
-        fnb_fit = "{0}/{1}".format(fit_outdir,itrk_name)
-
-    if(not os.path.isdir(fit_outdir)):
-        try:
-            os.mkdir(fit_outdir);
-        except OSError:
-            print "Error creating {0}".format(fit_outdir);
-    if(not os.path.isdir("{0}/{1}".format(fit_outdir,itrk_name))):
-        print "Directory {0}/{1} does not exist, creating...".format(fit_outdir,itrk_name);
-        try:
-            os.mkdir("{0}/{1}".format(fit_outdir,itrk_name));
-        except OSError:
-            print "Error creating {0}/{1}".format(fit_outdir,itrk_name);
-    if(not os.path.isdir("{0}/{1}/rev".format(fit_outdir,itrk_name))):
-        print "Directory {0}/{1}/rev does not exist, creating...".format(fit_outdir,itrk_name);
-        try:
-            os.mkdir("{0}/{1}/rev".format(fit_outdir,itrk_name));
-        except:
-            print "Error creating {0}/{1}/rev".format(fit_outdir,itrk_name);
+        NewStores(FitStores(fnb_fit,fnb_rfit,itrk_name,bidir))
+    events = journal.Remaining(range(sevt,eevt))
+    if(resume):
+        print "-- Resuming: {0} of {1} events already fitted".format(eevt-sevt-len(events),eevt-sevt)
 
     #reader---
-    eventReader = IEventReader(pathToFile)
+    eventReader = OpenEvents(pathToFile,events)
     #nRun = min(eventReader.NumberOfEvents(),nEvents)
     
     #--Logging
@@ -75,13 +70,91 @@ def main(argv):
     #slkf = KFWolinFilter("KFWolin",P0=2.9) #KF Fitter 
     
     #------Loop: cover events sevt to (eevt-1)
-    for event in range(sevt,eevt):
+    pipeline = FitEvents(eventReader,events,fnb_fit,fnb_rfit,itrk_name,bbevt,rev_trk,bidir,journal)
+    print pipeline.Report()
+    journal.Close()
+
+
+def FitDirectories(fnb_run,rev_trk,bidir):
+    """
+    Creates the fit directory fnb_run of a run and its reverse fit directory
+    fnb_run/rev. Returns the directories in which the fits are written:
+    (fnb_fit,fnb_rfit), forward and reverse fits go to fnb_fit and fnb_rfit
+    (bidir)
+    """
+    fnb_rfit = "{0}/rev/".format(fnb_run)
+    if(rev_trk and not bidir):
+        fnb_fit = fnb_rfit
+    else:
+        fnb_fit = fnb_run
+
+    for fdir in (os.path.dirname(fnb_run),fnb_run,fnb_rfit):
+        if(fdir and not os.path.isdir(fdir)):
+            print "Directory {0} does not exist, creating...".format(fdir);
+            try:
+                os.mkdir(fdir);
+            except OSError:
+                print "Error creating {0}".format(fdir);
+
+    return fnb_fit,fnb_rfit
+
+
+def FitStores(fnb_fit,fnb_rfit,itrk_name,bidir):
+    """
+    The fit stores of a run (ip.FitStore): forward, and reverse (bidir)
+    """
+    if not ip.FitStore: return []
+    return [FitFileName(fnb_fit,itrk_name)]+([FitFileName(fnb_rfit,itrk_name)] if bidir else [])
+
+
+def NewStores(stores):
+    """
+    Removes the fit stores (file names) left by an earlier run, which a new
+    run would otherwise append to
+    """
+    for fname in stores:
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+
+def FitEvents(eventReader,events,fnb_fit,fnb_rfit,itrk_name,bbevt,rev_trk,bidir,journal=None):
+    """
+    Reads the events (a list of event numbers) with eventReader, fits them
+    (ip.FitBatch at a time) and writes their fit files. The batches stream
+    through a pipeline (see KPipeline): they are read by one thread, fitted
+    by ip.FitWorkers workers and written in order by the calling thread,
+    which commits each batch written to the journal (if any).
+    Returns the pipeline (its stats)
+    """
+    batches = [events[i:i+ip.FitBatch] for i in range(0,len(events),ip.FitBatch)]
+
+    pipeline = KPipeline([KStage("read",lambda batch: ReadEvents(eventReader,batch,bbevt,rev_trk)),
+                          KStage("fit",lambda batch: FitFitters(batch,bidir),
+                                 ip.FitWorkers,ip.FitProcesses)],ip.QueueSize)
+    def Write(batch):
+        WriteFits(batch,fnb_fit,fnb_rfit,itrk_name,bidir)
+        if journal is not None:
+            journal.Commit([evt for evt,tf in batch],FitStores(fnb_fit,fnb_rfit,itrk_name,bidir))
+
+    pipeline.Run(batches,Write)
+    lgx.debug(pipeline.Report())
+    return pipeline
+
+
+def ReadEvents(eventReader,events,bbevt,rev_trk):
+    """
+    Reads the events (a list of event numbers) with eventReader and sets up
+    their track fitters. Returns the list of (event,fitter)
+    """
+    batch = []
+
+    for event in events:
     #---------
 
         #--Logging
         s="Reading event number {0}"
         lgx.debug(s.format(event))
-        cond_pause(Debug.verbose.value)
+        cond_pause(debug)
         #--
 
         #read event
@@ -89,39 +162,42 @@ def main(argv):
 
         #--Logging
         s="Number of Bytes read = {0} "
-        s+="Total number of Bytes read = {1}"
+        s+="Total number of Bytes read = {1} "
+        s+="Read latency = {2} s (total {3} s)"
         lgx.debug(s.format(eventReader.NumberOfBytesRead(),
-                        eventReader.TotalNumberOfBytesRead()))
-        cond_pause(Debug.verbose.value)
+                        eventReader.TotalNumberOfBytesRead(),
+                        eventReader.ReadLatency(),eventReader.TotalReadLatency()))
+        cond_pause(debug)
         #--
 
         #Get MC particle
+        # (the hits of an event are smeared with the stream (ip.Seed, event),
+        # whatever the worker and the order in which the events are fitted)
+        rng = Random.stream(ip.Seed,event)
         smearVector =np.array([ip.sigma_x, ip.sigma_y, 0]) 
-        betaMax = IParticle(ievt,smearVector,ip.sample)
+        betaMax = IParticle(ievt,smearVector,ip.sample,rng=rng)
         
         # Get the other electron if this is a double-beta event.
         if(bbevt):
-            betaSecond = IParticle(ievt,smearVector,ip.sample,2447.,2)
+            betaSecond = IParticle(ievt,smearVector,ip.sample,2447.,2,rng)
 
             # Assign the list of smeared hits appropriately.            
+            # (the reverse list is the forward list reversed, so in bidir
+            # mode the forward list is fitted in both directions)
             if(not rev_trk):
-                trueHits = betaMax.TrueHits(); trueHits.reverse()
+                trueHits = betaMax.TrueHits()[::-1]
                 secondHits = betaSecond.TrueHits()
-                smearHits = betaMax.SmearedHits(); smearHits.reverse()
+                smearHits = betaMax.SmearedHits(True)
                 sSmearHits = betaSecond.SmearedHits()
             else:
-                trueHits = betaSecond.TrueHits(); trueHits.reverse()
+                trueHits = betaSecond.TrueHits()[::-1]
                 secondHits = betaMax.TrueHits()
-                smearHits = betaSecond.SmearedHits(); smearHits.reverse()
+                smearHits = betaSecond.SmearedHits(True)
                 sSmearHits = betaMax.SmearedHits()
             
-            # Construct the list of true hits from both tracks.
-            for th in secondHits:
-                trueHits.append(th)
-                
-            # Construct the list of smeared hits from both tracks.
-            for sh in sSmearHits:
-                smearHits.append(sh)
+            # Construct the arrays of true and smeared hits from both tracks.
+            trueHits = np.vstack((trueHits,secondHits))
+            smearHits = np.vstack((smearHits,sSmearHits))
         else:
             trueHits = betaMax.TrueHits()
             smearHits = betaMax.SmearedHits(rev_trk)                        
@@ -134,7 +210,7 @@ def main(argv):
         #--Logging
         s ="betaMax ={0}"
         lgx.debug(s.format(betaMax))
-        cond_pause(Debug.verbose.value)
+        cond_pause(debug)
         if debug >= Debug.verbose.value:
             DrawHits(trueHits,smearHits)
         #----
@@ -147,64 +223,114 @@ def main(argv):
         lgx.debug("-- Creating KFTrackFitter...")
         tfitter  = KTrackFitter(kfilter,smearHits,smearVector,
                                  betaMax,chi2Limit=ip.Chi2Lim,Pressure=ip.Pr)
-    
-        
-        # Perform the fit.
-        lgx.debug("-- Performing fit...")
-        tfitter.Fit()
-        cond_pause(Debug.verbose.value)
+        batch.append((event,tfitter))
 
-        segments = tfitter.Segments
+    return batch
 
-        lgx.debug("-- Fitter found {0} segments".format(segments))
+
+def FitFitters(batch,bidir):
+    """
+    Fits (and smooths) a batch of (event,fitter) in lockstep. Returns the
+    batch
+    """
+    lgx.debug("-- Performing fit of {0} events...".format(len(batch)))
+    FitBatch([tf for evt,tf in batch],bidirectional=bidir)
+    if ip.Smooth:
+        for evt,tf in batch: tf.Smooth()
+    cond_pause(debug)
+    return batch
+
+
+def WriteFits(batch,fnb_fit,fnb_rfit,itrk_name,bidir):
+    """
+    Writes the fits of a batch of (event,fitter): to the store of the run
+    as one chunk, or to the fit files of each event
+    """
+    if ip.FitStore:
+        AppendFits(fnb_fit,itrk_name,[(evt,tf.Segments) for evt,tf in batch],ip.Smooth)
+        if(bidir): AppendFits(fnb_rfit,itrk_name,[(evt,tf.RevSegments) for evt,tf in batch])
+    else:
+        for evt,tf in batch:
+            WriteFit(fnb_fit,itrk_name,evt,tf.Segments)
+            if(bidir): WriteFit(fnb_rfit,itrk_name,evt,tf.RevSegments)
+
+
+def AppendFits(fnb_fit,itrk_name,events,smooth=False):
+    """
+    Appends the fits of a list of (event,segments) to the store of the run
+    in fnb_fit as one chunk
+    """
+    store = KFitStoreWriter(FitFileName(fnb_fit,itrk_name),smooth)
+    store.Write(events)
+    store.Close()
+
+
+def WriteFit(fnb_fit,itrk_name,event,segments):
+    """
+    Logs the segments of a fitted event and writes its fit files
+    """
+    lgx.debug("-- Fitter found {0} segments".format(segments))
+
+    for seg in segments:
     
-        for seg in segments:
-        
-            # Get the mean, min, and max chi2 values for each segment.
-            #  Set to -1 if the segment is not >= 3 points.
-            
-            mean_chi2 = -1.; min_chi2 = -1.; max_chi2 = -1.;
-            
-            if(len(seg.seg_k) >= 2):
-                mean_chi2 = np.mean(seg.seg_fchisq[1:])
-                min_chi2 = min(seg.seg_fchisq[1:])
-                max_chi2 = max(seg.seg_fchisq[1:])
+        # Get the mean, min, and max chi2 values for each segment.
+        #  Set to -1 if the segment is not >= 3 points.
         
-            # Print the segment file line.
-            s="segment id = {0} length ={1}"
-            s+=" mean chi2 ={2} min chi2 = {3} max chi2 ={4}\n"
-            lgx.info(s.format(seg.seg_id,
-            len(seg.seg_k),mean_chi2,min_chi2,max_chi2));
+        mean_chi2 = -1.; min_chi2 = -1.; max_chi2 = -1.;
         
-        # Temporary fit result writing
-        f_ftrk = open("{0}/fit_{1}_{2}.dat".format(fnb_fit,itrk_name,event),"w")
-        f_fseg = open("{0}/seg_{1}_{2}.dat".format(fnb_fit,itrk_name,event),"w")
+        if(len(seg.seg_k) >= 2):
+            mean_chi2 = np.mean(seg.seg_fchisq[1:])
+            min_chi2 = min(seg.seg_fchisq[1:])
+            max_chi2 = max(seg.seg_fchisq[1:])
+    
+        # Print the segment file line.
+        s="segment id = {0} length ={1}"
+        s+=" mean chi2 ={2} min chi2 = {3} max chi2 ={4}\n"
+        lgx.info(s.format(seg.seg_id,
+        len(seg.seg_k),mean_chi2,min_chi2,max_chi2));
+    
+    # Temporary fit result writing (the files are renamed into place once
+    #  written, so that a fit file is never left half written)
+    fn_ftrk = "{0}/fit_{1}_{2}.dat".format(fnb_fit,itrk_name,event)
+    fn_fseg = "{0}/seg_{1}_{2}.dat".format(fnb_fit,itrk_name,event)
+    f_ftrk = open(fn_ftrk+".tmp","w")
+    f_fseg = open(fn_fseg+".tmp","w")
+    # the header follows the segments (the reverse fit is not smoothed)
+    smooth = len(segments) > 0 and all(seg.IsSmoothed() for seg in segments)
+    if smooth:
+        f_ftrk.write("# segID k x0 y0 z0 p1p p2p p3p p4p chi2p p1f p2f p3f p4f chi2f cfxy cftxy p1s p2s p3s p4s chi2s\n")
+    else:
         f_ftrk.write("# segID k x0 y0 z0 p1p p2p p3p p4p chi2p p1f p2f p3f p4f chi2f cfxy cftxy\n")
-        f_fseg.write("# segID nPts chi2avg chi2min chi2max\n")
+    f_fseg.write("# segID nPts chi2avg chi2min chi2max\n")
 
-        for seg in segments:
-        
-            # Get the mean, min, and max chi2 values for each segment.
-            #  Set to -1 if the segment is not >= 3 points.
-            mean_chi2 = -1.; min_chi2 = -1.; max_chi2 = -1.;
-            if(len(seg.seg_k) >= 2):
-                mean_chi2 = np.mean(seg.seg_fchisq[1:]);
-                min_chi2 = min(seg.seg_fchisq[1:]);
-                max_chi2 = max(seg.seg_fchisq[1:]);
-            
-            # Print the segment file line.
-            f_fseg.write("{0} {1} {2} {3} {4}\n".format(seg.seg_id,len(seg.seg_k),mean_chi2,min_chi2,max_chi2));
-            
-            # Print the track file lines for each segment point: include the smeared hits.
-            for k,x0,y0,z0,p1p,p2p,p3p,p4p,chi2p,p1f,p2f,p3f,p4f,chi2f,cfxy,cftxy in zip(seg.seg_k,seg.seg_x0,seg.seg_y0,seg.seg_z0,seg.seg_p1p,seg.seg_p2p,seg.seg_p3p,seg.seg_p4p,seg.seg_pchisq,seg.seg_p1f,seg.seg_p2f,seg.seg_p3f,seg.seg_p4f,seg.seg_fchisq,seg.seg_cfxy,seg.seg_cftxy):
-                if(isinstance(chi2f,KFVector)):
-                    chi2 = chi2f[2];
-                else:
-                    chi2 = chi2f;
-                f_ftrk.write("{0} {1} {2} {3} {4} {5} {6} {7} {8} {9} {10} {11} {12} {13} {14} {15} {16}\n".format(seg.seg_id,k,x0,y0,z0,p1p,p2p,p3p,p4p,chi2p,p1f,p2f,p3f,p4f,chi2f,cfxy,cftxy));
+    for seg in segments:
     
-
+        # Get the mean, min, and max chi2 values for each segment.
+        #  Set to -1 if the segment is not >= 3 points.
+        mean_chi2 = -1.; min_chi2 = -1.; max_chi2 = -1.;
+        if(len(seg.seg_k) >= 2):
+            mean_chi2 = np.mean(seg.seg_fchisq[1:]);
+            min_chi2 = min(seg.seg_fchisq[1:]);
+            max_chi2 = max(seg.seg_fchisq[1:]);
         
+        # Print the segment file line.
+        f_fseg.write("{0} {1} {2} {3} {4}\n".format(seg.seg_id,len(seg.seg_k),mean_chi2,min_chi2,max_chi2));
+        
+        # Print the track file lines for each segment point: include the smeared hits.
+        for i,(k,x0,y0,z0,p1p,p2p,p3p,p4p,chi2p,p1f,p2f,p3f,p4f,chi2f,cfxy,cftxy) in enumerate(zip(seg.seg_k,seg.seg_x0,seg.seg_y0,seg.seg_z0,seg.seg_p1p,seg.seg_p2p,seg.seg_p3p,seg.seg_p4p,seg.seg_pchisq,seg.seg_p1f,seg.seg_p2f,seg.seg_p3f,seg.seg_p4f,seg.seg_fchisq,seg.seg_cfxy,seg.seg_cftxy)):
+            if(isinstance(chi2f,KFVector)):
+                chi2 = chi2f[2];
+            else:
+                chi2 = chi2f;
+            f_ftrk.write("{0} {1} {2} {3} {4} {5} {6} {7} {8} {9} {10} {11} {12} {13} {14} {15} {16}".format(seg.seg_id,k,x0,y0,z0,p1p,p2p,p3p,p4p,chi2p,p1f,p2f,p3f,p4f,chi2f,cfxy,cftxy));
+            if smooth:
+                f_ftrk.write(" {0} {1} {2} {3} {4}".format(seg.seg_p1s[i],seg.seg_p2s[i],seg.seg_p3s[i],seg.seg_p4s[i],seg.seg_schisq[i]));
+            f_ftrk.write("\n")
+
+    f_ftrk.close()
+    f_fseg.close()
+    os.rename(fn_ftrk+".tmp",fn_ftrk)
+    os.rename(fn_fseg+".tmp",fn_fseg)
 
 def GetArguments(argv):
     inputFile = ''
@@ -214,17 +340,21 @@ def GetArguments(argv):
     eevt=''
     bbevt=False
     rev_trk=False
+    bidir=False
     itrk_name='' 
+    resume=False
     try:      
-        opts, args = getopt.getopt(argv,"hi:d:s:e:u:g:r:",["ifile=","idir=","sevt=","eevt","rname=","gen=","rev="])
+        opts, args = getopt.getopt(argv,"hi:d:s:e:u:g:r:",["ifile=","idir=","sevt=","eevt","rname=","gen=","rev=","resume"])
     except getopt.GetoptError:
-        print 'IMain -i <inputFile> -d <inputDir> -s <event start> -e <event end> -u <run_name> -g <0=sel,1=bb> -r <0=forward,1=reverse>'
+        print 'IMain -i <inputFile> -d <inputDir> -s <event start> -e <event end> -u <run_name> -g <0=sel,1=bb> -r <0=forward,1=reverse,2=both> [--resume]'
         sys.exit(2)
     
     for opt, arg in opts:
         if opt == '-h':
-            print 'IMain -i <inputFile> -d <inputDir> -s <event start> -e <event end> -u <run_name> -g <0=sel,1=bb> -r <0=forward,1=reverse>'
+            print 'IMain -i <inputFile> -d <inputDir> -s <event start> -e <event end> -u <run_name> -g <0=sel,1=bb> -r <0=forward,1=reverse,2=both> [--resume]'
             sys.exit()
+        elif opt == "--resume":
+            resume = True
         elif opt in ("-i", "--ifile"):
             inputFile = arg
         elif opt in ("-d", "--idir"):
@@ -241,7 +371,8 @@ def GetArguments(argv):
             if(int(arg) > 0): bbevt = True
             else: bbevt = False
         elif opt in ("-r", "--rev"):
-            if(int(arg) > 0): rev_trk = True
+            if(int(arg) > 1): bidir = True
+            elif(int(arg) > 0): rev_trk = True
             else: rev_trk = False 
             
     if inputFile=="":
@@ -262,7 +393,7 @@ def GetArguments(argv):
 
     pathToFile = inputDir+'/'+inputFile
 
-    return (pathToFile,sevt,eevt,itrk_name,bbevt,rev_trk)
+    return (pathToFile,sevt,eevt,itrk_name,bbevt,rev_trk,bidir,resume)
 
 def DrawHits(trueHits,smearHits):
     """
@@ -276,6 +407,7 @@ def DrawHits(trueHits,smearHits):
     upperBin =np.array([700.,700.,700.])/scale
 
     if DrawRoot == True:
+        from TDrawHits import TDrawHits   # (ROOT)
         drawHits = TDrawHits((lowerBin,upperBin),trueHits,smearHits)
         drawHits.DrawMeasurements(draw='2D')
         drawHits.DrawMeasurements(draw='3D')
@@ -286,6 +418,7 @@ def DrawHits(trueHits,smearHits):
         drawHits.DrawAll(draw='2D')
         
     elif DrawMPL == True:
+        from MPLDrawHits import MPLDrawHits
         drawHits = MPLDrawHits((lowerBin,upperBin),trueHits,smearHits)
         # drawHits.DrawMeasurements(draw='2D')
         # drawHits.DrawMeasurements(draw='3D')
@@ -20,6 +20,19 @@ eps = 0.001
 Pr = 10.1325      #pressure in bar
 sample =5.
 Chi2Lim=4.
+FitBatch=100  #number of events fitted in lockstep
+Smooth=False  #smooth the fits and add the smoothed states to the fit files
+FitStore=False #write the fits to one store per run, fit_<run>.kfs (see KFitStore), instead of text files
+Workers=0     #number of worker processes of IScheduler (0 = all cores)
+Retries=2     #number of times IScheduler retries the events that failed
+Seed=1        #run seed: the hits of event i are smeared with the random stream (Seed,i)
+HitCache=True #read the events from the hit cache of the input file, <file>.khc, if there is one (see IHitCache)
+ReadCache=30*1024*1024  #size in bytes of the TTree read cache of IEventReader (0 = no cache)
+ReadBranches=["EventBranch.fTracks*","EventBranch.fParticles*"]  #sub-branches read by IEventReader, those IParticle uses (None = all)
+Prefetch=8    #number of events IEventReader reads ahead on a background thread (0 = no read-ahead)
+FitWorkers=1  #number of workers of the fit stage of the IMain pipeline (see KPipeline)
+FitProcesses=False #the fit workers are processes (else threads; the workers of IScheduler use threads)
+QueueSize=4   #number of batches of events that wait in front of each stage of the pipeline
 
 sigma_x=5. #measurement resolution in mm
 sigma_y=5.
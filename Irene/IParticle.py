@@ -5,6 +5,7 @@ JJ, Spring, 2014
 
 import numpy as np
 from KMCParticle import KMCParticle
+from IHitCache import ICachedEvent
 
 
 
@@ -13,31 +14,30 @@ class IParticle(KMCParticle):
     Implements the interface to KMCParticle with an Irene particle
     """
 
-    def __init__(self,ievt,smearVector,sample=5,TMAX=2447,npart=1):
+    def __init__(self,ievt,smearVector,sample=5,TMAX=2447,npart=1,rng=None):
         """
         Grab the main properties of the particle
         TMAX is the Qbb of Xe-136 in keV
+        rng is the random stream used to smear the hits (see KMCParticle)
         """
 
         self.TMAX = TMAX
         self.ievt = ievt
-        ipart,itrk = self.__SelectEMax(npart)
-        self.ihits = itrk.GetHits()
-        
-        i_vx = ipart.GetInitialVertex()
-        i_p = ipart.GetInitialMomentum()
-        d_vx = ipart.GetDecayVertex()
-
-        self.name = ipart.Name()
-        self.pdg = ipart.GetPDGcode()
-        self.mass =ipart.GetMass()
-        self.E0 =ipart.Energy()
-        self.P0= ipart.Momentum()
+        if(isinstance(ievt,ICachedEvent)):
+            record = ievt.Particle(npart)
+        else:
+            record = ParticleRecord(ievt,npart)
+
+        self.name = record["name"]
+        self.pdg = record["pdg"]
+        self.mass = record["mass"]
+        self.E0 = record["energy"]
+        self.P0 = record["momentum"]
         self.T0 =self.E0 - self.mass 
-        self.V0 = np.array([i_vx.X(),i_vx.Y(),i_vx.Z()])
-        self.Vf = np.array([d_vx.X(),d_vx.Y(),d_vx.Z()])
-        self.P30 = np.array([i_p.X(),i_p.Y(),i_p.Z()])
-        self.trackLength = ipart.GetTrackLength()
+        self.V0 = record["vertex"]
+        self.Vf = record["decayVertex"]
+        self.P30 = record["p3"]
+        self.trackLength = record["trackLength"]
         if(self.P30[2] > 0):
             self.ux = self.P30[0]/self.P30[2]
             self.uy = self.P30[1]/self.P30[2]
@@ -45,9 +45,9 @@ class IParticle(KMCParticle):
             self.ux = self.P30[0]/self.P0
             self.uy = self.P30[1]/self.P0
 
-        self.THits = self.__FillTrueHits()
+        self.THits = record["hits"]
 
-        KMCParticle.__init__(self,smearVector,sample)
+        KMCParticle.__init__(self,smearVector,sample,rng)
         
 
     def Name(self):
@@ -139,64 +139,89 @@ class IParticle(KMCParticle):
         """
         True hits left by this particle in the detector. The particle trajectory could have been
         affected by MS, Eloss and the effect of B, but there is no detector resolution.
-        hit = np.array(x,y,z,edep)
+        (N,4) array, hit = (x,y,z,edep)
         """
         return self.THits
 
 
-    def __FillTrueHits(self):
-        """
-        Fills the true hits in an array
-        """
+def ParticleRecord(ievt,npart=1):
+    """
+    The properties and true hits of the (npart)th most energetic primary
+    particle of an Irene event (see SelectEMax), as a dictionary: name, pdg,
+    mass, energy, momentum, vertex, decayVertex, p3, trackLength and hits,
+    the (N,4) array of true hits (x,y,z,edep)
+    """
+    ipart,itrk = SelectEMax(ievt,npart)
 
-        TrueHits=[]        
-        
-        for i in range(0,self.ihits.size()):
-            ihit = self.ihits.at(i)
-            xyzt = ihit.first
-            energy = ihit.second 
-            hit =np.array([xyzt.X(),xyzt.Y(),xyzt.Z(),energy])
-            TrueHits.append(hit)
+    i_vx = ipart.GetInitialVertex()
+    i_p = ipart.GetInitialMomentum()
+    d_vx = ipart.GetDecayVertex()
 
-        return TrueHits
+    return {"name": ipart.Name(),
+            "pdg": ipart.GetPDGcode(),
+            "mass": ipart.GetMass(),
+            "energy": ipart.Energy(),
+            "momentum": ipart.Momentum(),
+            "vertex": np.array([i_vx.X(),i_vx.Y(),i_vx.Z()]),
+            "decayVertex": np.array([d_vx.X(),d_vx.Y(),d_vx.Z()]),
+            "p3": np.array([i_p.X(),i_p.Y(),i_p.Z()]),
+            "trackLength": ipart.GetTrackLength(),
+            "hits": FillTrueHits(itrk.GetHits())}
 
-    def __SelectEMax(self,npart):
-        """
-        Selects the electron that is the (npart)th most energetic
-        in the list of particles for the event, where npart = 1 or 2.
-        """
+
+def FillTrueHits(ihits):
+    """
+    Fills the true hits of an Irene track in an (N,4) array
+    """
+
+    TrueHits = np.empty((ihits.size(),4))
     
-        eps = 0.01 #tolerance
+    for i in range(0,ihits.size()):
+        ihit = ihits.at(i)
+        xyzt = ihit.first
+        TrueHits[i] = (xyzt.X(),xyzt.Y(),xyzt.Z(),ihit.second)
+    TrueHits.flags.writeable = False
+
+    return TrueHits
+
+
+def SelectEMax(ievt,npart):
+    """
+    Selects the electron that is the (npart)th most energetic
+    in the list of particles for the event, where npart = 1 or 2.
+    """
+
+    eps = 0.01 #tolerance
+
+    itrks= ievt.GetTracks()
+    n_itrks = itrks.GetEntries()
+
+    Emax = -1.; E2max = -1.
+    ipmax = 0; ip2max = 0
+    itrkmax=0; itrk2max = 0
+    for it in range(0,n_itrks):
+        itrk = itrks.At(it) 
+        ipart= itrk.GetParticle()
+
+        if ipart.IsPrimary() == False:
+            continue
+
+        T= (ipart.Energy()-ipart.GetMass())*1e+3
+
+        # Assign the energies, particles, and tracks correctly.
+        if(T > E2max): 
+            E2max = T
+            ip2max = ipart
+            itrk2max = itrk
+        if(E2max > Emax):
+            Etemp = Emax; Emax = E2max; E2max = Etemp
+            iptemp = ipmax; ipmax = ip2max; ip2max = iptemp
+            itrktemp = itrkmax; itrkmax = itrk2max; itrk2max = itrktemp
 
-        itrks= self.ievt.GetTracks()
-        n_itrks = itrks.GetEntries()
-        
-        Emax = -1.; E2max = -1.
-        ipmax = 0; ip2max = 0
-        itrkmax=0; itrk2max = 0
-        for it in range(0,n_itrks):
-            itrk = itrks.At(it) 
-            ipart= itrk.GetParticle()
-            
-            if ipart.IsPrimary() == False:
-                continue
-
-            T= (ipart.Energy()-ipart.GetMass())*1e+3
-            
-            # Assign the energies, particles, and tracks correctly.
-            if(T > E2max): 
-                E2max = T
-                ip2max = ipart
-                itrk2max = itrk
-            if(E2max > Emax):
-                Etemp = Emax; Emax = E2max; E2max = Etemp
-                iptemp = ipmax; ipmax = ip2max; ip2max = iptemp
-                itrktemp = itrkmax; itrkmax = itrk2max; itrk2max = itrktemp
-                
 #            if abs(T-self.TMAX)< eps:
 #                ipmax = ipart
 #                itrkmax=itrk
-        if(npart == 1):
-            return ipmax,itrkmax
-        if(npart == 2):
-            return ip2max,itrk2max
+    if(npart == 1):
+        return ipmax,itrkmax
+    if(npart == 2):
+        return ip2max,itrk2max
@@ -0,0 +1,298 @@
+"""
+Local scheduler: runs the IMain fit of an event range over a pool of worker
+processes on one node (no batch system needed).
+
+Each worker opens its own event reader once and is given the next event
+range as it becomes idle. The ranges shrink towards the end of the run so
+that the workers finish together. Failed events are retried one at a time (a
+range whose worker crashes is split until the crashing event is found), and the fits of each range are merged into the run directory, and committed
+to the journal of the run (see KJournal), as the range is done: a run that
+dies can be resumed (--resume) from the last range merged.
+
+python IScheduler.py -j <workers> + the IMain arguments
+"""
+import os
+import glob
+# The fit matrices are 4x4: BLAS threads only compete with the fit workers.
+for blas in ("OMP_NUM_THREADS","OPENBLAS_NUM_THREADS","MKL_NUM_THREADS"):
+    os.environ.setdefault(blas,"1")
+
+import sys,getopt
+import shutil
+import tempfile
+import traceback
+import multiprocessing
+
+import IMain
+from IMain import FitDirectories, FitEvents, FitStores, NewStores
+from IHitCache import OpenEvents
+import IParam as ip
+from KFitStore import KFitStore, KFitStoreWriter, FitFileName
+from KJournal import KJournal, JournalFileName
+
+from KLog import *
+#create logger
+lgx =logging.getLogger("IScheduler")
+lgx.setLevel(logging.INFO)
+lgx.addHandler(ch)
+
+# Worker state: the event reader opened by each worker and the fit options
+eventReader = None
+fitOptions = None
+
+def main(argv):
+
+    workers,iargv = GetArguments(argv)
+    pathToFile,sevt,eevt,itrk_name,bbevt,rev_trk,bidir,resume = IMain.GetArguments(iargv)
+
+    print "-- Got args.  pathToFile = {0}, sevt = {1}, eevt = {2}, itrk_name = {3}, bbevt = {4}, rev_trk = {5}, bidir = {6}, resume = {7}, workers = {8}".format(pathToFile,sevt,eevt,itrk_name,bbevt,rev_trk,bidir,resume,workers);
+
+    fnb_run = "{0}/{1}".format(IMain.fit_outdir,itrk_name)
+    fnb_fit,fnb_rfit = FitDirectories(fnb_run,rev_trk,bidir)
+
+    # a resumed run fits the events that the journal does not have (the
+    #  staging areas of the run that died are dropped), a new run starts its
+    #  fit stores anew
+    journal = KJournal(JournalFileName(fnb_fit,itrk_name),resume)
+    if(resume):
+        journal.Restore(FitStores(fnb_fit,fnb_rfit,itrk_name,bidir))
+    else:
+        NewStores(FitStores(fnb_fit,fnb_rfit,itrk_name,bidir))
+    events = journal.Remaining(range(sevt,eevt))
+    if(resume):
+        print "-- Resuming: {0} of {1} events already fitted".format(eevt-sevt-len(events),eevt-sevt)
+        for old in glob.glob(os.path.join(fnb_run,".stage_*")):
+            shutil.rmtree(old)
+
+    # every range is fitted into its own directory of the staging area
+    stage = tempfile.mkdtemp(prefix=".stage_",dir=fnb_run)
+
+    done,failed = RunEvents(pathToFile,events,workers,stage,
+                            itrk_name,bbevt,rev_trk,bidir,
+                            lambda fitted,part: CommitFits(fitted,part,fnb_run,journal,
+                                                           FitStores(fnb_fit,fnb_rfit,itrk_name,bidir),
+                                                           itrk_name))
+    shutil.rmtree(stage)
+    journal.Close()
+
+    print "-- Fitted {0} of {1} events".format(sum(len(events) for events,part in done),len(events))
+    for event,error in sorted(failed.items()):
+        print "-- Event {0} failed: {1}".format(event,error.strip().split("\n")[-1])
+
+
+def RunEvents(pathToFile,events,workers,stage,itrk_name,bbevt,rev_trk,bidir,commit=None):
+    """
+    Fits events over a pool of workers (see FitRanges). Failed events are
+    resubmitted one at a time up to ip.Retries times. commit(events,directory)
+    is called on the events fitted of each range as it is done. Returns the
+    list of (events,directory) of the fitted ranges and the dictionary
+    {event: error} of the events that could not be fitted
+    """
+    if not events: return [],{}
+
+    initargs = (pathToFile,events,stage,itrk_name,bbevt,rev_trk,bidir)
+
+    done = []
+    failed = {}
+    ranges = EventRanges(events,workers)
+    for attempt in range(ip.Retries+1):
+        if attempt > 0:
+            lgx.info("-- Retrying {0} failed events (attempt {1} of {2})".format(
+                len(ranges),attempt,ip.Retries))
+        for events,part,errors in FitRanges(ranges,workers,initargs):
+            fitted = [event for event in events if event not in errors]
+            if fitted:
+                done.append((fitted,part))
+                if commit is not None: commit(fitted,part)
+            for event in fitted: failed.pop(event,None)
+            failed.update(errors)
+            lgx.info("-- Fitted events {0} to {1} ({2} failed)".format(
+                events[0],events[-1],len(errors)))
+        ranges = [[event] for event in sorted(failed)]
+        if not ranges: break
+
+    return done,failed
+
+
+def FitRanges(ranges,workers,initargs):
+    """
+    Fits the ranges of events over worker processes (see Worker), each one
+    taking the next range when it is idle, and yields the (events,directory,
+    {event: error}) of each range as it is done. A range whose worker dies
+    (a crash in ROOT on a bad event) is split in two and fitted again, and an
+    event alone fails; the worker is replaced
+    """
+    todo = list(ranges)
+    idle = []
+    busy = {}
+    while todo or busy:
+        while todo and (idle or len(busy) < workers):
+            if idle:
+                worker = idle.pop()
+            else:
+                conn,child = multiprocessing.Pipe()
+                proc = multiprocessing.Process(target=Worker,args=(child,initargs))
+                proc.daemon = True
+                proc.start()
+                child.close()
+                worker = (proc,conn)
+            events = todo.pop(0)
+            worker[1].send(events)
+            busy[worker] = events
+
+        for worker,events in busy.items():
+            proc,conn = worker
+            if not conn.poll(0.1/len(busy)) and proc.is_alive(): continue
+            del busy[worker]
+            try:
+                result = conn.recv()
+            except Exception:
+                result = None
+            if result is not None:
+                idle.append(worker)
+                yield result
+                continue
+
+            # the worker died with the range
+            proc.join()
+            conn.close()
+            if len(events) > 1:
+                lgx.warning("-- Worker exited with code {0} on events {1} to {2}: splitting them".format(
+                    proc.exitcode,events[0],events[-1]))
+                todo[:0] = [events[:len(events)/2],events[len(events)/2:]]
+            else:
+                yield events,None,{events[0]: "worker exited with code {0} on event {1}".format(
+                    proc.exitcode,events[0])}
+
+    for proc,conn in idle:
+        conn.send(None)
+        proc.join()
+
+
+def EventRanges(events,workers):
+    """
+    Splits events in ranges for the workers (guided scheduling): each range
+    is a fraction 1/(2*workers) of the events still unassigned, between 1
+    and ip.FitBatch events, so that the last ranges are short
+    """
+    ranges = []
+    i = 0
+    while i < len(events):
+        n = (len(events)-i)/(2*workers)
+        n = max(1,min(ip.FitBatch,n))
+        ranges.append(events[i:i+n])
+        i += n
+    return ranges
+
+
+def InitWorker(pathToFile,events,stage,itrk_name,bbevt,rev_trk,bidir):
+    """
+    Opens the event reader of a worker for the events of the run (the file,
+    or its hit cache, is read by each worker)
+    """
+    global eventReader, fitOptions
+    eventReader = OpenEvents(pathToFile,events)
+    fitOptions = (stage,itrk_name,bbevt,rev_trk,bidir)
+
+
+def Worker(conn,initargs):
+    """
+    A worker process: opens its event reader (see InitWorker) and fits the
+    ranges of events it gets from conn (see FitRange), until None
+    """
+    InitWorker(*initargs)
+    while True:
+        events = conn.recv()
+        if events is None: break
+        conn.send(FitRange(events))
+
+
+def FitRange(events):
+    """
+    Fits a range of events (in a worker) into a new directory of the staging
+    area. If the range fails, its events are fitted one at a time to isolate
+    the failing ones. Returns (events,directory,{event: error})
+    """
+    stage,itrk_name,bbevt,rev_trk,bidir = fitOptions
+    part = tempfile.mkdtemp(prefix="part{0}_".format(events[0]),dir=stage)
+    fnb_fit,fnb_rfit = FitDirectories(part,rev_trk,bidir)
+
+    try:
+        FitEvents(eventReader,events,fnb_fit,fnb_rfit,itrk_name,bbevt,rev_trk,bidir)
+        return events,part,{}
+    except Exception:
+        if len(events) == 1:
+            return events,part,{events[0]: traceback.format_exc()}
+
+    errors = {}
+    for event in events:
+        try:
+            FitEvents(eventReader,[event],fnb_fit,fnb_rfit,itrk_name,bbevt,rev_trk,bidir)
+        except Exception:
+            errors[event] = traceback.format_exc()
+    return events,part,errors
+
+
+def CommitFits(events,part,fnb_run,journal,stores,itrk_name):
+    """
+    Merges the fits of the events of a range (fitted in directory part) into
+    the run directory fnb_run and commits them to the journal of the run
+    """
+    MergeFits([(events,part)],fnb_run,itrk_name)
+    journal.Commit(events,stores)
+
+
+def MergeFits(done,fnb_run,itrk_name):
+    """
+    Moves the fits of the fitted events from the staging area to the run
+    directory fnb_run (and fnb_run/rev): the fit files, or the fits of the
+    stores of the ranges, appended to the store of the run
+    """
+    for events,part in done:
+        for sub in ("","rev"):
+            fstore = FitFileName(os.path.join(part,sub),itrk_name)
+            if os.path.isfile(fstore):
+                store = KFitStore(fstore)
+                writer = KFitStoreWriter(FitFileName(os.path.join(fnb_run,sub),itrk_name),store.IsSmoothed())
+                writer.WriteChunk(store.Select([event for event in events if event in store]))
+                writer.Close()
+            for event in events:
+                for ftype in ("fit","seg"):
+                    fname = "{0}_{1}_{2}.dat".format(ftype,itrk_name,event)
+                    fsrc = os.path.join(part,sub,fname)
+                    if os.path.isfile(fsrc):
+                        os.rename(fsrc,os.path.join(fnb_run,sub,fname))
+
+
+def GetArguments(argv):
+    """
+    Returns the number of workers (-j, all the cores by default) and the
+    remaining arguments, which are passed to IMain
+    """
+    workers = ip.Workers
+    iargv = []
+    try:
+        opts, args = getopt.getopt(argv,"hi:d:s:e:u:g:r:j:",["ifile=","idir=","sevt=","eevt","rname=","gen=","rev=","workers=","resume"])
+    except getopt.GetoptError:
+        print 'IScheduler -j <workers> -i <inputFile> -d <inputDir> -s <event start> -e <event end> -u <run_name> -g <0=sel,1=bb> -r <0=forward,1=reverse,2=both> [--resume]'
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print 'IScheduler -j <workers> -i <inputFile> -d <inputDir> -s <event start> -e <event end> -u <run_name> -g <0=sel,1=bb> -r <0=forward,1=reverse,2=both> [--resume]'
+            sys.exit()
+        elif opt in ("-j", "--workers"):
+            workers = int(arg)
+        elif opt == "--resume":
+            iargv += [opt]
+        else:
+            iargv += [opt,arg]
+
+    if workers <= 0:
+        workers = multiprocessing.cpu_count()
+
+    return workers,iargv
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
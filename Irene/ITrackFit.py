@@ -3,15 +3,14 @@ Main driver: a file with event and calls the user-supplied method:
 """
 
 
-from IEventReader import IEventReader
+from IHitCache import OpenEvents
 from IParticle import IParticle
 from KTrackFitter import KTrackFitter
 from KFWolinFilter import KFWolinFilter
-from TDrawHits import TDrawHits
-from MPLDrawHits import MPLDrawHits
 import IParam as ip
 import sys,getopt
 import numpy as np
+from KFBase import Random
 
 from KLog import *
 #create logger
@@ -27,7 +26,7 @@ def main(argv):
     pathToFile,nEvents = GetArguments(argv)
 
     #reader---
-    eventReader = IEventReader(pathToFile)
+    eventReader = OpenEvents(pathToFile)
     nRun = min(eventReader.NumberOfEvents(),nEvents)
     
     #--Logging
@@ -56,15 +55,17 @@ def main(argv):
 
         #--Logging
         s="Number of Bytes read = {0} "
-        s+="Total number of Bytes read = {1}"
+        s+="Total number of Bytes read = {1} "
+        s+="Read latency = {2} s (total {3} s)"
         lgx.debug(s.format(eventReader.NumberOfBytesRead(),
-                        eventReader.TotalNumberOfBytesRead()))
+                        eventReader.TotalNumberOfBytesRead(),
+                        eventReader.ReadLatency(),eventReader.TotalReadLatency()))
         cond_pause(Debug.verbose.value)
         #--
 
         #Get MC particle
         smearVector =np.array([ip.sigma_x, ip.sigma_y, 0.]) 
-        betaMax = IParticle(ievt,smearVector,ip.sample)
+        betaMax = IParticle(ievt,smearVector,ip.sample,rng=Random.stream(ip.Seed,event))
         trueHits = betaMax.TrueHits()
         smearHits = betaMax.SmearedHits()
 
@@ -174,6 +175,7 @@ def DrawHits(trueHits,smearHits):
     upperBin =np.array([700.,700.,700.])/scale
 
     if DrawRoot == True:
+        from TDrawHits import TDrawHits   # (ROOT)
         drawHits = TDrawHits((lowerBin,upperBin),trueHits,smearHits)
         drawHits.DrawMeasurements(draw='2D')
         drawHits.DrawMeasurements(draw='3D')
@@ -184,6 +186,7 @@ def DrawHits(trueHits,smearHits):
         drawHits.DrawAll(draw='2D')
         
     elif DrawMPL == True:
+        from MPLDrawHits import MPLDrawHits
         drawHits = MPLDrawHits((lowerBin,upperBin),trueHits,smearHits)
         # drawHits.DrawMeasurements(draw='2D')
         # drawHits.DrawMeasurements(draw='3D')
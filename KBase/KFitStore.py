@@ -0,0 +1,245 @@
+"""
+KFitStore.py
+
+Store of fit results (see KStore): one file per run (and direction),
+fit_<run>.kfs, instead of a fit_<run>_<ntrk>.dat and a seg_<run>_<ntrk>.dat
+text file per track. The fit table has the columns of the fit text files
+(plus edep) and the seg table those of the seg text files.
+"""
+import sys
+import os
+import numpy as np
+from KFBase import KFVector
+from KStore import KStore, KStoreWriter, ChunkFromRows
+
+# Columns of the fit table (the columns of the fit text files) and seg table
+FIT_COLUMNS = [("segID","<i8"),("k","<i8"),
+               ("x0","<f8"),("y0","<f8"),("z0","<f8"),
+               ("p1p","<f8"),("p2p","<f8"),("p3p","<f8"),("p4p","<f8"),("chi2p","<f8"),
+               ("p1f","<f8"),("p2f","<f8"),("p3f","<f8"),("p4f","<f8"),("chi2f","<f8"),
+               ("cfxy","<f8"),("cftxy","<f8"),("edep","<f8")]
+SMOOTH_COLUMNS = [("p1s","<f8"),("p2s","<f8"),("p3s","<f8"),("p4s","<f8"),("chi2s","<f8")]
+SEG_COLUMNS = [("segID","<i8"),("nPts","<i8"),
+               ("chi2avg","<f8"),("chi2min","<f8"),("chi2max","<f8")]
+
+
+def FitFileName(fnb_fit,trk_name):
+    """
+    The store of the fits of run trk_name in directory fnb_fit
+    """
+    return "{0}/fit_{1}.kfs".format(fnb_fit,trk_name)
+
+
+def SegmentRows(segments,smooth=False):
+    """
+    The rows of the fit and seg tables of one fitted track (its segments),
+    as two dictionaries of columns
+    """
+    fit = dict((name,[]) for name,dtype in FIT_COLUMNS+(SMOOTH_COLUMNS if smooth else []))
+    seg = dict((name,[]) for name,dtype in SEG_COLUMNS)
+
+    for sg in segments:
+
+        # Mean, min and max chi2 of the segment (-1 if it has < 2 points)
+        mean_chi2 = -1.; min_chi2 = -1.; max_chi2 = -1.;
+        if(len(sg.seg_k) >= 2):
+            mean_chi2 = np.mean(sg.seg_fchisq[1:])
+            min_chi2 = min(sg.seg_fchisq[1:])
+            max_chi2 = max(sg.seg_fchisq[1:])
+        for name,value in zip(("segID","nPts","chi2avg","chi2min","chi2max"),
+                              (sg.seg_id,len(sg.seg_k),mean_chi2,min_chi2,max_chi2)):
+            seg[name].append(value)
+
+        n = len(sg.seg_k)
+        fit["segID"] += [sg.seg_id]*n
+        for name,column in (("k",sg.seg_k),("x0",sg.seg_x0),("y0",sg.seg_y0),
+                            ("z0",sg.seg_z0),("p1p",sg.seg_p1p),("p2p",sg.seg_p2p),
+                            ("p3p",sg.seg_p3p),("p4p",sg.seg_p4p),("chi2p",sg.seg_pchisq),
+                            ("p1f",sg.seg_p1f),("p2f",sg.seg_p2f),("p3f",sg.seg_p3f),
+                            ("p4f",sg.seg_p4f),("cfxy",sg.seg_cfxy),("cftxy",sg.seg_cftxy),
+                            ("edep",sg.seg_edep)):
+            fit[name] += list(column)
+        fit["chi2f"] += [chi2f[2] if isinstance(chi2f,KFVector) else chi2f
+                         for chi2f in sg.seg_fchisq]
+        if smooth:
+            if sg.IsSmoothed():
+                for name,column in (("p1s",sg.seg_p1s),("p2s",sg.seg_p2s),("p3s",sg.seg_p3s),
+                                    ("p4s",sg.seg_p4s),("chi2s",sg.seg_schisq)):
+                    fit[name] += list(column)
+            else:
+                for name,dtype in SMOOTH_COLUMNS:
+                    fit[name] += [np.nan]*n
+
+    return fit,seg
+
+
+def Chunk(tracks,smooth=False):
+    """
+    Builds a chunk (see KStore.Chunk) from a list of (track id, segments)
+    """
+    rows = []
+    for ntrk,segments in tracks:
+        fit,seg = SegmentRows(segments,smooth)
+        rows.append((ntrk,{"fit":fit,"seg":seg}))
+    return ChunkFromRows(rows)
+
+
+class KFitStoreWriter(KStoreWriter):
+    """
+    Writes chunks of fitted tracks to a fit store
+    """
+
+    def __init__(self,fname,smooth=False,mode="a"):
+        """
+        Opens the store fname to append chunks ("a") or to write a new
+        store ("w"). smooth adds the smoothed columns to the fit table of a
+        new store (an existing store keeps its columns)
+        """
+        KStoreWriter.__init__(self,fname,[("fit",FIT_COLUMNS+(SMOOTH_COLUMNS if smooth else [])),
+                                          ("seg",SEG_COLUMNS)],mode)
+
+    def Write(self,tracks):
+        """
+        Writes a list of (track id, segments) as one chunk
+        """
+        smooth = len(dict(self.tables)["fit"]) > len(FIT_COLUMNS)
+        self.WriteChunk(Chunk(tracks,smooth))
+
+
+class KFitStore(KStore):
+    """
+    Reads a fit store (memory-mapped)
+    """
+
+    def IsSmoothed(self):
+        """
+        True if the fit table has the smoothed columns
+        """
+        return len(self.Columns("fit")) > len(FIT_COLUMNS)
+
+    def Track(self,ntrk):
+        """
+        The fit and seg columns of track ntrk (two dictionaries of views)
+        """
+        return self.Table(ntrk,"fit"),self.Table(ntrk,"seg")
+
+    def FitTable(self,ntrk):
+        """
+        The fit table of track ntrk with the columns of the fit text files
+        (as read with np.loadtxt)
+        """
+        return self.Array(ntrk,"fit")
+
+    def SegTable(self,ntrk):
+        """
+        The seg table of track ntrk with the columns of the seg text files
+        """
+        return self.Array(ntrk,"seg")
+
+
+class KFitReader(object):
+    """
+    Reads the fits of a run from its store or, if there is no store, from
+    the fit and seg text files
+    """
+
+    def __init__(self,fnb_fit,trk_name):
+        self.fnb_fit = fnb_fit
+        self.trk_name = trk_name
+        fname = FitFileName(fnb_fit,trk_name)
+        self.store = KFitStore(fname) if os.path.isfile(fname) else None
+
+    def FitTable(self,ntrk):
+        if self.store is not None:
+            return self.store.FitTable(ntrk)
+        return np.loadtxt("{0}/fit_{1}_{2}.dat".format(self.fnb_fit,self.trk_name,ntrk))
+
+    def SegTable(self,ntrk):
+        if self.store is not None:
+            return self.store.SegTable(ntrk)
+        return np.loadtxt("{0}/seg_{1}_{2}.dat".format(self.fnb_fit,self.trk_name,ntrk))
+
+
+def ConvertText(fnb_fit,trk_name,tracks,fname,chunkSize=1000):
+    """
+    Converts the fit and seg text files of the listed tracks in directory
+    fnb_fit to the store fname. The columns are found from the header line
+    of the text files; the columns that the files do not have are NaN
+    """
+    writer = None
+    rows = []
+    for ntrk in tracks:
+        ffit = "{0}/fit_{1}_{2}.dat".format(fnb_fit,trk_name,ntrk)
+        fseg = "{0}/seg_{1}_{2}.dat".format(fnb_fit,trk_name,ntrk)
+        fitNames = open(ffit).readline().lstrip("#").split()
+        segNames = open(fseg).readline().lstrip("#").split()
+        fittbl = np.loadtxt(ffit,ndmin=2)
+        segtbl = np.loadtxt(fseg,ndmin=2)
+        if writer is None:
+            writer = KFitStoreWriter(fname,smooth="chi2s" in fitNames,mode="w")
+        fit = dict((name,fittbl[:,i]) for i,name in enumerate(fitNames))
+        seg = dict((name,segtbl[:,i]) for i,name in enumerate(segNames))
+        rows.append((ntrk,{"fit":fit,"seg":seg}))
+        if len(rows) == chunkSize:
+            writer.WriteChunk(ChunkFromRows(rows)); rows = []
+    if writer is not None:
+        writer.WriteChunk(ChunkFromRows(rows))
+        writer.Close()
+
+
+def testKFitStore():
+    """
+    Writes a text run and converts it; appends a refit and a cut chunk
+    """
+    import tempfile, shutil
+    tdir = tempfile.mkdtemp()
+    header = "# segID k x0 y0 z0 p1p p2p p3p p4p chi2p p1f p2f p3f p4f chi2f cfxy cftxy\n"
+    tables = {}
+    for ntrk in range(5):
+        fittbl = np.random.rand(3+ntrk,17)
+        fittbl[:,0] = np.arange(3+ntrk)/2; fittbl[:,1] = np.arange(3+ntrk)
+        segtbl = np.random.rand(2,5); segtbl[:,:2] = [[0,2],[1,1+ntrk]]
+        np.savetxt("{0}/fit_t_{1}.dat".format(tdir,ntrk),fittbl,header=header[2:-1])
+        np.savetxt("{0}/seg_t_{1}.dat".format(tdir,ntrk),segtbl,
+                   header="segID nPts chi2avg chi2min chi2max")
+        tables[ntrk] = (fittbl,segtbl)
+
+    fname = FitFileName(tdir,"t")
+    ConvertText(tdir,"t",range(5),fname,chunkSize=2)
+    store = KFitStore(fname)
+    assert store.Tracks() == range(5)
+    for ntrk,(fittbl,segtbl) in tables.items():
+        assert np.allclose(store.FitTable(ntrk)[:,:17],fittbl)
+        assert np.all(np.isnan(store.FitTable(ntrk)[:,17]))
+        assert np.allclose(store.SegTable(ntrk),segtbl)
+        assert np.allclose(KFitReader(tdir,"t").FitTable(ntrk)[:,:17],fittbl)
+    assert len(store.Column("k","fit")) == sum(3+ntrk for ntrk in range(5))
+
+    # a refit of track 1 supersedes the first fit; a cut chunk is ignored
+    writer = KFitStoreWriter(fname)
+    fit,seg = store.Track(3)
+    writer.WriteChunk(ChunkFromRows([(1,{"fit":fit,"seg":seg})]))
+    writer.WriteChunk(ChunkFromRows([(7,{"fit":fit,"seg":seg})]))
+    writer.Close()
+    f = open(fname,"r+b"); f.truncate(os.path.getsize(fname)-8); f.close()
+    store = KFitStore(fname)
+    assert store.Tracks() == range(5)
+    assert np.allclose(store.FitTable(1)[:,:17],tables[3][0])
+    assert len(store.Column("k","fit")) == sum(3+ntrk for ntrk in range(5))-(3+1)+(3+3)
+
+    # appending drops the cut chunk
+    writer = KFitStoreWriter(fname)
+    writer.WriteChunk(store.Select([0]))
+    writer.Close()
+    assert KFitStore(fname).Tracks() == range(5)
+    shutil.rmtree(tdir)
+    print "testKFitStore ok"
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # python KFitStore.py <fit directory> <run name> <number of tracks>
+        fnb_fit,trk_name,ntracks = sys.argv[1],sys.argv[2],int(sys.argv[3])
+        ConvertText(fnb_fit,trk_name,range(ntracks),FitFileName(fnb_fit,trk_name))
+    else:
+        testKFitStore()
@@ -0,0 +1,143 @@
+"""
+KJournal.py
+
+Progress journal of a fit run: fit_<run>.kjr, next to the fits. Each line
+records a commit, the tracks (events) whose fits are on disk and the sizes
+of the fit stores of the run (see KFitStore) after them:
+
+    <store size> <store size> ... | <ntrk> <ntrk> ...
+
+A line is appended (and synced) only once the fits it lists are written (the
+stores synced, the fit files renamed into place), so the journal lists only
+complete fits. A resumed run skips them, and cuts the stores back to their
+sizes at the last commit (the fits written after it are fitted again); a
+new run empties them.
+"""
+import os
+
+
+def JournalFileName(fnb_fit,trk_name):
+    """
+    The journal of run trk_name in directory fnb_fit
+    """
+    return "{0}/fit_{1}.kjr".format(fnb_fit,trk_name)
+
+
+class KJournal(object):
+    """
+    Records the commits of a run, and reads those of an earlier run to
+    resume it
+    """
+
+    def __init__(self,fname,resume=False):
+        """
+        Opens the journal fname: a new one, or (resume) the journal of the
+        run to resume, without its last line if it was cut short
+        """
+        self.fname = fname
+        self.done = set()
+        self.offsets = []
+
+        size = 0
+        if resume and os.path.isfile(fname):
+            for line in open(fname,"rb"):
+                if not line.endswith("\n"): break
+                offsets,tracks = line.split("|")
+                self.offsets = [int(offset) for offset in offsets.split()]
+                self.done.update(int(ntrk) for ntrk in tracks.split())
+                size += len(line)
+
+        self.f = open(fname,"r+b" if size > 0 else "wb")
+        self.f.truncate(size)
+        self.f.seek(size)
+
+    def Done(self):
+        """
+        The tracks committed
+        """
+        return self.done
+
+    def Remaining(self,tracks):
+        """
+        The tracks (a list) not committed yet, in order
+        """
+        return [ntrk for ntrk in tracks if ntrk not in self.done]
+
+    def Restore(self,stores):
+        """
+        Cuts the stores (file names, in the order of the commits) back to
+        their sizes at the last commit. A store with no commit (all of them
+        in a new journal) is emptied
+        """
+        for n,fname in enumerate(stores):
+            offset = self.offsets[n] if n < len(self.offsets) else 0
+            if os.path.isfile(fname) and os.path.getsize(fname) > offset:
+                f = open(fname,"r+b")
+                f.truncate(offset)
+                f.close()
+
+    def Commit(self,tracks,stores=()):
+        """
+        Records that the fits of tracks are written: syncs the stores (file
+        names) and appends the line of the commit
+        """
+        offsets = []
+        for fname in stores:
+            fd = os.open(fname,os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
+            offsets.append(os.path.getsize(fname))
+
+        self.f.write("{0} | {1}\n".format(" ".join(str(offset) for offset in offsets),
+                                          " ".join(str(ntrk) for ntrk in tracks)))
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.offsets = offsets
+        self.done.update(tracks)
+
+    def Close(self):
+        self.f.close()
+
+
+def testKJournal():
+    """
+    Commits to a journal and a store, cuts them short and resumes
+    """
+    import tempfile, shutil
+    tdir = tempfile.mkdtemp()
+    fname = JournalFileName(tdir,"t")
+    store = "{0}/fit_t.kfs".format(tdir)
+
+    journal = KJournal(fname)
+    open(store,"wb").write("a"*16)
+    journal.Commit([0,1,2],[store])
+    open(store,"ab").write("b"*8)
+    journal.Commit([3],[store])
+    journal.Close()
+
+    # the run dies writing the fits of 4 and 5, and the journal line
+    open(store,"ab").write("c"*5)
+    open(fname,"ab").write("29 | 4")
+
+    journal = KJournal(fname,resume=True)
+    assert journal.Done() == set([0,1,2,3])
+    assert journal.Remaining(range(6)) == [4,5]
+    journal.Restore([store])
+    assert open(store,"rb").read() == "a"*16+"b"*8
+    journal.Commit([4,5],[store])
+    journal.Close()
+    assert KJournal(fname,resume=True).Done() == set(range(6))
+
+    # a new run starts a new journal and empties the stores
+    journal = KJournal(fname)
+    assert journal.Done() == set()
+    assert os.path.getsize(fname) == 0
+    journal.Restore([store])
+    assert os.path.getsize(store) == 0
+    journal.Close()
+    shutil.rmtree(tdir)
+    print "testKJournal ok"
+
+
+if __name__ == '__main__':
+    testKJournal()
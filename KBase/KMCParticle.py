@@ -5,7 +5,6 @@ JJ, Spring, 2014
 """
 
 from abc import ABCMeta, abstractmethod
-import random
 import numpy as np
 
 class KMCParticle(object):
@@ -17,10 +16,15 @@ class KMCParticle(object):
     JJ, Spring, 2014
     """
 
-    def __init__(self,smearVector,sample=5):
+    def __init__(self,smearVector,sample=5,rng=None):
+        """
+        rng is the random stream used to smear the hits of this particle
+        (see KFBase.Random.stream), by default the global numpy one
+        """
 
         self.smearVector =smearVector
         self.sample = sample
+        self.rng = rng if rng is not None else np.random
 
         self.SmearHits=self.__FillSmearHits()
 
@@ -113,7 +117,7 @@ class KMCParticle(object):
         """
         True hits left by this particle in the detector. The particle trajectory could have been
         affected by MS, Eloss and the effect of B, but there is no detector resolution.
-        hit = np.array(x,y,z,edep)
+        (N,4) array, hit = (x,y,z,edep)
         """
         return 
 
@@ -121,15 +125,13 @@ class KMCParticle(object):
         """
         Smear true hits by errors sigma_x,sigma_y,sigma_z.
         Sample the true hits every sample
+        Returns a (read-only) view of the (N,4) array of smeared hits,
+        reversed if requested
         """
-
-        # Reverse the list of smeared hits.
         if(reverse):
-            rlist = self.SmearHits;
-            rlist.reverse();
-            return rlist;
+            return self.SmearHits[::-1]
         else:
-            return self.SmearHits;
+            return self.SmearHits[:]
 
     # @abstractmethod 
     # def DrawHits(self, draw='2D',view='True'):
@@ -141,48 +143,40 @@ class KMCParticle(object):
 
     def __FillSmearHits(self):
         """
-        Fills the smeared hits in an array
+        Fills the smeared hits in an (N,4) array (one normal draw per
+        coordinate of every hit, hit after hit)
         """
 
         SHits=self.__SampleHits()
-        SmearHits=[]
-
-        for hit in SHits:
-            x = random.gauss(hit[0],self.smearVector[0])
-            y = random.gauss(hit[1],self.smearVector[1])
-            z = random.gauss(hit[2],self.smearVector[2])
-            smhit = np.array([x,y,z,hit[3]])
-            SmearHits.append(smhit)
+        SmearHits = SHits.copy()
+        SmearHits[:,0:3] = self.rng.normal(SHits[:,0:3],self.smearVector[0:3])
+        SmearHits.flags.writeable = False
 
         return SmearHits
 
 
     def __SampleHits(self):
         """
-        Sample the true hits according to sample
-        """
-
-        SHits=[]       
-        nhit = 0
-        edep=0
-        Hits =self.TrueHits()
-        n_trueHits = len(Hits)
-        
-        for i in range(0,n_trueHits):
-            hit = Hits[i]
-            
-            if i==0:
-                SHits.append(hit)
-
-            elif nhit==self.sample:
-                edep+=hit[3]
-                nhit =np.array([hit[0],hit[1],hit[2],edep])
-                SHits.append(nhit)
-                nhit=0
-                edep = 0
-            else:
-                nhit+=1
-                edep+=hit[3]
+        Sample the true hits according to sample: the first hit, then one
+        hit per group of sample+1 hits, at the position of the last hit of
+        the group and with the energy of the whole group (an incomplete last
+        group is dropped). Returns an (N,4) array
+        """
+
+        Hits = np.asarray(self.TrueHits(),dtype=float).reshape(-1,4)
+        if len(Hits) == 0:
+            return Hits
+
+        ngroup = int(self.sample)+1
+        groups = Hits[1:1+ngroup*((len(Hits)-1)/ngroup)].reshape(-1,ngroup,4)
+
+        SHits = np.empty((len(groups)+1,4))
+        SHits[0] = Hits[0]
+        SHits[1:,0:3] = groups[:,-1,0:3]
+        # (the energies of a group are added in order, as they are deposited)
+        SHits[1:,3] = 0.
+        for i in range(ngroup):
+            SHits[1:,3] += groups[:,i,3]
 
         return SHits        
 
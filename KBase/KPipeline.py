@@ -0,0 +1,425 @@
+"""
+KPipeline.py
+
+Streaming pipeline: the items (events, batches of tracks) go from a source
+through a list of stages (read, fit, ...) to a sink (the writer), which runs
+in the calling thread. The stages are connected by bounded queues, so a slow
+stage holds the stages before it back (backpressure) and the number of items
+in flight, and the memory, stays bounded whatever the number of items.
+
+Each stage runs its function on one item at a time in its own workers,
+threads or processes. A process stage needs picklable items and results, and
+cannot be started from a daemonic process (a worker of a Pool): its workers
+are then threads.
+
+The pipeline reports, per stage, the items processed, the throughput, the
+fraction of the time its workers were busy and the depth of its input queue.
+
+    pipeline = KPipeline([KStage("read",Read),KStage("fit",Fit,workers=4,process=True)])
+    pipeline.Run(events,Write)
+    print pipeline.Report()
+"""
+import sys
+import os
+import time
+import traceback
+import threading
+import multiprocessing
+import multiprocessing.queues
+import Queue
+
+from KLog import *
+#create logger
+lgx =logging.getLogger("KPipeline")
+lgx.setLevel(logging.INFO)
+lgx.addHandler(ch)
+
+# Marks the end of the items in a queue (one per worker of the next stage)
+STOP = "KPipeline.STOP"
+
+
+class KPipelineError(RuntimeError):
+    """
+    Raised by KPipeline.Run when a stage fails on an item (the message ends
+    with the traceback of the failure in the stage), when a worker process
+    dies, or when items are lost
+    """
+    pass
+
+
+class KFailure(object):
+    """
+    Takes the place of an item on which a stage failed, to the sink
+    """
+
+    def __init__(self,stage,seq,trace):
+        self.stage = stage
+        self.seq = seq
+        self.trace = trace
+
+
+class KStage(object):
+    """
+    A stage of a pipeline: function (item -> result) run by workers threads,
+    or processes (process)
+    """
+
+    def __init__(self,name,function,workers=1,process=False):
+        self.name = name
+        self.function = function
+        self.workers = max(1,workers)
+        self.process = process
+
+
+def _Get(queue,stop):
+    """
+    Gets from queue, waiting until there is an item or stop is set (None)
+    """
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=0.1)
+        except Queue.Empty:
+            pass
+    return None
+
+
+def _Put(queue,msg,stop):
+    """
+    Puts msg in queue, waiting until there is room or stop is set (False)
+    """
+    while not stop.is_set():
+        try:
+            queue.put(msg,timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def _Relay(inq,outq,stop):
+    """
+    Moves the messages of inq to outq until a STOP (or until stop is set)
+    """
+    while True:
+        msg = _Get(inq,stop)
+        if msg is None or not _Put(outq,msg,stop) or msg == STOP: break
+
+
+def _Drain(queue):
+    """
+    Reads queue until it stays empty
+    """
+    while True:
+        try:
+            queue.get(timeout=0.1)
+        except Queue.Empty:
+            return
+
+
+def _Work(stage,inq,outq,stop):
+    """
+    A worker of stage: runs stage.function on the items of inq, and puts
+    the results (or the failures) in outq, with the time it took appended to
+    the times of the item
+    """
+    while True:
+        msg = _Get(inq,stop)
+        if msg is None or msg == STOP: break
+        seq,item,times = msg
+        if not isinstance(item,KFailure):
+            t0 = time.time()
+            try:
+                item = stage.function(item)
+            except Exception:
+                item = KFailure(stage.name,seq,traceback.format_exc())
+            times = times+[time.time()-t0]
+        if not _Put(outq,(seq,item,times),stop): break
+
+    # (a stopped process must not wait for the queue to be read to exit)
+    if stop.is_set() and stage.process:
+        outq.cancel_join_thread()
+
+
+class KPipeline(object):
+    """
+    Runs a source of items through stages to a sink
+    """
+
+    def __init__(self,stages,queueSize=4,ordered=True):
+        """
+        stages: list of KStage
+        queueSize: size of the queue in front of each stage and of the sink
+        ordered: the sink gets the results in the order of the source (else
+        as they are done)
+        """
+        self.stages = stages
+        self.queueSize = queueSize
+        self.ordered = ordered
+
+        # a process stage started from a daemonic process runs in threads
+        if multiprocessing.current_process().daemon:
+            for stage in stages:
+                if stage.process:
+                    lgx.debug("-- Stage {0}: threads (in a daemonic process)".format(stage.name))
+                    stage.process = False
+
+        self.stats = None
+
+    def Run(self,items,sink):
+        """
+        Runs the items (an iterable, read as the pipeline takes them) through
+        the stages and calls sink on each result. Returns the number of items.
+        Raises KPipelineError if a stage fails on an item (the sink gets the
+        results of the items before it, if ordered), if a worker process
+        dies or if an item does not get to the sink
+        """
+        stages = self.stages
+        nstages = len(stages)
+        process = any(stage.process for stage in stages)
+        stop = multiprocessing.Event() if process else threading.Event()
+
+        # queues[i] is in front of stage i, queues[nstages] of the sink
+        queues = []
+        for i in range(nstages+1):
+            if (i > 0 and stages[i-1].process) or (i < nstages and stages[i].process):
+                queues.append(multiprocessing.Queue(self.queueSize))
+            else:
+                queues.append(Queue.Queue(self.queueSize))
+
+        # the items in flight (also those waiting in order for the sink)
+        self.inflight = 0
+        self.slots = threading.Condition()
+        maxInflight = self.queueSize*(nstages+1)+sum(stage.workers for stage in stages)
+
+        self.stats = [{"name":stage.name,"workers":stage.workers,"items":0,"busy":0.,
+                       "depth":0,"maxDepth":0} for stage in stages]
+        self.stats.append({"name":"sink","workers":1,"items":0,"busy":0.,"depth":0,"maxDepth":0})
+        self.nsamples = 0
+        self.nfed = None
+        self.failure = None
+        t0 = time.time()
+
+        threads = [threading.Thread(target=self.__Feed,args=(items,queues[0],maxInflight,stop))]
+        # the sink reads the results of processes through a thread: a process
+        #  that dies while writing a result leaves its queue unreadable
+        relays = []
+        sinkq = queues[-1]
+        if isinstance(sinkq,multiprocessing.queues.Queue):
+            sinkq = Queue.Queue(self.queueSize)
+            relays.append(threading.Thread(target=_Relay,args=(queues[-1],sinkq,stop)))
+        workers = []
+        for i,stage in enumerate(stages):
+            if stage.process:
+                ws = [multiprocessing.Process(target=_Work,args=(stage,queues[i],queues[i+1],stop))
+                      for w in range(stage.workers)]
+            else:
+                ws = [threading.Thread(target=_Work,args=(stage,queues[i],queues[i+1],stop))
+                      for w in range(stage.workers)]
+            workers.append(ws)
+            nnext = stages[i+1].workers if i+1 < nstages else 1
+            threads.append(threading.Thread(target=self.__Close,args=(stage,ws,queues[i+1],nnext,stop)))
+        for w in sum(workers,[])+threads+relays:
+            w.daemon = True
+            w.start()
+
+        try:
+            nitems = self.__Sink(queues,sinkq,sink)
+        except:
+            stop.set()
+            self.__Join(threads,workers)
+            # the items left in the queues of the processes are dropped (the
+            #  queues written by a process that died may not be readable)
+            for r in relays:
+                r.join(1.)
+            for i,queue in enumerate(queues):
+                if not isinstance(queue,multiprocessing.queues.Queue): continue
+                if i == 0 or not stages[i-1].process:
+                    _Drain(queue); queue.close(); _Drain(queue)
+                    queue.join_thread()
+                else:
+                    queue.cancel_join_thread()
+            raise
+        finally:
+            self.wall = time.time()-t0
+
+        self.__Join(threads+relays,workers)
+        return nitems
+
+    def __Feed(self,items,queue,maxInflight,stop):
+        """
+        Puts the items in the queue of the first stage, with their sequence
+        number, and the stops of its workers
+        """
+        seq = 0
+        try:
+            for item in items:
+                self.slots.acquire()
+                while self.inflight >= maxInflight and not stop.is_set():
+                    self.slots.wait(0.1)
+                self.inflight += 1
+                self.slots.release()
+                if not _Put(queue,(seq,item,[]),stop): return
+                seq += 1
+        except Exception:
+            # (a failing source fails the next item)
+            _Put(queue,(seq,KFailure("source",seq,traceback.format_exc()),[]),stop)
+        self.nfed = seq
+        for w in range(self.stages[0].workers if self.stages else 1):
+            if not _Put(queue,STOP,stop): return
+
+    def __Close(self,stage,workers,queue,nnext,stop):
+        """
+        Puts the stops of the nnext workers of the next stage in its queue
+        when the workers of a stage are done. A worker process that dies
+        (exit code not 0) fails the pipeline (self.failure) at once
+        """
+        alive = list(workers)
+        while alive:
+            alive[0].join(0.1)
+            for w in [w for w in alive if not w.is_alive()]:
+                alive.remove(w)
+                if getattr(w,"exitcode",0) and self.failure is None:
+                    self.failure = "worker {0} of stage {1} exited with code {2}".format(
+                        w.name,stage.name,w.exitcode)
+        if self.failure is not None: return
+        for n in range(nnext):
+            if not _Put(queue,STOP,stop): return
+
+    def __Join(self,threads,workers):
+        for w in sum(workers,[])+threads:
+            w.join()
+
+    def __Sink(self,queues,sinkq,sink):
+        """
+        Calls sink on the results of sinkq (in order if self.ordered) as they
+        arrive. Raises KPipelineError if a worker dies or an item is lost
+        """
+        pending = {}
+        nextSeq = 0
+        while True:
+            if self.failure is not None:
+                raise KPipelineError(self.failure)
+            try:
+                msg = sinkq.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if msg == STOP: break
+            self.__Sample(queues)
+            seq,result,times = msg
+            pending[seq] = (result,times)
+            if not self.ordered: nextSeq = seq
+            while nextSeq in pending:
+                result,times = pending.pop(nextSeq)
+                if isinstance(result,KFailure):
+                    raise KPipelineError("stage {0} failed on item {1}:\n{2}".format(
+                        result.stage,result.seq,result.trace.rstrip()))
+                t0 = time.time()
+                sink(result)
+                times = times+[time.time()-t0]
+                for stat,busy in zip(self.stats,times):
+                    stat["items"] += 1
+                    stat["busy"] += busy
+                nextSeq += 1
+                self.slots.acquire()
+                self.inflight -= 1
+                self.slots.notify()
+                self.slots.release()
+        if pending or self.stats[-1]["items"] != self.nfed:
+            raise KPipelineError("{0} of {1} items did not get to the sink".format(
+                self.nfed-self.stats[-1]["items"],self.nfed))
+        return self.stats[-1]["items"]
+
+    def __Sample(self,queues):
+        """
+        Samples the depth of the queues (each time a result arrives)
+        """
+        self.nsamples += 1
+        for stat,queue in zip(self.stats,queues):
+            try:
+                depth = queue.qsize()
+            except NotImplementedError:
+                depth = 0
+            stat["depth"] += depth
+            stat["maxDepth"] = max(stat["maxDepth"],depth)
+
+    def Stats(self):
+        """
+        Per stage (and sink) of the last run: name, workers, items, busy
+        (seconds, summed over the workers), rate (items per second of the
+        run), use (fraction of the time its workers were busy), depth and
+        maxDepth (mean and maximum depth of its input queue)
+        """
+        stats = []
+        for stat in self.stats:
+            stat = dict(stat)
+            stat["rate"] = stat["items"]/self.wall if self.wall > 0 else 0.
+            stat["use"] = stat["busy"]/(self.wall*stat["workers"]) if self.wall > 0 else 0.
+            stat["depth"] = stat["depth"]/float(max(1,self.nsamples))
+            stats.append(stat)
+        return stats
+
+    def Report(self):
+        """
+        The stats of the last run, one line per stage
+        """
+        s = "-- Pipeline: {0} items in {1:.2f} s".format(self.stats[-1]["items"],self.wall)
+        for stat in self.Stats():
+            s += "\n   {name:>8}: {workers} workers, {items} items, {rate:.1f} items/s,"
+            s = s.format(**stat)
+            s += " busy {0:.0%}, queue {1:.1f} (max {2})".format(stat["use"],stat["depth"],
+                                                                 stat["maxDepth"])
+        return s
+
+
+def Square(x):
+    time.sleep(0.001)
+    return x*x
+
+def Fail(x):
+    if x == 7: raise ValueError("item 7")
+    return x
+
+def Exit(x):
+    if x == 3: os._exit(1)
+    return x
+
+def testKPipeline():
+    """
+    Runs items through thread and process stages, in and out of order, and
+    checks that a failing item or worker stops the pipeline
+    """
+    for process in (False,True):
+        results = []
+        pipeline = KPipeline([KStage("square",Square,workers=3,process=process),
+                              KStage("neg",lambda x: -x)],queueSize=2)
+        assert pipeline.Run(xrange(50),results.append) == 50
+        assert results == [-x*x for x in range(50)]
+
+        results = []
+        pipeline = KPipeline([KStage("square",Square,workers=3,process=process)],ordered=False)
+        pipeline.Run(xrange(50),results.append)
+        assert sorted(results) == [x*x for x in range(50)]
+
+        results = []
+        pipeline = KPipeline([KStage("fail",Fail,workers=2,process=process)],queueSize=1)
+        try:
+            pipeline.Run(xrange(100),results.append)
+            assert False
+        except KPipelineError as error:
+            assert str(error).endswith("ValueError: item 7")
+        assert results == range(7)
+
+    # a worker process that dies fails the pipeline (its items are lost)
+    for nitems in (10,100):
+        results = []
+        try:
+            KPipeline([KStage("exit",Exit,workers=2,process=True)]).Run(xrange(nitems),results.append)
+            assert False
+        except KPipelineError as error:
+            assert "exited with code 1" in str(error)
+    print pipeline.Report()
+    print "testKPipeline ok"
+
+
+if __name__ == '__main__':
+    testKPipeline()
@@ -0,0 +1,269 @@
+"""
+KStore.py
+
+Columnar binary store of per-track (or per-event) tables: one file for a
+whole run, written in chunks of tracks and read memory-mapped.
+
+File layout (all numbers little-endian, 8 bytes):
+    "KSTORE01", header length, JSON header (the tables and the names and
+        types of their columns), padded to 8 bytes. A column holds numbers
+        ("<f8", "<i8") or fixed-shape rows of numbers ("(4,)<f8")
+    chunks, each one:
+        "KCHUNK01", ntracks, number of rows of each table
+        track ids [ntracks]
+        row offsets of each table [ntracks+1 each]
+        columns of each table, one after the other [nrows (x row shape) each]
+
+Chunks are appended as the tracks are produced. The reader memory-maps the
+file: the columns of a track are views of the file, not copies. A track
+written again supersedes the earlier one, and a chunk cut short (a run that
+died while writing) is ignored, and dropped when the store is appended to.
+"""
+import sys
+import os
+import json
+import numpy as np
+
+MAGIC = "KSTORE01"
+CHUNK = "KCHUNK01"
+
+
+def Chunk(ids,tables):
+    """
+    Builds a chunk from the track ids and a dictionary {table: (row offsets,
+    {column: values})}. The chunk is a dictionary of arrays (it can be sent
+    between processes) written by KStoreWriter.WriteChunk
+    """
+    return {"ids":np.asarray(ids,dtype="<i8"),
+            "offsets":dict((table,np.asarray(offsets,dtype="<i8"))
+                           for table,(offsets,columns) in tables.items()),
+            "columns":dict((table,columns) for table,(offsets,columns) in tables.items())}
+
+
+def ChunkFromRows(rows):
+    """
+    Builds a chunk from a list of (track id, {table: {column: values}}). A
+    column missing in some tracks is NaN for those tracks
+    """
+    ids = [ntrk for ntrk,tables in rows]
+    names = set()
+    for ntrk,tables in rows: names.update(tables.keys())
+
+    chunk = {}
+    for table in names:
+        tracks = [tables.get(table,{}) for ntrk,tables in rows]
+        nrows = [len(columns.values()[0]) if columns else 0 for columns in tracks]
+        offsets = np.zeros(len(rows)+1,dtype="<i8")
+        offsets[1:] = np.cumsum(nrows)
+        shapes = {}
+        for columns in tracks:
+            for name,column in columns.items():
+                shapes[name] = np.shape(column)[1:]
+        columns = dict((name,np.concatenate(
+            [np.asarray(cols[name],dtype=float).reshape((n,)+shape) if name in cols
+             else np.full((n,)+shape,np.nan) for cols,n in zip(tracks,nrows)]))
+                       for name,shape in shapes.items())
+        chunk[table] = (offsets,columns)
+    return Chunk(ids,chunk)
+
+
+def ReadHeader(fname):
+    """
+    Returns the tables of store fname: a list of (table, [(column, type)])
+    """
+    f = open(fname,"rb")
+    magic = f.read(8)
+    if magic != MAGIC:
+        print "KStore: {0} is not a store".format(fname)
+        sys.exit(-1)
+    nheader = np.fromstring(f.read(8),dtype="<i8")[0]
+    header = json.loads(f.read(nheader))
+    f.close()
+    return [(str(table),[(str(name),str(dtype)) for name,dtype in columns])
+            for table,columns in header["tables"]]
+
+
+def ChunkSize(ntracks,nrows,tables):
+    """
+    Size in bytes of a chunk, including its marker
+    """
+    return (8*(2 + len(tables) + ntracks + len(tables)*(ntracks+1)) +
+            sum(n*np.dtype(dtype).itemsize
+                for n,(table,columns) in zip(nrows,tables) for name,dtype in columns))
+
+
+def Chunks(fname,tables):
+    """
+    Returns the (list of (offset,ntracks,nrows) of the complete chunks of
+    store fname, offset of the end of the last one)
+    """
+    size = os.path.getsize(fname)
+    f = open(fname,"rb")
+    f.seek(8)
+    offset = 16 + np.fromstring(f.read(8),dtype="<i8")[0]
+    nhead = 8*(2+len(tables))
+    chunks = []
+    while offset + nhead <= size:
+        f.seek(offset)
+        if f.read(8) != CHUNK: break
+        counts = np.fromstring(f.read(nhead-8),dtype="<i8")
+        ntracks,nrows = counts[0],counts[1:]
+        nbytes = ChunkSize(ntracks,nrows,tables)
+        if offset + nbytes > size: break
+        chunks.append((offset,ntracks,nrows))
+        offset += nbytes
+    f.close()
+    return chunks,offset
+
+
+class KStoreWriter(object):
+    """
+    Writes chunks of tracks to a store
+    """
+
+    def __init__(self,fname,tables,mode="a"):
+        """
+        Opens the store fname to append chunks ("a") or to write a new
+        store ("w") with tables, a list of (table, [(column, type)]). An
+        existing store keeps its tables
+        """
+        self.fname = fname
+        if mode == "a" and os.path.isfile(fname) and os.path.getsize(fname) > 0:
+            self.tables = ReadHeader(fname)
+            self.f = open(fname,"r+b")
+            self.f.seek(Chunks(fname,self.tables)[1])
+            self.f.truncate()
+        elif mode in ("a","w"):
+            self.tables = tables
+            self.f = open(fname,"wb")
+            header = json.dumps({"tables":self.tables})
+            header += " "*(-len(header) % 8)
+            self.f.write(MAGIC)
+            self.f.write(np.array([len(header)],dtype="<i8").tostring())
+            self.f.write(header)
+        else:
+            print "KStoreWriter: unknown mode {0}".format(mode)
+            sys.exit(-1)
+
+    def WriteChunk(self,chunk):
+        """
+        Writes a chunk (see Chunk). Missing columns are NaN
+        """
+        ntracks = len(chunk["ids"])
+        if ntracks == 0: return
+        offsets = [chunk["offsets"].get(table,np.zeros(ntracks+1,dtype="<i8"))
+                   for table,columns in self.tables]
+        nrows = [off[-1] for off in offsets]
+
+        data = [np.array([ntracks]+nrows,dtype="<i8"),chunk["ids"].astype("<i8")]
+        data += [off.astype("<i8") for off in offsets]
+        for (table,columns),n in zip(self.tables,nrows):
+            for name,dtype in columns:
+                dtype = np.dtype(dtype)
+                column = chunk["columns"].get(table,{}).get(name)
+                if column is None or np.shape(column) != (n,)+dtype.shape:
+                    column = np.full((n,)+dtype.shape,np.nan)
+                data.append(np.asarray(column).astype(dtype.base))
+
+        self.f.write(CHUNK)
+        for array in data:
+            self.f.write(array.tostring())
+        self.f.flush()
+
+    def Close(self):
+        self.f.close()
+
+
+class KStore(object):
+    """
+    Reads a store (memory-mapped)
+    """
+
+    def __init__(self,fname):
+        """
+        Maps store fname and indexes its tracks
+        """
+        self.fname = fname
+        self.tables = ReadHeader(fname)
+        self.map = np.memmap(fname,dtype=np.uint8,mode="r")
+
+        self.chunks = []
+        self.index = {}
+        for offset,ntracks,nrows in Chunks(fname,self.tables)[0]:
+            pos = [offset+8*(2+len(self.tables))]
+            def take(n,dtype):
+                dtype = np.dtype(dtype)
+                nbytes = n*dtype.itemsize
+                array = self.map[pos[0]:pos[0]+nbytes].view(dtype.base).reshape((n,)+dtype.shape)
+                pos[0] += nbytes
+                return array
+            ids = take(ntracks,"<i8")
+            offsets = dict((table,take(ntracks+1,"<i8")) for table,columns in self.tables)
+            data = {}
+            for (table,columns),n in zip(self.tables,nrows):
+                data[table] = dict((name,take(n,dtype)) for name,dtype in columns)
+            self.chunks.append((ids,offsets,data))
+            for i,ntrk in enumerate(ids):
+                self.index[int(ntrk)] = (len(self.chunks)-1,i)
+
+    def Tracks(self):
+        """
+        The ids of the tracks in the store
+        """
+        return sorted(self.index)
+
+    def __contains__(self,ntrk):
+        return ntrk in self.index
+
+    def Columns(self,table):
+        """
+        The (column, type) of a table
+        """
+        return dict(self.tables)[table]
+
+    def Table(self,ntrk,table):
+        """
+        The columns of a table of track ntrk (dictionary of views)
+        """
+        if ntrk not in self.index:
+            print "KStore: track {0} not in {1}".format(ntrk,self.fname)
+            sys.exit(-1)
+        c,i = self.index[ntrk]
+        ids,offsets,data = self.chunks[c]
+        r0,r1 = offsets[table][i],offsets[table][i+1]
+        return dict((name,column[r0:r1]) for name,column in data[table].items())
+
+    def Array(self,ntrk,table):
+        """
+        The table of track ntrk as a 2D float array (rows, columns in order;
+        a column of shape (k,) rows takes k columns)
+        """
+        columns = self.Table(ntrk,table)
+        return np.column_stack([columns[name] for name,dtype in self.Columns(table)]).astype(float)
+
+    def Column(self,name,table):
+        """
+        A column of a table, over the (last written) tables of all the
+        tracks, in the order in which they were written
+        """
+        columns = []
+        for c,(ids,offsets,data) in enumerate(self.chunks):
+            column = data[table][name]
+            live = [i for i,ntrk in enumerate(ids) if self.index[int(ntrk)] == (c,i)]
+            if len(live) == len(ids):
+                columns.append(column)
+            else:
+                columns += [column[offsets[table][i]:offsets[table][i+1]] for i in live]
+        if len(columns) == 1: return columns[0]
+        if len(columns) == 0:
+            dtype = np.dtype(dict(self.Columns(table))[name])
+            return np.zeros((0,)+dtype.shape,dtype=dtype.base)
+        return np.concatenate(columns)
+
+    def Select(self,tracks):
+        """
+        A chunk with the (last written) tables of the listed tracks
+        """
+        return ChunkFromRows([(ntrk,dict((table,self.Table(ntrk,table))
+                                         for table,columns in self.tables))
+                              for ntrk in tracks])
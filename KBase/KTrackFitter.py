@@ -19,6 +19,7 @@ from KFSetup import KFSetup
 from KFSystem import KFSystem
 from KalmanFilter import KalmanFilter
 from KTrackSegment import KTrackSegment
+from KFArrayFilter import KFArrayFilter, KFTrackArrays
 from KMCParticle import KMCParticle
 
 from math import *
@@ -48,6 +49,9 @@ class KTrackFitter(object):
         self.chi2lim = chi2Limit
 
         self.L=kp.LrXe/self.Pr  #radiation length
+
+        # initial momentum, before the filter corrects it for eloss
+        self.P0 = getattr(kalmanFilter,'P',kalmanFilter.P0)
         
         #####################
         self.Track = KalmanTrack()
@@ -60,6 +64,17 @@ class KTrackFitter(object):
         # Create an empty list of KTrackSegments.
         self.Segments = []
 
+        # Result of the array engine (FitArrays, FitBatch).
+        self.Result = None
+
+        # Hits, kept to fit the track in the reverse direction
+        # (FitBidirectional) without building the system again.
+        self.Hits = np.array([hit[0:4] for hit in hits],dtype=float)
+        self.HitErrors = hitErrors
+        self.RevSegments = []
+        self.RevTrack = None
+        self.RevResult = None
+
         lgx.info("--> Fitter = {0}, Pressure (bar)= {1} Chi2lim ={2}".format(
             self.KF.FitterName(),self.Pr, self.chi2lim))
     
@@ -147,7 +162,7 @@ class KTrackFitter(object):
         
         for k in range(nnodes):
             
-            lgx.debug("--> Processing state {0}".format(k))
+            if trc.on: trc.debug("--> Processing state {0}",k)
             
             x0 = kFilter.GetNodes()[k].Measurement.V[0]
             y0 = kFilter.GetNodes()[k].Measurement.V[1]
@@ -262,3 +277,177 @@ class KTrackFitter(object):
         
         # Return the list of hits now composed of fit states.
         return fHits;
+
+    def __KalmanState(self,V,C):
+        """
+        KalmanMeasurement from a state vector V (4) and a covariance C (4,4)
+        """
+        return KalmanMeasurement( Array.Vector( *V ),
+                                  Array.Matrix( *[ list(C[i]) for i in range(4) ] ) )
+
+    def FitArrays(self):
+        """
+        Perform the fit with the array engine (KFArrayFilter): same
+        segments, track and hits as Fit() but with the nodes in arrays
+        """
+        akf = KFArrayFilter(self.KF.FitterName(),P0=self.P0,
+            update=self.KF.GetUpdateMode())
+        res = akf.Fit(self.TrackArrays())
+        return self.SetResult(res)
+
+    def TrackArrays(self):
+        """
+        The nodes of the system as a KFTrackArrays
+        """
+        return KFTrackArrays.FromSystem(self.KF.GetSystem())
+
+    def ReverseTrackArrays(self):
+        """
+        The nodes of the track traversed in the reverse direction, as a
+        KFTrackArrays (the nodes built from the hits in reverse order)
+        """
+        return KFTrackArrays.FromHits(self.Hits[::-1],self.HitErrors,self.L)
+
+    def FitBidirectional(self):
+        """
+        Fits the track in the forward and in the reverse direction in one
+        pass of the array engine (both directions are fitted in lockstep).
+        The forward fit is set as in FitArrays (Segments, Track, Result),
+        the reverse one in RevSegments, RevTrack and RevResult.
+        Returns the lists of forward and reverse fitted hits
+        """
+        akf = KFArrayFilter(self.KF.FitterName(),
+            update=self.KF.GetUpdateMode())
+        res,rres = akf.FitBatch([self.TrackArrays(),self.ReverseTrackArrays()],
+            P0=[self.P0,self.P0])
+        return self.SetResult(res),self.SetReverseResult(rres)
+
+    def SetResult(self,res):
+        """
+        Fills the segments and the track from a KFArrayResult and
+        returns the list of fitted hits
+        """
+        self.Result = res
+        return self.__FillResult(res,self.Track,self.Segments)
+
+    def SetReverseResult(self,rres):
+        """
+        Fills the reverse segments and track from the KFArrayResult of
+        the reverse fit and returns the list of fitted hits
+        """
+        self.RevResult = rres
+        self.RevSegments = []
+        self.RevTrack = KalmanTrack()
+        sxk,syk = self.HitErrors[0],self.HitErrors[1]
+        for i,hit in enumerate(self.Hits[:0:-1]):
+            ghit = KalmanMeasurement( Array.Vector( hit[0], hit[1], hit[2], hit[3] ), Array.Matrix( [sxk**2,0.], [0.,syk**2] ) )
+            self.RevTrack.AddNode( KalmanNode(step = i, hit = ghit) )
+        return self.__FillResult(rres,self.RevTrack,self.RevSegments)
+
+    def __FillResult(self,res,track,segments):
+        """
+        Fills the segments and the track nodes from a KFArrayResult
+        """
+        CFxy = res.CFxy()
+        CFtxy = res.CFtxy()
+        AP, AF = res.AP, res.AF
+
+        seg = KTrackSegment(0)
+        nseg = 1
+
+        for k in range(len(res)):
+
+            if trc.on: trc.debug("--> Processing state {0}",k)
+
+            if(k == 0):
+                track.GetNode(k).pred_state = self.__KalmanState(AF[0],res.CF[0])
+                track.GetNode(k).filt_state = track.GetNode(k).pred_state
+                seg.AddPoint(0,res.X0[0],res.Y0[0],res.Z0[0],0.,0.,0.,0.,
+                            AF[0,0],AF[0,1],AF[0,2],AF[0,3],CFxy[0],CFtxy[0],
+                            0.,res.Chi2F[0],res.Edep[0])
+                continue;
+
+            chi2f = res.Chi2F[k]
+            track.GetNode(k).pred_state = self.__KalmanState(AP[k],res.CP[k])
+            track.GetNode(k).filt_state = self.__KalmanState(AF[k],res.CF[k])
+            track.GetNode(k).chi2    = chi2f
+            track.GetNode(k).cumchi2 = track.GetNode(k-1).chi2 + chi2f
+
+            if chi2f > self.chi2lim:
+                lgx.debug("\n\n** Chi2 = {0} > {1}; creating new segment \n\n".format(chi2f,
+                    self.chi2lim))
+                segments.append(seg)
+                seg = KTrackSegment(nseg)
+                nseg += 1
+
+            seg.AddPoint(k,res.X0[k],res.Y0[k],res.Z0[k],AP[k,0],AP[k,1],AP[k,2],
+                        AP[k,3],AF[k,0],AF[k,1],AF[k,2],AF[k,3],
+                        CFxy[k],CFtxy[k],res.Chi2P[k],chi2f,res.Edep[k])
+
+        segments.append(seg)
+
+        return list(res.FittedHits()[1:])
+
+    def Smooth(self):
+        """
+        Smooths the fit (after Fit, FitArrays or FitBatch) with the RTS
+        smoother, in one backward pass over the stored predicted and filtered
+        states (the filter is not run again). Sets the smoothed states and chi2
+        in the track nodes and in the segments (replacing those of an earlier
+        call) and returns the list of smoothed hits
+        """
+        if self.Result is not None:
+            res = self.Result.Smooth()
+            AS, CS, chi2s = res.AS, res.CS, res.Chi2S
+        else:
+            self.KF.Smooth()
+            sstates = [stateDict["S"] for stateDict in self.KF.GetStates()]
+            AS = np.array([sstate.V.M[:,0] for sstate in sstates])
+            CS = np.array([sstate.Cov.M for sstate in sstates])
+            chi2s = np.array([sstate.Chi2 for sstate in sstates])
+
+        CSxy = np.sqrt(np.maximum(CS[:,0,0] + CS[:,1,1],0.))
+        CStxy = np.sqrt(np.maximum(CS[:,2,2] + CS[:,3,3],0.))
+
+        for k in range(len(AS)):
+            self.Track.GetNode(k).smooth_state = self.__KalmanState(AS[k],CS[k])
+            self.Track.GetNode(k).smooth_chi2 = chi2s[k]
+
+        for seg in self.Segments:
+            seg.ClearSmoothed()
+            for k in seg.seg_k:
+                seg.AddSmoothedPoint(AS[k,0],AS[k,1],AS[k,2],AS[k,3],
+                    CSxy[k],CStxy[k],chi2s[k])
+
+        nodes = self.KF.GetNodes()
+        sHits = []
+        for k in range(1,len(AS)):
+            zi = nodes[k].ZSlice.Zi
+            z0 = (zi+nodes[k].ZSlice.Zf)/2.
+            sHits.append(np.array([AS[k,0] + z0*AS[k,2],AS[k,1] + z0*AS[k,3],
+                zi,nodes[k].ZSlice.Edep]))
+        return sHits
+
+
+def FitBatch(trackFitters,bidirectional=False):
+    """
+    Fits a list of KTrackFitter in lockstep with the array engine
+    (KFArrayFilter.FitBatch). Each fitter gets its segments and track as
+    with FitArrays(). Returns the list of fitted hits of each fitter.
+    If bidirectional the reverse fits go in the same batch (as with
+    FitBidirectional) and a list of (forward,reverse) hits is returned
+    """
+    if len(trackFitters) == 0: return []
+    akf = KFArrayFilter(trackFitters[0].GetKFName(),
+        update=trackFitters[0].KF.GetUpdateMode())
+    tracks = [tf.TrackArrays() for tf in trackFitters]
+    P0 = [tf.P0 for tf in trackFitters]
+    if bidirectional:
+        tracks += [tf.ReverseTrackArrays() for tf in trackFitters]
+        P0 += P0
+    results = akf.FitBatch(tracks,P0=P0)
+    fHits = [tf.SetResult(res) for tf,res in zip(trackFitters,results)]
+    if not bidirectional: return fHits
+    rHits = [tf.SetReverseResult(res) for tf,res in
+        zip(trackFitters,results[len(trackFitters):])]
+    return zip(fHits,rHits)
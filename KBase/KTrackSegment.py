@@ -36,6 +36,9 @@ class KTrackSegment(object):
         self.seg_pchisq = []; self.seg_fchisq = [];
         self.seg_x0 = []; self.seg_y0 = [];
         self.seg_edep = [];
+        self.seg_p1s = []; self.seg_p2s = []; self.seg_p3s = []; self.seg_p4s = [];
+        self.seg_csxy = []; self.seg_cstxy = [];
+        self.seg_schisq = [];
         
     def AddPoint(self,k,x0,y0,z0,p1p,p2p,p3p,p4p,p1f,p2f,p3f,p4f,cfxy,cftxy,pchisq,fchisq,edep):
         """
@@ -53,6 +56,33 @@ class KTrackSegment(object):
         self.seg_x0.append(x0); self.seg_y0.append(y0);
         self.seg_edep.append(edep);
 
+    def AddSmoothedPoint(self,p1s,p2s,p3s,p4s,csxy,cstxy,schisq):
+        """
+        Add the smoothed state of the next point of the segment
+        (points are smoothed in the same order as they were added).
+        """
+        
+        self.seg_p1s.append(p1s); self.seg_p2s.append(p2s); 
+        self.seg_p3s.append(p3s); self.seg_p4s.append(p4s);
+        self.seg_csxy.append(csxy); self.seg_cstxy.append(cstxy);
+        self.seg_schisq.append(schisq);
+
+    def ClearSmoothed(self):
+        """
+        Removes the smoothed states of the segment (before it is smoothed
+        again).
+        """
+        
+        self.seg_p1s = []; self.seg_p2s = []; self.seg_p3s = []; self.seg_p4s = [];
+        self.seg_csxy = []; self.seg_cstxy = [];
+        self.seg_schisq = [];
+
+    def IsSmoothed(self):
+        """
+        True if all the points of the segment have a smoothed state
+        """
+        return len(self.seg_schisq) == len(self.seg_k)
+
     def NumPoints(self):
         """
         Returns the number of points in the segment.
@@ -97,3 +127,21 @@ class KTrackSegment(object):
         return self.seg_fchisq
 
         
+
+    def SmoothedState(self,i):
+        """
+        Returns the smoothed state in point i of segment
+        """
+        PS=[]
+        PS.append(self.seg_p1s[i])
+        PS.append(self.seg_p2s[i])
+        PS.append(self.seg_p3s[i])
+        PS.append(self.seg_p4s[i])
+
+        return PS
+
+    def SmoothedChi2(self,i):
+        """
+        Returns the chi2 (smoothed)
+        """
+        return self.seg_schisq
@@ -2,6 +2,8 @@
 Define logging parameters
 """
 import logging 
+import sys
+import numpy as np
 from KEnum import Enum
 
 Debug=Enum("DEBUG", mute=1,quiet=2,info=3,verbose=4,draw=5)
@@ -22,3 +24,66 @@ def cond_pause(debug_level):
     """
     if debug_level >= Debug.verbose.value:
         s=raw_input("return to continue")
+
+
+class KTraceMessage(object):
+    """
+    A trace message: a format string and its arguments, formatted
+    only when the logging record is emitted. Matrices (KFMatrix, KFVector,
+    numpy arrays) are written in full.
+    """
+    __slots__ = ('fmt','args')
+
+    def __init__(self,fmt,args):
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        return self.fmt.format(*[KTraceMessage.Full(a) for a in self.args])
+
+    @staticmethod
+    def Full(arg):
+        M = getattr(arg,'M',arg)
+        if isinstance(M,np.ndarray):
+            return np.array2string(M,threshold=sys.maxsize,max_line_width=sys.maxsize)
+        return arg
+
+
+class KTrace(object):
+    """
+    Tracing of the hot paths of a module (the per node code of the
+    filters and the fitter).
+
+    Each module creates its tracer next to its logger, e.g.
+        trc = KTrace(lgx,on=False)
+    and guards its traces with the switch:
+        if trc.on:
+            trc.debug("CF={0}",CF)
+            trc.pause()
+    With the tracer off nothing but the guard runs. With it on, the
+    message is formatted only if the logger accepts the level.
+    A module is switched on with (e.g. for KalmanFilter)
+        KLogKalmanFilter.trc.Switch(True)
+    """
+
+    def __init__(self,logger,on=False,debugLevel=Debug.info.value):
+        self.lgx = logger
+        self.on = on
+        self.debugLevel = debugLevel
+
+    def Switch(self,on=True,debugLevel=None):
+        """
+        Switches the tracer on/off and optionally sets the level
+        used by pause
+        """
+        self.on = on
+        if debugLevel is not None: self.debugLevel = debugLevel
+
+    def debug(self,fmt,*args):
+        self.lgx.debug(KTraceMessage(fmt,args))
+
+    def info(self,fmt,*args):
+        self.lgx.info(KTraceMessage(fmt,args))
+
+    def pause(self):
+        cond_pause(self.debugLevel)
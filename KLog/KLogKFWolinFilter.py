@@ -3,4 +3,6 @@ from KLog import *
 lgx =logging.getLogger("KFWolinFilter")
 lgx.setLevel(logging.INFO)
 lgx.addHandler(ch)
-debug = Debug.info.value
\ No newline at end of file
+debug = Debug.info.value
+#tracer of the per node code: switch on with trc.Switch(True)
+trc = KTrace(lgx,on=False,debugLevel=debug)
@@ -5,3 +5,5 @@ lgx =logging.getLogger("KTrackFitter")
 lgx.setLevel(logging.DEBUG)
 lgx.addHandler(ch)
 debug = Debug.info.value
+#tracer of the per node code: switch on with trc.Switch(True)
+trc = KTrace(lgx,on=False,debugLevel=debug)
@@ -0,0 +1,451 @@
+"""
+KFArrayFilter.py
+
+A KalmanFilter engine equivalent to KFWolinFilter that works on a
+structure-of-arrays representation of the nodes:
+
+    measurements (N,2), zi (N,), zf (N,), edep (N,)
+
+and stores the predicted and filtered states in preallocated
+(N,4) and (N,4,4) arrays. No KFState, KFMatrix or dictionary is created
+per node; all the quantities that do not depend on the state
+(H, H^T G H, momentum after energy loss, sigma2(theta_ms)) are computed
+once for the whole track.
+
+"""
+import sys
+import numpy as np
+from KFSystem import KFSystem
+from KFBase import GainUpdate, RTSSmoother, SmoothedChi2
+from math import *
+
+from KLogKFWolinFilter import *
+
+ME = 0.511 # electron mass in MeV (as in KalmanFilter.Beta/CorrectP)
+
+def inverse(A):
+    """
+    Inverse of A. As KFMatrix.Inverse, if A is singular it warns and
+    returns A unchanged
+    """
+    try:
+        return np.linalg.inv(A)
+    except np.linalg.LinAlgError:
+        print "WARNING: singular matrix, cannot properly invert..."
+        return np.array(A)
+
+def inverses(A):
+    """
+    Inverse of a stack of matrices A (...,n,n), falls back to inverse()
+    matrix by matrix if one of them is singular
+    """
+    try:
+        return np.linalg.inv(A)
+    except np.linalg.LinAlgError:
+        Ai = np.empty_like(A)
+        for i in np.ndindex(A.shape[:-2]): Ai[i] = inverse(A[i])
+        return Ai
+
+def CorrectPArray(P0,edep):
+    """
+    Momentum at each node: P[0] = P0 and P[k] = CorrectP(P[k-1],edep[k]),
+    that is the momentum after the energy deposited in slices 1..k
+    """
+    edep = np.asarray(edep,dtype=float)
+    E0 = sqrt(P0**2+ME**2)
+    E = np.empty(len(edep))
+    E[0] = E0
+    E[1:] = E0 - np.cumsum(edep[1:])
+    dead = np.logical_or.accumulate(E <= ME)
+    dead[0] = False
+    P = np.where(dead,0.,np.sqrt(np.maximum(E**2-ME**2,0.)))
+    P[0] = P0
+    return P
+
+def Sigma2ThetaMsArray(P,L):
+    """
+    sigma2(theta_ms) for arrays of momenta P and lengths L (in radiation length)
+    see KalmanFilter.SigmaThetaMs. Null for P=0 (beta=0) or L=0
+    """
+    P = np.asarray(P,dtype=float)
+    L = np.asarray(L,dtype=float)
+    ok = np.logical_and(P > 0.,L > 0.)
+    Ps = np.where(ok,P,1.)
+    Ls = np.where(ok,L,1.)
+    beta = Ps/np.sqrt(Ps**2+ME**2)
+    tms = (13.6/(Ps*beta))*np.sqrt(Ls)*(1 + 0.038*np.log(Ls))
+    return np.where(ok,tms**2,0.)
+
+def MSCovariance(s2tms,z0,p3,p4,out=None):
+    """
+    The Wolin MS covariance matrix (4,4) at z0 for tangents (p3,p4),
+    as in KFWolinFilter.MultipleScatteringMatrix. The arguments can be
+    arrays of shape (B,), then the result is (B,4,4)
+    """
+    t = 1+p3**2+p4**2
+    p3p3 = s2tms*(1+p3**2)*t
+    p4p4 = s2tms*(1+p4**2)*t
+    p3p4 = s2tms*p3*p4*t
+    z02 = z0*z0
+    if out is None: out = np.empty(np.broadcast(s2tms,z0,p3,p4).shape+(4,4))
+    out[...,0,0] = z02*p3p3; out[...,0,1] = z02*p3p4
+    out[...,0,2] = -z0*p3p3; out[...,0,3] = -z0*p3p4
+    out[...,1,0] = z02*p3p4; out[...,1,1] = z02*p4p4
+    out[...,1,2] = -z0*p3p4; out[...,1,3] = -z0*p4p4
+    out[...,2,0] = -z0*p3p3; out[...,2,1] = -z0*p3p4
+    out[...,2,2] = p3p3; out[...,2,3] = p3p4
+    out[...,3,0] = -z0*p3p4; out[...,3,1] = -z0*p4p4
+    out[...,3,2] = p3p4; out[...,3,3] = p4p4
+    return out
+
+def pad(x,N):
+    """
+    Pads the array x (n,...) to (N,...) repeating its last row
+    """
+    n = len(x)
+    if n == N: return x
+    return np.concatenate((x,np.repeat(x[-1:],N-n,axis=0)))
+
+
+class KFTrackArrays(object):
+    """
+    Structure-of-arrays storage of the nodes of a track:
+        Meas (N,2) measurements (x,y)
+        V (N,2,2) covariance of the measurements
+        Zi, Zf, Edep (N,) slices
+        Lr radiation length
+    """
+
+    def __init__(self,meas,zi,zf,edep,Lr,V):
+        """
+        meas (N,2), zi, zf, edep (N,) and Lr a number.
+        V is the (2,2) covariance of all the measurements or a (N,2,2) array
+        """
+        self.Meas = np.asarray(meas,dtype=float).reshape(-1,2)
+        self.Zi = np.asarray(zi,dtype=float)
+        self.Zf = np.asarray(zf,dtype=float)
+        self.Edep = np.asarray(edep,dtype=float)
+        self.Lr = Lr
+        N = len(self.Zi)
+        V = np.asarray(V,dtype=float)
+        if V.ndim == 2: V = np.tile(V,(N,1,1))
+        self.V = V
+
+        if not (len(self.Meas) == len(self.Zf) == len(self.Edep) == len(self.V) == N):
+            print "KFTrackArrays: inconsistent number of nodes"
+            sys.exit(-1)
+
+    def __len__(self):
+        return len(self.Zi)
+
+    @staticmethod
+    def FromSystem(system):
+        """
+        Extracts the arrays from the nodes of a KFSystem
+        """
+        if isinstance(system, KFSystem) != True:
+            print "error, must be an instance of KFSystem "
+            sys.exit(-1)
+
+        nodes = system.Nodes
+        meas = [(node.Measurement.V[0],node.Measurement.V[1]) for node in nodes]
+        zi = [node.ZSlice.Zi for node in nodes]
+        zf = [node.ZSlice.Zf for node in nodes]
+        edep = [node.ZSlice.Edep for node in nodes]
+        V = np.array([node.Measurement.Cov.M for node in nodes])
+        return KFTrackArrays(meas,zi,zf,edep,nodes[0].ZSlice.Lr,V)
+
+    @staticmethod
+    def FromHits(hits,hitErrors,Lr):
+        """
+        Builds the arrays from a list of hits (x,y,z,edep) as done
+        by KTrackFitter: node k goes from hit k to hit k+1
+        """
+        hits = np.asarray(hits,dtype=float)
+        V = np.diag([hitErrors[0]**2,hitErrors[1]**2])
+        return KFTrackArrays(hits[:-1,0:2],hits[:-1,2],hits[1:,2],hits[:-1,3],Lr,V)
+
+
+class KFArrayResult(object):
+    """
+    Columnar result of a fit:
+        K (N,) node index
+        X0, Y0, Z0, Edep (N,) measurement and z at the middle of the slice
+        AP, AF (N,4) predicted and filtered states
+        CP, CF (N,4,4) predicted and filtered covariances
+        Chi2P, Chi2F (N,) MS part of the chi2 and total chi2 per dof
+        AS, CS, Chi2S smoothed states, covariances and chi2 per dof
+        (None until Smooth is called)
+    Node 0 holds the initial state (predicted = filtered).
+    The fit arrays can be views of the arrays of a batch (see
+    KFArrayFilter.FitBatch)
+    """
+
+    def __init__(self,arrays,AP,CP,AF,CF,Chi2P,Chi2F):
+        N = len(arrays)
+        self.Arrays = arrays
+        self.K = np.arange(N)
+        self.X0 = arrays.Meas[:,0]
+        self.Y0 = arrays.Meas[:,1]
+        self.Z0 = (arrays.Zi + arrays.Zf)/2.
+        self.Edep = arrays.Edep
+        self.AP = AP; self.CP = CP
+        self.AF = AF; self.CF = CF
+        self.Chi2P = Chi2P; self.Chi2F = Chi2F
+        self.AS = None; self.CS = None; self.Chi2S = None
+
+    def __len__(self):
+        return len(self.K)
+
+    def CFxy(self):
+        """
+        sqrt(CF[0,0]+CF[1,1]) per node (0 if not positive)
+        """
+        s = self.CF[:,0,0] + self.CF[:,1,1]
+        return np.sqrt(np.where(s > 0.,s,0.))
+
+    def Smooth(self):
+        """
+        Runs the RTS smoother (F is the identity) backwards over the
+        predicted and filtered arrays and sets AS, CS and Chi2S
+        (the chi2 of the measurement with the smoothed state, per dof)
+        """
+        self.AS,self.CS = RTSSmoother(self.AP,self.CP,self.AF,self.CF)
+        N = len(self)
+        H = np.zeros((N,2,4))
+        H[:,0,0] = 1.; H[:,1,1] = 1.
+        H[:,0,2] = self.Z0; H[:,1,3] = self.Z0
+        self.Chi2S = SmoothedChi2(self.Arrays.Meas,self.Arrays.V,H,
+            self.AS,self.CS)/2.
+        return self
+
+    def CSxy(self):
+        """
+        sqrt(CS[0,0]+CS[1,1]) per node (0 if not positive)
+        """
+        s = self.CS[:,0,0] + self.CS[:,1,1]
+        return np.sqrt(np.where(s > 0.,s,0.))
+
+    def CStxy(self):
+        """
+        sqrt(CS[2,2]+CS[3,3]) per node (0 if not positive)
+        """
+        s = self.CS[:,2,2] + self.CS[:,3,3]
+        return np.sqrt(np.where(s > 0.,s,0.))
+
+    def CFtxy(self):
+        """
+        sqrt(CF[2,2]+CF[3,3]) per node (0 if not positive)
+        """
+        s = self.CF[:,2,2] + self.CF[:,3,3]
+        return np.sqrt(np.where(s > 0.,s,0.))
+
+    def FittedHits(self):
+        """
+        (N,4) hits (x,y,zi,edep) built from the filtered states at the middle
+        of the slices
+        """
+        xh = self.AF[:,0] + self.Z0*self.AF[:,2]
+        yh = self.AF[:,1] + self.Z0*self.AF[:,3]
+        return np.column_stack((xh,yh,self.Arrays.Zi,self.Edep))
+
+
+class KFArrayFilter(object):
+    """
+    A KF filter following Wodin et. al. (as KFWolinFilter) over arrays.
+    A batch of tracks can be fitted in lockstep with FitBatch
+    """
+
+    nfpts = 4 # number of points used to set up the initial direction
+
+    def __init__(self,name,P0=2.913527586963954,update="information"):
+        """
+        inits the engine with a name, the initial momentum and the
+        update mode ("information" or "gain", see KalmanFilter.SetUpdateMode)
+        """
+        self.name = name
+        self.P0 = P0
+        if update not in ("information","gain"):
+            print "error, update mode must be information or gain"
+            sys.exit(-1)
+        self.Update = update
+
+    def FitterName(self):
+        return self.name
+
+    def Tables(self,arrays,P0=None):
+        """
+        State independent quantities per node:
+        z at the middle of the slice, H (N,2,4), G = V^-1 (N,2,2),
+        H^T G (N,4,2), H^T G H (N,4,4), momentum after eloss and
+        sigma2(theta_ms)
+        """
+        if P0 is None: P0 = self.P0
+        N = len(arrays)
+        dz = arrays.Zf - arrays.Zi
+        zmid = arrays.Zi + dz/2.
+        H = np.zeros((N,2,4))
+        H[:,0,0] = 1.; H[:,1,1] = 1.
+        H[:,0,2] = zmid; H[:,1,3] = zmid
+        G = inverses(arrays.V)
+        HT = H.transpose(0,2,1)
+        HTG = np.einsum('nij,njk->nik',HT,G)
+        HTGH = np.einsum('nij,njk->nik',HTG,H)
+        P = CorrectPArray(P0,arrays.Edep)
+        s2tms = Sigma2ThetaMsArray(P,np.abs(dz)/arrays.Lr)
+        return zmid,H,G,HTG,HTGH,P,s2tms
+
+    def InitialState(self,arrays,k=0,P0=None):
+        """
+        Initial state at node k, as KFWolinFilter.SetupFilter: the direction
+        is fitted from nodes k to k+nfpts with momentum P0
+        """
+        if P0 is None: P0 = self.P0
+        kf = min(k+self.nfpts,len(arrays))
+        zs = (arrays.Zi[k:kf] + arrays.Zf[k:kf])/2.
+        dmatrix = np.column_stack((arrays.Meas[k:kf,0],arrays.Meas[k:kf,1],zs))
+        uu, dd, vv = np.linalg.svd(dmatrix - dmatrix[0])
+        ux,uy,uz = vv[0]
+
+        z0 = arrays.Zi[k]
+        L = abs(arrays.Zf[k]-arrays.Zi[k])/arrays.Lr
+        tanX0 = ux/uz; tanY0 = uy/uz
+        a0 = np.array([arrays.Meas[k,0] - z0*tanX0, arrays.Meas[k,1] - z0*tanY0,
+                       tanX0, tanY0])
+        s2tms = float(Sigma2ThetaMsArray(P0,L))
+        C0 = MSCovariance(s2tms,z0,tanX0,tanY0)
+        return a0,C0
+
+    def Fit(self,arrays):
+        """
+        Predicts and filters all the nodes, returns a KFArrayResult
+        """
+        return self.FitBatch([arrays])[0]
+
+    def FitBatch(self,tracks,P0=None):
+        """
+        Fits a list of tracks (KFTrackArrays) in lockstep: the tracks are
+        padded to a common number of nodes N and the predict/filter
+        algebra runs over (B,4) and (B,4,4) arrays, node by node.
+        P0 is an optional list with the initial momentum of each track.
+        Returns a list of KFArrayResult (one per track)
+        """
+        B = len(tracks)
+        if P0 is None: P0 = [self.P0]*B
+        nodes = np.array([len(arrays) for arrays in tracks])
+        if B == 0: return []
+        if nodes.min() < 1:
+            print "KFArrayFilter.FitBatch: tracks must have at least one node"
+            sys.exit(-1)
+        N = nodes.max()
+        mask = np.arange(N)[np.newaxis,:] < nodes[:,np.newaxis] # (B,N)
+
+        meas = np.empty((B,N,2)); zi = np.empty((B,N))
+        H = np.empty((B,N,2,4)); G = np.empty((B,N,2,2)); V = np.empty((B,N,2,2))
+        HTG = np.empty((B,N,4,2)); HTGH = np.empty((B,N,4,4))
+        s2tms = np.empty((B,N))
+        AP = np.zeros((B,N,4)); AF = np.zeros((B,N,4))
+        CP = np.zeros((B,N,4,4)); CF = np.zeros((B,N,4,4))
+        Chi2P = np.zeros((B,N)); Chi2F = np.zeros((B,N))
+
+        for b,arrays in enumerate(tracks):
+            zmid,Hb,Gb,HTGb,HTGHb,Pb,s2b = self.Tables(arrays,P0[b])
+            meas[b] = pad(arrays.Meas,N); zi[b] = pad(arrays.Zi,N)
+            H[b] = pad(Hb,N); G[b] = pad(Gb,N); V[b] = pad(arrays.V,N)
+            HTG[b] = pad(HTGb,N); HTGH[b] = pad(HTGHb,N)
+            s2tms[b] = pad(s2b,N)
+            AP[b,0],CP[b,0] = self.InitialState(arrays,P0=P0[b])
+        AF[:,0] = AP[:,0]; CF[:,0] = CP[:,0]
+        Chi2P[:,0] = 1e+6; Chi2F[:,0] = 1e+6
+
+        Q = np.empty((B,4,4))
+        for k in range(1,N):
+            # predict: F is the identity
+            aF = AF[:,k-1]
+            MSCovariance(s2tms[:,k],zi[:,k],aF[:,2],aF[:,3],out=Q)
+            AP[:,k] = aF
+            np.add(CF[:,k-1],Q,out=CP[:,k])
+
+            # filter
+            if self.Update == "gain":
+                AF[:,k],CF[:,k],chi2meas,chi2ms = GainUpdate(AP[:,k],CP[:,k],
+                    meas[:,k],V[:,k],H[:,k])
+                Chi2F[:,k] = (chi2meas + chi2ms)/2.
+                Chi2P[:,k] = chi2ms/2.
+                continue
+
+            CPI = inverses(CP[:,k])
+            CF[:,k] = inverses(CPI + HTGH[:,k])
+            K = np.einsum('bij,bjk->bik',CF[:,k],HTG[:,k])
+            Hk = H[:,k]
+            r = meas[:,k] - np.einsum('bij,bj->bi',Hk,AP[:,k])
+            AF[:,k] = AP[:,k] + np.einsum('bij,bj->bi',K,r)
+            R = meas[:,k] - np.einsum('bij,bj->bi',Hk,AF[:,k])
+            Rf = AF[:,k] - AP[:,k]
+            chi2meas = np.einsum('bi,bij,bj->b',R,G[:,k],R)
+            chi2ms = np.einsum('bi,bij,bj->b',Rf,CPI,Rf)
+            Chi2F[:,k] = (chi2meas + chi2ms)/2.
+            Chi2P[:,k] = chi2ms/2.
+
+        Chi2P[~mask] = 0.; Chi2F[~mask] = 0.
+        self.Mask = mask
+
+        results = []
+        for b,arrays in enumerate(tracks):
+            n = nodes[b]
+            results.append(KFArrayResult(arrays,AP[b,:n],CP[b,:n],AF[b,:n],
+                CF[b,:n],Chi2P[b,:n],Chi2F[b,:n]))
+
+        lgx.info("KFArrayFilter.FitBatch -> tracks = {0}, nodes = {1}".format(B,N))
+        return results
+
+
+if __name__ == '__main__':
+
+    from KFWolinFilter import KFWolinFilter, Setup
+
+    setup = Setup()
+    system = KFSystem(setup)
+    arrays = KFTrackArrays.FromSystem(system)
+
+    slkf = KFWolinFilter("KFWolin",P0=2.9)
+    slkf.SetSystem(system)
+    slkf.SetInitialState()
+    for k in range(1,len(setup.Nodes)):
+        slkf.Predict(k)
+        slkf.Filter(k)
+
+    akf = KFArrayFilter("KFArray",P0=2.9)
+    res = akf.Fit(arrays)
+
+    print "test property: same fit as KFWolinFilter"
+    c1 = True
+    for k,stateDict in enumerate(slkf.GetStates()):
+        fstate = stateDict["F"]
+        c1 = c1 and np.allclose(np.ravel(fstate.V.M),res.AF[k])
+        c1 = c1 and np.allclose(fstate.Cov.M,res.CF[k])
+        if k > 0: c1 = c1 and np.allclose(fstate.Chi2,res.Chi2F[k])
+    if c1 == True:
+        print "passed"
+    else:
+        print """
+        failed
+        KFWolinFilter = {0}
+        KFArrayFilter = {1}
+        """.format(slkf.GetStates(),res.AF)
+        sys.exit(-1)
+
+    print "test property: a batch gives the same fit as track by track"
+    short = KFTrackArrays(arrays.Meas[:3],arrays.Zi[:3],arrays.Zf[:3],
+        arrays.Edep[:3],arrays.Lr,arrays.V[:3])
+    batch = akf.FitBatch([short,arrays,short])
+    one = akf.Fit(short)
+    c1 = len(batch) == 3 and len(batch[0]) == 3 and len(batch[1]) == len(arrays)
+    c1 = c1 and np.allclose(batch[1].AF,res.AF) and np.allclose(batch[1].CF,res.CF)
+    c1 = c1 and np.allclose(batch[0].AF,one.AF) and np.allclose(batch[2].Chi2F,one.Chi2F)
+    c1 = c1 and not akf.Mask[0,3:].any()
+    if c1 == True:
+        print "passed"
+    else:
+        print "failed"
+        sys.exit(-1)
@@ -3,28 +3,59 @@ Module KFBase defines some basic objects for KF
 """
 import numpy as np
 import sys
-import random
+from collections import OrderedDict
 eps=1e-10
 
+def isnumber(x):
+    """ returns True if x is a scalar number (python or numpy)
+    """
+    return isinstance(x,(int,long,float,np.number))
+
+def operand(other,what):
+    """ returns the numpy array (or the number) behind other,
+    exits if other can not be operated with a KFMatrix/KFVector
+    """
+    if isinstance(other,KFMatrix) == True or isinstance(other,KFVector) == True:
+        return other.M
+    elif isnumber(other) == True:
+        return other
+    print "cannot {0} a KFMatrix/KFVector to type ".format(what),type(other)
+    sys.exit(-1)
+
+def npdot(a,b,out):
+    """ matrix product a.b written in the array out.
+    np.dot can only write in a contiguous array not overlapping a or b,
+    otherwise the product is computed and then copied into out
+    """
+    if (out.flags.c_contiguous and not np.may_share_memory(out,a)
+        and not np.may_share_memory(out,b)):
+        np.dot(a,b,out=out)
+    else:
+        out[...] = np.dot(a,b)
+    return out
+
 class KFMatrix(object):
     """
-    A KF matrix contains a numpy matrix
+    A KF matrix contains a 2D numpy array of floats (M).
+
+    Binary operators (+,-,*) return a new KFMatrix, built on top of the
+    result array without extra copies. The in-place operators (+=,-=,*=)
+    and the methods Add, Sub, Dot with an out= buffer write on existing
+    storage and do not allocate a new KFMatrix.
     """
 
+    __slots__ = ('M',)
+
     def __init__(self,obj):
-            
+
         """
         M is a numpy array containing the coordinates
         """
 
-        if isinstance(obj,list) ==True:
-            self.M = np.matrix(obj)
+        if isinstance(obj,list) ==True or isinstance(obj,np.ndarray) ==True:
+            self.M = np.array(obj,dtype=float,ndmin=2)
         elif isinstance(obj,KFMatrix) ==True or isinstance(obj,KFVector) ==True:
-            i,j = np.shape(obj.M)
-            m=np.zeros(i*j)
-            self.M=m.reshape(i,j)
-            self.M = np.copy(obj.M)
-#            np.copyto(self.M,obj.M)
+            self.M = np.array(obj.M,dtype=float)
         else:
             print """input matrix must be a list with the following format
                     [[a11,a12,a13...],[a21,a22,a23...],[a31,a32,a33...]]
@@ -32,155 +63,185 @@ class KFMatrix(object):
                   """
             sys.exit(-1)
 
+    @classmethod
+    def Wrap(cls,M):
+        """
+        Returns a KFMatrix using the numpy array M as storage (no copy)
+        """
+        m = object.__new__(cls)
+        m.M = M
+        return m
 
     def __eq__(self,other):
-        m= abs(self.M-other.M)
-
-        for i in range(0,np.shape(m)[0]):
-            for j in range(0,np.shape(m)[1]):
-                if m[i,j] > eps:
-                    return False
-        
-        return True
+        if isinstance(other,KFMatrix) != True and isinstance(other,KFVector) != True:
+            return NotImplemented
+        return bool(np.all(abs(self.M-other.M) <= eps))
 
+    def __ne__(self,other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented: return eq
+        return not eq
 
-    def __setitem__(self, (i, j), value): 
+    def __setitem__(self, ij, value):
+        """
+        Allows m[i,j]=value
         """
-        Allows m[i,j]=value 
-        """ 
-        
-        self.M[i,j] = value 
 
-    def __getitem__(self, (i, j)): 
+        self.M[ij] = value
+
+    def __getitem__(self, ij):
+        """
+        Allows return m[i,j]
         """
-        Allows return m[i,j]   
-        """ 
 
-        return self.M[i,j]
+        return self.M[ij]
 
     def size(self):
-        """ returns the size of the matrix       
+        """ returns the size of the matrix
         """
-        return self.M.shape()
-    
-    def __add__(self, other): 
+        return self.M.shape
+
+    def __add__(self, other):
 
         """
         M+x adds x to all elements of M
         M+N adds elements of M and N
         """
+        return KFMatrix.Wrap(self.M + operand(other,"add"))
 
-        
-        if isinstance(other,KFMatrix) == True or isinstance(other,KFVector) == True:
-            m = KFMatrix(self)
-            m.M += other.M
-            return m
-
-        elif isinstance(other,int) ==True or isinstance(other,float) == True: 
-            m = KFMatrix(self)
-            m.M += other
-            return m
-        else:
-            print "cannot add a KFMatrix to type ",type(other)
-            sys.exit(-1) 
-        
-    def __radd__(self, other): 
+    def __radd__(self, other):
 
         """
         x+M
         """
         return self.__add__(other)
 
-    def __sub__(self, other): 
+    def __sub__(self, other):
 
         """
         M+x subtracts x to all elements of M
         M+N subtracts elements of M and N
         """
+        return KFMatrix.Wrap(self.M - operand(other,"subtract"))
 
-        
-        if isinstance(other,KFMatrix) == True or isinstance(other,KFVector) == True:
-            m = KFMatrix(self)
-            m.M -= other.M
-            return m
-
-        elif isinstance(other,int) ==True or isinstance(other,float) == True: 
-            m = KFMatrix(self)
-            m.M -= other
-            return m
-        else:
-            print "cannot add a KFMatrix to type ",type(other)
-            sys.exit(-1) 
-        
-    def __rsub__(self, other): 
+    def __rsub__(self, other):
 
         """
         x-M
         """
-        return self.__sub__(other)
+        return KFMatrix.Wrap(operand(other,"subtract") - self.M)
 
-    def __mul__(self, other): 
+    def __mul__(self, other):
 
         """
         M*Y matrix multiplication if both are matrices
         M*e multiplication of element if e a number
         """
-        
+
         if isinstance(other,KFMatrix) == True:
-            m = KFMatrix(self)
-            m.M = np.dot(self.M,other.M)
-            return m
+            return KFMatrix.Wrap(np.dot(self.M,other.M))
         elif isinstance(other,KFVector) == True:
-            m = KFVector(other)
-            m.M = np.dot(self.M,other.M)
-            return m
-        elif isinstance(other,int) ==True or isinstance(other,float) == True: 
-            m = KFMatrix(self)
-            m.M *= other
-            return m
+            return KFVector.Wrap(np.dot(self.M,other.M))
+        elif isnumber(other) == True:
+            return KFMatrix.Wrap(self.M*other)
         else:
             print "cannot multiply a KFMatrix to type ",type(other)
-            sys.exit(-1) 
+            sys.exit(-1)
 
 
-    def __rmul__(self, other): 
+    def __rmul__(self, other):
 
         """
         M*Y matrix multiplication if both are matrices
         M*e multiplication of element if e a number
         """
 
-        m = KFMatrix(self)
         if isinstance(other,KFMatrix) == True or isinstance(other,KFVector) == True:
-            m.M = np.dot(other.M,self.M)
+            return KFMatrix.Wrap(np.dot(other.M,self.M))
+        elif isnumber(other) == True:
+            return KFMatrix.Wrap(other*self.M)
+        else:
+            print "cannot multiply a KFMatrix to type ",type(other)
+            sys.exit(-1)
+
+    def __iadd__(self, other):
+        """
+        M+=x or M+=N, in place
+        """
+        self.M += operand(other,"add")
+        return self
 
-        elif isinstance(other,int) ==True or isinstance(other,float) == True: 
-            m.M *= other
-            
+    def __isub__(self, other):
+        """
+        M-=x or M-=N, in place
+        """
+        self.M -= operand(other,"subtract")
+        return self
+
+    def __imul__(self, other):
+        """
+        M*=e scales M in place, M*=N stores the product M*N in M
+        """
+        if isinstance(other,KFMatrix) == True:
+            m = np.dot(self.M,other.M)
+            if m.shape == self.M.shape: self.M[...] = m
+            else: self.M = m
+        elif isnumber(other) == True:
+            self.M *= other
         else:
             print "cannot multiply a KFMatrix to type ",type(other)
-            sys.exit(-1) 
+            sys.exit(-1)
+        return self
 
-        return m
+    def Add(self, other, out=None):
+        """
+        M+N (or M+x), written into the KFMatrix out if given
+        """
+        if out is None: return self.__add__(other)
+        np.add(self.M,operand(other,"add"),out=out.M)
+        return out
+
+    def Sub(self, other, out=None):
+        """
+        M-N (or M-x), written into the KFMatrix out if given
+        """
+        if out is None: return self.__sub__(other)
+        np.subtract(self.M,operand(other,"subtract"),out=out.M)
+        return out
+
+    def Dot(self, other, out=None):
+        """
+        Matrix product M*N, written into out (a KFMatrix or KFVector
+        of the right shape) if given
+        """
+        if out is None: return self.__mul__(other)
+        npdot(self.M,other.M,out.M)
+        return out
 
     def Shape(self):
         return np.shape(self.M)
 
     def Transpose(self):
-        m = KFMatrix(self)
-        m.M=self.M.T
-        return m
+        """
+        Returns the transpose. Notice that it shares the storage with M
+        """
+        return KFMatrix.Wrap(self.M.T)
 
     def Determinant(self):
         return np.linalg.det(self.M)
 
-    def Inverse(self):
-        m = KFMatrix(self)
+    def Inverse(self, out=None):
+        """
+        Returns the inverse matrix (written into out if given)
+        """
         try:
-            m.M=np.linalg.inv(self.M)
-        except np.linalg.linalg.LinAlgError:
+            mi = np.linalg.inv(self.M)
+        except np.linalg.LinAlgError:
             print "WARNING: singular matrix, cannot properly invert..."
-        return m
+            mi = np.array(self.M)
+        if out is None: return KFMatrix.Wrap(mi)
+        out.M[...] = mi
+        return out
 
     def __str__(self):
         return self.M.__str__()
@@ -191,21 +252,28 @@ class KFMatrix(object):
 
 class KFVector(object):
     """
-    A KF vector contains a numpy array
+    A KF vector contains a numpy array of floats (M) with shape (n,1).
+    It supports the same in-place operators and out= buffers as KFMatrix
     """
 
+    __slots__ = ('M',)
+
     def __init__(self,obj):
         """
         Takes as an argument a list or another KFVector.
-        Represents the vector as a column 
+        Represents the vector as a column
         """
-        if isinstance(obj,list) ==True:
-            self.M = np.transpose(np.matrix(obj))
-            row,col = np.shape(self.M)
-            if not col == 1:
+        if isinstance(obj,list) ==True or isinstance(obj,np.ndarray) ==True:
+            M = np.array(obj,dtype=float)
+            if M.ndim == 1:
+                M = M.reshape(len(M),1)
+            elif M.ndim == 2 and M.shape[0] == 1:
+                M = M.reshape(M.shape[1],1)
+            if M.ndim != 2 or M.shape[1] != 1:
                 print "A KFVector takes as input a list of number"
                 print "for example: v = KFVector([1,2,3])"
                 sys.exit(-1)
+            self.M = M
 
         elif isinstance(obj,KFVector) ==True or isinstance(obj,KFMatrix) ==True:
             i,j = np.shape(obj.M)
@@ -214,119 +282,145 @@ class KFVector(object):
                 print "Imput was:", obj.__str__()
                 sys.exit(-1)
 
-            m=np.zeros(i*j)
-            self.M=m.reshape(i,j)
-            self.M = np.copy(obj.M)
-#            np.copyto(self.M,obj.M)
-            self.M=self.M.reshape(i*j,1)
-        
+            self.M = np.array(obj.M,dtype=float)
+
         else:
             print """input  must be a list v = KFVector([1,2,3])
                      or another KFVector
                   """
             sys.exit(-1)
 
+    @classmethod
+    def Wrap(cls,M):
+        """
+        Returns a KFVector using the (n,1) numpy array M as storage (no copy)
+        """
+        v = object.__new__(cls)
+        v.M = M
+        return v
 
     def __eq__(self,other):
-        m= abs(self.M-other.M)
+        if isinstance(other,KFMatrix) != True and isinstance(other,KFVector) != True:
+            return NotImplemented
+        return bool(np.all(abs(self.M-other.M) <= eps))
 
-        for i in range(0,np.shape(m)[0]):
-            for j in range(0,np.shape(m)[1]):
-                if m[i,j] > eps:
-                    return False
-        
-        return True
+    def __ne__(self,other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented: return eq
+        return not eq
 
-    def __setitem__(self, i, value): 
+    def __setitem__(self, i, value):
         """
-        Allows m[i]=value 
-        """ 
-        
-        self.M[i,0] = value 
-
-    def __getitem__(self, i): 
+        Allows m[i]=value
         """
-        Allows return m[i]   
-        """ 
 
-        return self.M[i,0]
+        self.M[i,0] = value
 
-    def size(self):
-        """ returns the size of the matrix       
+    def __getitem__(self, i):
+        """
+        Allows return m[i]
         """
-        return self.M.shape()
-
 
-    def __add__(self, other): 
+        return self.M[i,0]
 
+    def __iter__(self):
         """
-        M+x adds x to all elements of M
-        M+N adds elements of M and N
+        Allows x,y = v
         """
+        return iter(self.M[:,0])
 
-        m = KFVector(self)
+    def size(self):
+        """ returns the size of the matrix
+        """
+        return self.M.shape
 
+    def __column(self, other):
+        """
+        checks that other is a column vector (or a number) and returns its array
+        """
         if isinstance(other,KFVector) ==True or isinstance(other,KFMatrix) ==True:
             row,col = np.shape(other.M)
             if not col == 1:
                 print "A KFVector must be a column vector"
                 print "Imput was:", other.__str__()
                 sys.exit(-1)
+            return other.M
+        elif isnumber(other) == True:
+            return other
+        print "cannot add the KFVector to type ",type(other)
+        sys.exit(-1)
 
-            m.M += other.M
-        
-        elif isinstance(other,int) ==True or isinstance(other,float) == True: 
-            m.M += other 
-        else:
-            print "cannot add the KFVector to type ",type(other)
-            sys.exit(-1)
-            
+    def __add__(self, other):
 
-        return m
+        """
+        M+x adds x to all elements of M
+        M+N adds elements of M and N
+        """
+        return KFVector.Wrap(self.M + self.__column(other))
 
-    def __sub__(self, other): 
+    def __sub__(self, other):
 
         """
         M+x subtracts x to all elements of M
         M+N subtracts elements of M and N
         """
+        return KFVector.Wrap(self.M - self.__column(other))
 
-        m = KFVector(self)
+    def __radd__(self, other):
 
-        if isinstance(other,KFVector) ==True or isinstance(other,KFMatrix) ==True:
-            row,col = np.shape(other.M)
-            if not col == 1:
-                print "A KFVector must be a column vector"
-                print "Imput was:", other.__str__()
-                sys.exit(-1)
+        """
+        x+M
+        """
+        return self.__add__(other)
 
-            m.M -= other.M
-        
-        elif isinstance(other,int) ==True or isinstance(other,float) == True: 
-            m.M -= other 
-        else:
-            print "cannot add the KFVector to type ",type(other)
-            sys.exit(-1)
-            
+    def __rsub__(self, other):
 
-        return m
+        """
+        x-M
+        """
+        return KFVector.Wrap(self.__column(other) - self.M)
 
+    def __iadd__(self, other):
+        """
+        v+=x or v+=w, in place
+        """
+        self.M += self.__column(other)
+        return self
 
-    def __radd__(self, other): 
+    def __isub__(self, other):
+        """
+        v-=x or v-=w, in place
+        """
+        self.M -= self.__column(other)
+        return self
 
+    def __imul__(self, other):
         """
-        x+M
+        v*=e, in place
         """
-        return self.__add__(other)
+        if isnumber(other) != True:
+            print "cannot scale a KFVector by type ",type(other)
+            sys.exit(-1)
+        self.M *= other
+        return self
 
-    def __rsub__(self, other): 
+    def Add(self, other, out=None):
+        """
+        v+w (or v+x), written into the KFVector out if given
+        """
+        if out is None: return self.__add__(other)
+        np.add(self.M,self.__column(other),out=out.M)
+        return out
 
+    def Sub(self, other, out=None):
         """
-        x+M
+        v-w (or v-x), written into the KFVector out if given
         """
-        return self.__sub__(other)
+        if out is None: return self.__sub__(other)
+        np.subtract(self.M,self.__column(other),out=out.M)
+        return out
 
-    def __mul__(self, other): 
+    def __mul__(self, other):
 
         """
         product of two KFVectors ---> scalar product (dot)
@@ -335,20 +429,16 @@ class KFVector(object):
         """
 
         if isinstance(other,KFMatrix) == True:
-            m = KFMatrix(self)
-            m.M = np.dot(self.M,other.M)
-            return m
+            return KFMatrix.Wrap(np.dot(self.M,other.M))
         elif isinstance(other,KFVector) == True:
-            return np.dot(np.transpose(other.M),self.M)
-        elif isinstance(other,int) ==True or isinstance(other,float) == True: 
-            m = KFVector(self)
-            m.M*=other
-            return m
+            return float(np.dot(other.M[:,0],self.M[:,0]))
+        elif isnumber(other) == True:
+            return KFVector.Wrap(self.M*other)
         else:
             print "cannot multiply a KFVector to type ",type(other)
-            sys.exit(-1) 
+            sys.exit(-1)
 
-    def __rmul__(self, other): 
+    def __rmul__(self, other):
 
         """
         product of two KFVectors ---> scalar product (dot)
@@ -357,16 +447,11 @@ class KFVector(object):
         """
 
         if isinstance(other,KFMatrix) == True:
-            m = KFVector(self)
-            m.M = other.M * self.M 
-            return m
+            return KFVector.Wrap(np.dot(other.M,self.M))
         elif isinstance(other,KFVector) == True:
-            return np.sum(np.transpose(other.M)*self.M)
-
-        elif isinstance(other,int) ==True or isinstance(other,float) == True: 
-            m = KFVector(self)
-            m.M *= other
-            return m
+            return float(np.dot(other.M[:,0],self.M[:,0]))
+        elif isnumber(other) == True:
+            return KFVector.Wrap(other*self.M)
         else:
             print "cannot multiply a KFVector to type ",type(other)
             sys.exit(-1)
@@ -375,14 +460,15 @@ class KFVector(object):
         return np.shape(self.M)
 
     def Transpose(self):
-        m = KFMatrix(self)
-        m.M=self.M.T
-        return m
+        """
+        Returns the (1,n) transpose. Notice that it shares the storage with M
+        """
+        return KFMatrix.Wrap(self.M.T)
 
     def Length(self):
         return len(self.M)
 
-    
+
     def Mod(self):
         return np.linalg.norm(self.M)
 
@@ -391,8 +477,8 @@ class KFVector(object):
 
     def Unit(self):
         nn = self.Mod()
-        self.M = self.M*(1./nn)
-        return 
+        self.M *= (1./nn)
+        return
 
     def Sum(self):
         return np.sum(self.M)
@@ -694,35 +780,88 @@ class Random:
     """
 
     @staticmethod
-    def cov(SS):
-        """ generates random numbers according with a symmetric matriz (S), 
-        for example cov. matrix
+    def stream(seed,*keys):
+        """ returns an independent random stream (a numpy RandomState) for 
+        the item identified by keys (i.e. a track or event number) of a run 
+        with the given seed. The stream depends only on (seed,keys), so the 
+        items can be generated in any order and in any process.
+        """
+        words = []
+        for key in (seed,)+keys:
+            key = int(key)
+            words += [key & 0xffffffff, (key >> 32) & 0xffffffff]
+        return np.random.RandomState(words)
+
+    @staticmethod
+    def sampler(SS):
+        """ returns the sampler (see MVNormal) of the symmetric matrix SS.
+        The samplers are kept by the content of the matrix (the last
+        SAMPLERS_SIZE used), so a matrix is factorized once
         """
         S = SS
         if (isinstance(SS,KFMatrix)): S = SS.M
-        n,m = S.shape
-        #print ' S ',S
-        try: 
-            #det = np.linalg.det(S)
-            L = np.linalg.cholesky(S)
-        except:
-            #print " Warning Random.cov ",S
-            a = KFVector(n*[0.])
-            #print ' null cov! '
-            #print ' a ',a
-            return a
-        #print ' L ',L
-        #ll = list(np.array(L).reshape(-1,))
-        ll = list(np.array(L))
-        LL = KFMatrix(ll)
-        n,m = S.shape
-        z = map(lambda i: random.gauss(0.,1), range(n))
-        #print ' z ',z
-        z = KFVector(z)
-        a = LL*z
-        #print ' L ',L
-        #print ' a ',a
-        return a
+        S = np.asarray(S,dtype=float)
+        key = (S.shape,S.tostring())
+        sampler = SAMPLERS.pop(key,None)
+        if (sampler is None):
+            sampler = MVNormal(S)
+            if (len(SAMPLERS)>=SAMPLERS_SIZE): SAMPLERS.popitem(last=False)
+        SAMPLERS[key] = sampler
+        return sampler
+
+    @staticmethod
+    def cov(SS,rng=None):
+        """ generates random numbers according with a symmetric matriz (S), 
+        for example cov. matrix. rng is the random stream (see stream), 
+        by default the global numpy one
+        """
+        return Random.sampler(SS).random(rng)
+
+    @staticmethod
+    def covs(SS,n,rng=None):
+        """ generates n random vectors according with a symmetric matrix (S),
+        as a (n,dim) array: the same numbers as n calls to cov
+        """
+        return Random.sampler(SS).randoms(n,rng)
+
+
+class MVNormal(object):
+    """ multivariate normal sampler with a symmetric matrix (S), for example
+    a cov. matrix: S is factorized once, L*LT = S, with Cholesky, or with its
+    eigenvalues if S is only semidefinite (a null eigenvalue is a direction
+    without spread, a negative one is set to zero with a warning)
+    """
+
+    def __init__(self,S):
+        S = np.array(S,dtype=float)
+        self.n = S.shape[0]
+        try:
+            self.L = np.linalg.cholesky(S)
+        except np.linalg.LinAlgError:
+            w,Q = np.linalg.eigh(S)
+            tol = 1e-12*max(1.,np.max(np.abs(w)))
+            if (np.min(w)<-tol):
+                print "WARNING: MVNormal matrix not semidefinite, eigenvalues ",w
+            self.L = Q*np.sqrt(np.clip(w,0.,None))
+
+    def random(self,rng=None):
+        """ returns a random KFVector (rng is the random stream, see
+        Random.stream, by default the global numpy one)
+        """
+        if (rng is None): rng = np.random
+        z = rng.normal(0.,1.,(self.n,1))
+        return KFVector.Wrap(np.dot(self.L,z))
+
+    def randoms(self,n,rng=None):
+        """ returns n random vectors, a (n,dim) array, drawn at once
+        """
+        if (rng is None): rng = np.random
+        z = rng.normal(0.,1.,(n,self.n))
+        return np.dot(z,self.L.T)
+
+# samplers of Random.sampler, by matrix, the last used at the end
+SAMPLERS = OrderedDict()
+SAMPLERS_SIZE = 64
 
 
 def exampleVector():
@@ -968,19 +1107,116 @@ def KFMatrixNull(n,m=-1):
     """ returns a null matrix with n-rows and m-columns
     """
     if (m<0): m=n
-    ns = []
-    for i in range(n):
-        ni = m*[0.]
-        ns.append(ni)
-    mm = KFMatrix(ns)
-    return mm
+    return KFMatrix.Wrap(np.zeros((n,m)))
 
 def KFMatrixUnitary(n):
     """ returns a unitary matrix with dimension n
     """
-    kf = KFMatrixNull(n,n)
-    for i in range(n): kf[i,i]=1.
-    return kf
+    return KFMatrix.Wrap(np.identity(n))
+
+def CholeskyChi2(C,d):
+    """ chi2 = d^T C^-1 d computed with the Cholesky factor of C (C = L L^T,
+    chi2 = |L^-1 d|^2), without inverting C. C (...,n,n) and d (...,n) are
+    numpy arrays, the leading dimensions are a batch. If C is not positive
+    definite the pseudo-inverse is used
+    """
+    try:
+        L = np.linalg.cholesky(C)
+    except np.linalg.LinAlgError:
+        y = np.matmul(np.linalg.pinv(C),d[...,np.newaxis])[...,0]
+        return np.einsum('...i,...i->...',d,y)
+    y = np.linalg.solve(L,d[...,np.newaxis])[...,0]
+    return np.einsum('...i,...i->...',y,y)
+
+# Structures of a transport matrix F that Transport exploits:
+#   identity: F = 1
+#   zline: F = 1 but F[0,2] = F[1,3] = dz (straight line in (x,y,tx,ty,...))
+#   constant, general: any F (constant: the same F for every step)
+FSTRUCTURES = ("identity","zline","constant","general")
+
+def Transport(x,C,F,structure="general",dz=0.):
+    """ transports the state (x,C), a KFVector and a KFMatrix, with the
+    transport matrix F: returns F*x and F*C*F^T (new objects), without the
+    multiplications that the structure of F (see FSTRUCTURES) makes trivial:
+    identity: copies; zline: adds dz times the rows and columns of the
+    tangents to those of the positions (dz, the step, is F[0,2])
+    """
+    if structure == "identity":
+        return KFVector(x),KFMatrix(C)
+    if structure == "zline":
+        xp = np.array(x.M,dtype=float)
+        xp[0:2] += dz*xp[2:4]
+        Cp = np.array(C.M,dtype=float)
+        Cp[0:2] += dz*Cp[2:4]
+        Cp[:,0:2] += dz*Cp[:,2:4]
+        return KFVector.Wrap(xp),KFMatrix.Wrap(Cp)
+    return F*x,F*C*F.Transpose()
+
+def GainUpdate(x,C,m,V,H):
+    """ gain form of the update of the state (x,C) with the measurement
+    (m,V) and the projection matrix H:
+        S = V + H C H^T (innovation covariance)
+        K = C H^T S^-1 (solving S, no inverse)
+        xf = x + K (m - H x)
+        Cf = (I-KH) C (I-KH)^T + K V K^T (Joseph form)
+    returns xf, Cf, the measurement chi2 (m-H xf)^T V^-1 (m-H xf) and the
+    MS chi2 (xf-x)^T C^-1 (xf-x) (with CholeskyChi2).
+    The arguments are numpy arrays x (...,n), C (...,n,n), m (...,p),
+    V (...,p,p), H (...,p,n), the leading dimensions are a batch
+    """
+    HT = np.swapaxes(H,-1,-2)
+    CHT = np.matmul(C,HT)
+    S = V + np.matmul(H,CHT)
+    r = m - np.matmul(H,x[...,np.newaxis])[...,0]
+    try:
+        KT = np.linalg.solve(S,np.swapaxes(CHT,-1,-2))
+    except np.linalg.LinAlgError:
+        KT = np.matmul(np.linalg.pinv(S),np.swapaxes(CHT,-1,-2))
+    K = np.swapaxes(KT,-1,-2)
+    xf = x + np.matmul(K,r[...,np.newaxis])[...,0]
+    IKH = np.identity(x.shape[-1]) - np.matmul(K,H)
+    Cf = np.matmul(np.matmul(IKH,C),np.swapaxes(IKH,-1,-2)) + np.matmul(np.matmul(K,V),KT)
+    R = m - np.matmul(H,xf[...,np.newaxis])[...,0]
+    chi2meas = CholeskyChi2(V,R)
+    chi2ms = CholeskyChi2(C,xf-x)
+    return xf,Cf,chi2meas,chi2ms
+
+def RTSSmoother(AP,CP,AF,CF,F=None):
+    """ Rauch-Tung-Striebel smoother over the predicted (AP,CP) and
+    filtered (AF,CF) states of a fit, numpy arrays (N,n) and (N,n,n).
+    F (N,n,n) are the transport matrices (F[k] from node k-1 to k),
+    the identity if None. The smoother gains
+        A[k] = CF[k] F[k+1]^T CP[k+1]^-1
+    are computed for all the nodes at once (solving CP, no inverse) and then
+        AS[k] = AF[k] + A[k] (AS[k+1] - AP[k+1])
+        CS[k] = CF[k] + A[k] (CS[k+1] - CP[k+1]) A[k]^T
+    from the last node (AS = AF) backwards. Returns AS, CS
+    """
+    N = len(AF)
+    AS = np.array(AF,dtype=float)
+    CS = np.array(CF,dtype=float)
+    if N < 2: return AS,CS
+
+    FCF = CF[:-1] if F is None else np.matmul(F[1:],CF[:-1])
+    try:
+        AT = np.linalg.solve(CP[1:],FCF)
+    except np.linalg.LinAlgError:
+        AT = np.matmul(np.linalg.pinv(CP[1:]),FCF)
+    A = np.swapaxes(AT,-1,-2)
+
+    for k in range(N-2,-1,-1):
+        AS[k] += np.dot(A[k],AS[k+1]-AP[k+1])
+        CS[k] += np.dot(np.dot(A[k],CS[k+1]-CP[k+1]),AT[k])
+    return AS,CS
+
+def SmoothedChi2(m,V,H,AS,CS):
+    """ chi2 of the smoothed states (AS,CS) with the measurements (m,V)
+    and projections H (numpy arrays with a leading node axis):
+        r = m - H AS, R = V - H CS H^T, chi2 = r^T R^-1 r
+    """
+    r = m - np.matmul(H,AS[...,np.newaxis])[...,0]
+    R = V - np.matmul(np.matmul(H,CS),np.swapaxes(H,-1,-2))
+    return CholeskyChi2(R,r)
 
 def testMatrix():
     v1 = KFVector([1.,2.,3.])  #notice: 1.,2.,3.] to get floats
@@ -1202,6 +1438,174 @@ def testMatrix():
         m+10 = {1}
         """.format(ma10,m+10)
 
+def testInPlace():
+
+    print "\n\n** TESTING IN-PLACE OPERATIONS **\n\n"
+
+    m1 = KFMatrix([[1.,2.],[3.,4.]])
+    m2 = KFMatrix([[2.,0.],[1.,2.]])
+    v1 = KFVector([1.,2.])
+    out = KFMatrixNull(2)
+    vout = KFVector([0.,0.])
+
+    print "test property: m += m2 keeps the storage"
+    store = m1.M
+    m1 += m2
+    c1 = m1 == KFMatrix([[3.,2.],[4.,6.]]) and m1.M is store
+    m1 -= m2
+    c1 = c1 and m1 == KFMatrix([[1.,2.],[3.,4.]]) and m1.M is store
+    m1 *= 2
+    c1 = c1 and m1 == KFMatrix([[2.,4.],[6.,8.]]) and m1.M is store
+    m1 *= 0.5
+    if c1 == True:
+        print "passed"
+    else:
+        print """
+        failed: m1 = {0}
+        """.format(m1)
+        sys.exit(-1)
+
+    print "test property: Dot/Add/Sub with out buffer"
+    c1 = m1.Dot(m2,out=out) is out and out == m1*m2
+    c1 = c1 and m1.Add(m2,out=out) is out and out == m1+m2
+    c1 = c1 and m1.Sub(m2,out=out) is out and out == m1-m2
+    c1 = c1 and m1.Dot(v1,out=vout) is vout and vout == m1*v1
+    c1 = c1 and m1.Inverse(out=out) is out and out*m1 == KFMatrixUnitary(2)
+    if c1 == True:
+        print "passed"
+    else:
+        print """
+        failed: out = {0}, vout = {1}
+        """.format(out,vout)
+        sys.exit(-1)
+
+    print "test property: v += w, v -= w, v *= number"
+    v2 = KFVector(v1)
+    store = v2.M
+    v2 += v1
+    v2 -= 1.
+    v2 *= 2
+    c1 = v2 == KFVector([2.,6.]) and v2.M is store
+    c1 = c1 and 10-v1 == KFVector([9.,8.])
+    if c1 == True:
+        print "passed"
+    else:
+        print """
+        failed: v2 = {0}
+        """.format(v2)
+        sys.exit(-1)
+
+def testGainUpdate():
+
+    print "\n\n** TESTING GAIN UPDATE **\n\n"
+
+    x = KFVector([1.,2.,0.1,-0.2])
+    C = KFMatrix([[0.5,0.1,0.02,0.],[0.1,0.4,0.,0.03],
+                  [0.02,0.,0.05,0.01],[0.,0.03,0.01,0.06]])
+    H = KFMatrix([[1.,0.,3.,0.],[0.,1.,0.,3.]])
+    V = KFMatrix([[0.01,0.],[0.,0.02]])
+    m = KFVector([1.5,1.2])
+
+    # information form
+    Ci = C.Inverse()
+    Vi = V.Inverse()
+    HT = H.Transpose()
+    Cf = (Ci+HT*Vi*H).Inverse()
+    xf = Cf*(Ci*x+HT*(Vi*m))
+    R = m-H*xf
+    d = xf-x
+    chi2meas = R*(Vi*R)
+    chi2ms = d*(Ci*d)
+
+    gxf,gCf,gchi2meas,gchi2ms = GainUpdate(x.M[:,0],C.M,m.M[:,0],V.M,H.M)
+
+    print "test property: gain form = information form"
+    c1 = np.allclose(gxf,xf.M[:,0]) and np.allclose(gCf,Cf.M)
+    c1 = c1 and np.allclose(gchi2meas,chi2meas) and np.allclose(gchi2ms,chi2ms)
+    if c1 == True:
+        print "passed"
+    else:
+        print """
+        failed
+        xf = {0} gain xf = {1}
+        Cf = {2} gain Cf = {3}
+        chi2 = {4},{5} gain chi2 = {6},{7}
+        """.format(xf,gxf,Cf,gCf,chi2meas,chi2ms,gchi2meas,gchi2ms)
+
+    print "test property: batch = one by one"
+    bx = np.array([x.M[:,0],2*x.M[:,0]])
+    bm = np.array([m.M[:,0],m.M[:,0]])
+    b = GainUpdate(bx,np.array([C.M,C.M]),bm,np.array([V.M,V.M]),np.array([H.M,H.M]))
+    one = GainUpdate(bx[1],C.M,bm[1],V.M,H.M)
+    c2 = np.allclose(b[0][0],gxf) and np.allclose(b[1][1],one[1])
+    c2 = c2 and np.allclose(b[2][1],one[2]) and np.allclose(b[3][1],one[3])
+    if c2 == True:
+        print "passed"
+    else:
+        print "failed"
+
+    if(c1 and c2):
+        print "\n\n-- PASSED --\n\n"
+    else:
+        print "\n\n-- FAILED --\n\n"    
+
+def testRTSSmoother():
+
+    print "\n\n** TESTING RTS SMOOTHER **\n\n"
+
+    F = KFMatrix([[1.,0.5],[0.,1.]])
+    Q = KFMatrix([[0.01,0.],[0.,0.02]])
+    AF = [KFVector([0.,1.])]; CF = [KFMatrix([[1.,0.],[0.,1.]])]
+    AP = [AF[0]]; CP = [CF[0]]
+    for k in range(1,4):
+        AP.append(F*AF[-1]); CP.append(F*CF[-1]*F.Transpose()+Q)
+        AF.append(AP[-1]+KFVector([0.1*k,-0.05])); CF.append(CP[-1]*0.5)
+
+    # explicit backward pass with inverses
+    xs = [None]*4; Cs = [None]*4
+    xs[3] = AF[3]; Cs[3] = CF[3]
+    for k in range(2,-1,-1):
+        A = CF[k]*F.Transpose()*CP[k+1].Inverse()
+        xs[k] = AF[k] + A*(xs[k+1]-AP[k+1])
+        Cs[k] = CF[k] + A*(Cs[k+1]-CP[k+1])*A.Transpose()
+
+    ar = lambda l: np.array([x.M[:,0] if isinstance(x,KFVector) else x.M for x in l])
+    AS,CS = RTSSmoother(ar(AP),ar(CP),ar(AF),ar(CF),np.array([F.M]*4))
+
+    print "test property: RTSSmoother = explicit backward pass"
+    c1 = np.allclose(AS,ar(xs)) and np.allclose(CS,ar(Cs))
+    if(c1):
+        print "passed"
+        print "\n\n-- PASSED --\n\n"
+    else:
+        print "failed, AS = {0}, xs = {1}".format(AS,xs)
+        print "\n\n-- FAILED --\n\n"    
+
+def testTransport():
+
+    print "\n\n** TESTING TRANSPORT **\n\n"
+
+    dz = 0.7
+    x = KFVector([1.,2.,0.3,-0.2,2.5])
+    C = KFMatrix((np.diag([1.,2.,0.1,0.2,0.5])+0.01).tolist())
+    F = KFMatrixUnitary(5)
+    F[0,2] = dz; F[1,3] = dz
+
+    print "test property: Transport = F*x, F*C*FT for each structure"
+    xp,Cp = Transport(x,C,F,"zline",dz)
+    c1 = np.allclose(xp.M,(F*x).M) and np.allclose(Cp.M,(F*C*F.Transpose()).M)
+    I = KFMatrixUnitary(5)
+    xp,Cp = Transport(x,C,I,"identity")
+    c1 = c1 and xp == x and Cp == C and xp is not x and Cp is not C
+    xp,Cp = Transport(x,C,F,"general")
+    c1 = c1 and np.allclose(Cp.M,(F*C*F.Transpose()).M)
+    if(c1):
+        print "passed"
+        print "\n\n-- PASSED --\n\n"
+    else:
+        print "failed"
+        print "\n\n-- FAILED --\n\n"    
+
 def testMatrix4by4():
     
     m2 = KFMatrix([[2.41520000e-03,   2.91000000e-05,  -3.61620000e-03,  -4.36000000e-05],
@@ -1288,4 +1692,8 @@ if __name__ == '__main__':
     testMatrix()
     #testKHVector()
     testMatrixMult()
+    testInPlace()
+    testGainUpdate()
+    testRTSSmoother()
+    testTransport()
     testMatrix4by4()
@@ -14,6 +14,7 @@ from KFState import KFState
 from KFSetup import KFSetup 
 from KFSystem import KFSystem
 from KalmanFilter import KalmanFilter
+from KFArrayFilter import CorrectPArray, Sigma2ThetaMsArray, MSCovariance
 from math import *
 
 from KLogKFWolinFilter import *
@@ -21,7 +22,10 @@ from KLogKFWolinFilter import *
 class KFWolinFilter(KalmanFilter):
     """
     A KF filter following Wodin et. al.  
+    The state is at z = 0: the transport matrix is the identity
     """
+
+    TransportStructure = "identity"
         
     def __init__(self,name,P0=2.913527586963954):
         """
@@ -31,8 +35,33 @@ class KFWolinFilter(KalmanFilter):
         KalmanFilter.__init__(self,name)
         
         self.P = P0 # in MeV
+        self.F = KFMatrix([[1.,0.,0.,0. ],
+                           [0.,1.,0.,0.],
+                           [0.,0.,1.,0.],
+                           [0.,0.,0.,1]])
         lgx.info("KFWolinFilter__init__ -> P0 ={0}".
             format(P0))
+
+    def SetSystem(self,system):
+        """
+        Sets the system, and computes the quantities of the nodes that
+        depend only on their KFZSlice (not on the state): the z at the
+        middle of the slices and the H matrices, the momentum after the
+        energy loss of each slice (from the current momentum self.P) and
+        sigma2(theta_ms) (see KFArrayFilter)
+        """
+        KalmanFilter.SetSystem(self,system)
+
+        slices = [node.ZSlice for node in self.system.Nodes]
+        self.Zi = np.array([zslice.Zi for zslice in slices],dtype=float)
+        dz = np.array([zslice.dz for zslice in slices],dtype=float)
+        edep = np.array([zslice.Edep for zslice in slices],dtype=float)
+        Lr = np.array([zslice.Lr for zslice in slices],dtype=float)
+
+        self.Zm = self.Zi + dz/2.
+        self.Hs = [KFMatrix([[1.,0.,z0,0.],[0.,1.,0.,z0]]) for z0 in self.Zm]
+        self.Ps = CorrectPArray(self.P,edep)
+        self.S2tms = Sigma2ThetaMsArray(self.Ps,np.abs(dz)/Lr)
     
     def SetupFilter(self,k):
         """
@@ -126,71 +155,47 @@ class KFWolinFilter(KalmanFilter):
         """
         H matrix at state k
         """
-        dz =self.system.Nodes[k].ZSlice.dz;
-        z0 =self.system.Nodes[k].ZSlice.Zi + dz/2.;
-        return KFMatrix([[1.,0.,z0,0.],[0.,1.,0.,z0]])
+        return self.Hs[k]
 
 
     def TransportMatrix(self,k):
         """
         The Transport Matrix F allows to transport the State from site i to j
+        (the unit matrix: the state is at z = 0)
         """
-        
-        return KFMatrix([[1.,0.,0.,0. ],
-                            [0.,1.,0.,0.],
-                            [0.,0.,1.,0.],
-                            [0.,0.,0.,1]]) 
+        return self.F
 
     def MultipleScatteringMatrix(self,k):
         """
-        The multiple scattering matrix Qk
+        The multiple scattering matrix Qk (the momentum after the energy
+        loss and sigma2(theta_ms) of node k are computed by SetSystem)
         """
-        dz =self.system.Nodes[k].ZSlice.dz
-        z0 =self.system.Nodes[k].ZSlice.Zi
-        z02=z0*z0;
-        edep = self.system.Nodes[k].ZSlice.Edep*1.
-        Lr = self.system.Nodes[k].ZSlice.Lr
-        L=abs(dz)/Lr
+        z0 = self.Zi[k]
 
         stateDict=self.system.States[k-1]
         state =stateDict["F"]
 
         ak = state.V
-        p1 = ak[0]
-        p2 = ak[1]
         p3 = ak[2]
         p4 = ak[3]
 
-        lgx.debug("KFWolinFilter:MultipleScatteringMatrix -> ak ={0} type ={1}".
-            format(ak,type(ak)))
-
-        lgx.debug(" -> p1 ={0} p2 ={1} p3 ={2} p4 ={3}, type(p1)={4}".
-            format(p1,p2,p3,p4,type(p1)))
+        if trc.on:
+            trc.debug("KFWolinFilter:MultipleScatteringMatrix -> ak ={0} type ={1}",
+                ak,type(ak))
+            trc.debug(" -> p3 ={0} p4 ={1}, type(p3)={2}",p3,p4,type(p3))
+            trc.debug("KFWolinFilter:MultipleScatteringMatrix -> z0 ={0} P ={1}",
+                z0,self.P)
 
-        lgx.debug("KFWolinFilter:MultipleScatteringMatrix -> dz ={0} dz2 = {1} edep ={2}".
-            format(dz,dz*dz,edep))
+        self.P = self.Ps[k]
+        s2tms = self.S2tms[k]
 
-        lgx.debug("KFWolinFilter:MultipleScatteringMatrix -> Lr ={0} L = {1} P ={2}".
-            format(Lr,L,self.P))
-
-        self.P =self.CorrectP(self.P, edep)
-        
-        lgx.debug("KFWolinFilter:MultipleScatteringMatrix -> P (after correct) ={0}".
-            format(self.P))
-        
-        s2tms =self.Sigma2ThetaMs(self.P,L)
-
-        lgx.debug("KFWolinFilter:MultipleScatteringMatrix -> s2tms ={0} type ={1}".
-            format(s2tms,type(s2tms)))
-
-        p3p3 =s2tms*(1+p3**2)*(1+p3**2+p4**2)
-        p4p4 = s2tms*(1+p4**2)*(1+p3**2+p4**2)
-        p3p4=s2tms*p3*p4*(1+p3**2+p4**2)
+        if trc.on:
+            trc.debug("KFWolinFilter:MultipleScatteringMatrix -> P (after correct) ={0}",
+                self.P)
+            trc.debug("KFWolinFilter:MultipleScatteringMatrix -> s2tms ={0} type ={1}",
+                s2tms,type(s2tms))
 
-        cov = KFMatrix([[z02*p3p3,z02*p3p4,-z0*p3p3,-z0*p3p4],
-                        [z02*p3p4,z02*p4p4,-z0*p3p4,-z0*p4p4],
-                        [-z0*p3p3,-z0*p3p4,p3p3,p3p4],
-                        [-z0*p3p4,-z0*p4p4,p3p4,p4p4]])
+        cov = KFMatrix.Wrap(MSCovariance(s2tms,z0,p3,p4))
 
         return cov
     
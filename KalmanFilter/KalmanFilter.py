@@ -1,5 +1,5 @@
 
-from KFBase import KFVector, KFMatrix
+from KFBase import KFVector, KFMatrix, GainUpdate, RTSSmoother, SmoothedChi2, Transport
 from KFMeasurement import KFMeasurement 
 from KFZSlice import KFZSlice
 from KFNode import KFNode 
@@ -9,6 +9,7 @@ from KFSystem import KFSystem
 from KMCParticle import KMCParticle
 
 import sys
+import numpy as np
 
 from math import *
 from abc import ABCMeta, abstractmethod
@@ -28,7 +29,18 @@ class KalmanFilter(object):
     
     Takes a System and additional conditions as extra arguments   
     P0 is the initial momentum (needed for the computation of MS) 
+
+    The filter update can be done in the information form (reference)
+    or in the gain form (see SetUpdateMode)
+
+    A fitter declares the structure of its TransportMatrix in
+    TransportStructure (see KFBase.FSTRUCTURES): the prediction and the
+    smoother skip the products that it makes trivial
     """
+
+    UpdateModes = ("information","gain")
+    Update = "information"
+    TransportStructure = "general"
     
     def __init__(self,name,P0=2.9):
         """
@@ -98,6 +110,23 @@ class KalmanFilter(object):
         """
         return self.name
 
+    def SetUpdateMode(self,mode):
+        """
+        Sets the update of Filter:
+        "information": CF = (CP^-1 + H^T G H)^-1 (three inverses per node)
+        "gain": S = V + H CP H^T, K = CP H^T S^-1 and Joseph form for CF
+        """
+        if mode not in KalmanFilter.UpdateModes:
+            print "error, update mode must be one of ",KalmanFilter.UpdateModes
+            sys.exit(-1)
+        self.Update = mode
+
+    def GetUpdateMode(self):
+        """
+        Returns the update mode of Filter
+        """
+        return self.Update
+
     @abstractmethod
     def H(self,k):
         """
@@ -162,7 +191,7 @@ class KalmanFilter(object):
 
         """
 
-        lgx.debug("-->Predict: k = {0}".format(k))
+        if trc.on: trc.debug("-->Predict: k = {0}",k)
             
 
         if k== 0:
@@ -176,28 +205,21 @@ class KalmanFilter(object):
         CF = state.Cov
         F = self.TransportMatrix(k)   # the method should be constructed to give F(k-1)
         Q =self.MultipleScatteringMatrix(k) # the method should be constructed to give Q(k-1)
-        FT = F.Transpose()
-        aP = F*aF
-        CPt = F*CF*FT 
-        CP = F*CF*FT + Q
-
-        lgx.debug("Filtered from previous state->\n aF={0}\n CF={1}".
-            format(aF,CF))
-
-        lgx.debug("Transport and MS->\n F={0} \n FT={1} \n Q={2}".
-            format(F,FT,Q))
+        aP,CPt = Transport(aF,CF,F,self.TransportStructure)
+        CP = CPt + Q
 
-        lgx.debug("Predict-> \n aP=F*aF->{0}\n MS matrix = {1}".
-            format(aP,Q))
-
-        lgx.debug("Predict-> CPt= F*CF*FT->{0} CP= F*CF*FT+Q ->{1}".
-            format(CPt,CP))
+        if trc.on:
+            FT = F.Transpose()
+            trc.debug("Filtered from previous state->\n aF={0}\n CF={1}",aF,CF)
+            trc.debug("Transport and MS->\n F={0} \n FT={1} \n Q={2}",F,FT,Q)
+            trc.debug("Predict-> \n aP=F*aF->{0}\n MS matrix = {1}",aP,Q)
+            trc.debug("Predict-> CPt= F*CF*FT->{0} CP= F*CF*FT+Q ->{1}",CPt,CP)
 
         pstate = KFState(aP,CP)
         pstate.Chi2=1e+6
         self.system.States.append({"P":pstate,"F":0,"S":0})
 
-        cond_pause(debug)
+        if trc.on: trc.pause()
 
         return 0
 
@@ -234,9 +256,13 @@ class KalmanFilter(object):
         Ck^-1 = CFI 
         Ck,k-1 = CP
         Ck, k-1^-1 =CPI 
+
+        In the "gain" update mode the same state is computed with
+        the innovation covariance S = V + H Ck,k-1 H^T:
+        K = Ck,k-1 H^T S^-1 and Ck = (I-KH) Ck,k-1 (I-KH)^T + K V K^T
         """
 
-        lgx.debug("-->Filter : k = {0}".format(k))
+        if trc.on: trc.debug("-->Filter : k = {0}",k)
 
         if k== 0:
             print "Can't filter at site 0 k must be >=1"
@@ -247,107 +273,141 @@ class KalmanFilter(object):
         aP = state.V  # aP = ak,k+1
         CP = state.Cov
 
-        lgx.debug("Predicted State->  aP ={0} \n  CP ={1}".
-            format(aP,CP))
+        if self.Update == "gain":
+            aF,CF,chi2meas,chi2ms = self.GainUpdate(k,aP,CP)
+        else:
+            aF,CF,chi2meas,chi2ms = self.InformationUpdate(k,aP,CP)
+        
+        chi2 = (chi2meas + chi2ms)/2.  # chi2/2. is chi2/dof
 
-        m = self.system.Nodes[k].Measurement.V
-        G = self.system.Nodes[k].Measurement.Cov.Inverse()
+        if trc.on:
+            trc.info("Chi2Meas ={0} Chi2Ms = {1}",chi2meas,chi2ms)
+            trc.info("Filtered State-> \n aF ={0} \n Chi2 = {1} ",aF,chi2)
 
-        lgx.debug("Measurement-> \n  m ={0} \n G = V^-1 ={1}".
-            format(m,G))
+        # Construct the filtered state.
+        fstate = KFState(aF,CF)
+        fstate.Chi2=chi2
+        stateDict["F"] = fstate
+
+        # Save the MS part of the chi2 in the predicted state.
+        stateDict["P"].Chi2 = chi2ms/2; 
+
+        if trc.on: trc.pause()
+        
+        return 0
 
-        cond_pause(debug)
+
+    def InformationUpdate(self,k,aP,CP):
+        """
+        Filtered state at k from the predicted state (aP,CP) in the
+        information form. Returns aF, CF and the chi2 of the measurement
+        and of the MS
+        """
+        m = self.system.Nodes[k].Measurement.V
+        G = self.system.Nodes[k].Measurement.Cov.Inverse()
 
         CPI = CP.Inverse()
         H = self.H(k)
         HT =H.Transpose()
 
-        lgx.debug("Matrices-> \n Ck,k-1^-1 =CPI ={0} \n H ={1} \n HT ={2}".
-                 format(CPI,H,HT))
-
-        cond_pause(debug)
+        if trc.on:
+            trc.debug("Predicted State->  aP ={0} \n  CP ={1}",aP,CP)
+            trc.debug("Measurement-> \n  m ={0} \n G = V^-1 ={1}",m,G)
+            trc.debug("Matrices-> \n Ck,k-1^-1 =CPI ={0} \n H ={1} \n HT ={2}",
+                 CPI,H,HT)
+            trc.pause()
 
         CFI = CPI + HT*G*H  # CFI = Ck^-1
         CF = CFI.Inverse() #CF = Ck : filtered
         K = CF*HT*G  # G= V^-1: K : Gain Matrix
 
-        r2 = H*aP   # transforms predicted state
-
-        lgx.debug("Filt Cov-> \n Ck,^-1 =CFI ->{0} \n Ck = CF = {1} \n K =CF*HT*G ->{2}".
-                 format(CFI,CF,K))
-
-        cond_pause(debug)
-
-        lgx.debug("-->r2 =H*aP ={0}".
-                 format(r2))
-        
         r = m - H*aP # residual wrt predicted
 
-        lgx.debug("-->r = m - H*aP ={0}".
-                 format(r))
-
-        cond_pause(debug)
-
-        r2 = K*r # K =(4x2) r = (2x1): KfMatrix*KFvector -->(KFvector) (4x1)
-
-        lgx.debug(" r2 =K*r ={0}  ".
-                 format(r2))
-
-        cond_pause(debug)
-        
         aF = aP + K* r # aF = ak : filtered
 
-        lgx.debug("aF = aP + K* r-> \n aP ={0} \n aF ={1} \n ".
-                 format(aP,aF))
-
-        cond_pause(debug)
-
-        r2 = H*aF
-
-        lgx.debug("r2 =H*aF ={0} \n".
-                 format(r2))
-
         R = m - H*aF # residual wrt Filtered
 
-        lgx.debug("R = m - H*aF-> \n R ={0}  \n ".
-                 format(R))
-
         RT = R.Transpose()
-        
-        lgx.debug("RT  ={0}, G={1}  \n ".
-                 format(RT,G))
 
-        cond_pause(debug)
+        if trc.on:
+            trc.debug("Filt Cov-> \n Ck,^-1 =CFI ->{0} \n Ck = CF = {1} \n K =CF*HT*G ->{2}",
+                 CFI,CF,K)
+            trc.debug("-->r2 =H*aP ={0}",H*aP)
+            trc.debug("-->r = m - H*aP ={0}",r)
+            trc.debug(" r2 =K*r ={0}  ",K*r) # K =(4x2) r = (2x1): (4x1)
+            trc.debug("aF = aP + K* r-> \n aP ={0} \n aF ={1} \n ",aP,aF)
+            trc.debug("r2 =H*aF ={0} \n",H*aF)
+            trc.debug("R = m - H*aF-> \n R ={0}  \n ",R)
+            trc.debug("RT  ={0}, G={1}  \n ",RT,G)
+            trc.pause()
         
         Rf = aF - aP          # residual (filtered - predicted)
         RfT = Rf.Transpose()
         
         chi2meas = RT*G*R     # chi2 contribution due to measurement
         chi2ms = RfT*CPI*Rf   # chi2 contribution due to MS
-        
-        chi2 = (chi2meas[0] + chi2ms[0])/2.  # chi2/2. is chi2/dof
 
-        lgx.debug("Residuals-> \n r ={0} \n R = {1} ".
-                 format(r,R))
+        if trc.on: trc.debug("Residuals-> \n r ={0} \n R = {1} ",r,R)
 
-        lgx.info("Chi2Meas ={0} Chi2Ms = {1}".
-                 format(chi2meas,chi2ms))
+        return aF,CF,chi2meas[0],chi2ms[0]
 
-        lgx.info("Filtered State-> \n aF ={0} \n Chi2 = {1} ".
-                 format(aF,chi2))
+    def GainUpdate(self,k,aP,CP):
+        """
+        Filtered state at k from the predicted state (aP,CP) in the
+        gain form (see KFBase.GainUpdate). Returns aF, CF and the chi2
+        of the measurement and of the MS
+        """
+        measurement = self.system.Nodes[k].Measurement
+        H = self.H(k)
 
-        # Construct the filtered state.
-        fstate = KFState(aF,CF)
-        fstate.Chi2=chi2
-        stateDict["F"] = fstate
+        xf,Cf,chi2meas,chi2ms = GainUpdate(aP.M[:,0],CP.M,
+            measurement.V.M[:,0],measurement.Cov.M,H.M)
+        aF = KFVector.Wrap(xf[:,np.newaxis])
+        CF = KFMatrix.Wrap(Cf)
 
-        # Save the MS part of the chi2 in the predicted state.
-        stateDict["P"].Chi2 = chi2ms[0]/2; 
+        if trc.on:
+            trc.debug("Gain update-> \n aP ={0} \n CP ={1} \n H ={2}",aP,CP,H)
+            trc.debug("aF ={0} \n CF ={1}",aF,CF)
+            trc.pause()
+
+        return aF,CF,float(chi2meas),float(chi2ms)
 
-        cond_pause(debug)
-        
-        return 0
 
+    def Smooth(self):
+        """
+        Smooths the filtered states (RTS smoother): the predicted and
+        filtered states of all the nodes are smoothed in one backward pass
+        (see KFBase.RTSSmoother) and set in the "S" slot of the States
+        (a KFState with the chi2 per dof of the measurement)
+        """
+        states = self.system.States
+        nodes = self.system.Nodes
+        N = len(states)
+
+        AP = np.array([states[k]["P"].V.M[:,0] for k in range(N)])
+        CP = np.array([states[k]["P"].Cov.M for k in range(N)])
+        AF = np.array([states[k]["F"].V.M[:,0] for k in range(N)])
+        CF = np.array([states[k]["F"].Cov.M for k in range(N)])
+        F = None
+        if self.TransportStructure != "identity":
+            F = np.array([np.identity(len(AF[0]))]+
+                         [self.TransportMatrix(k).M for k in range(1,N)])
+
+        AS,CS = RTSSmoother(AP,CP,AF,CF,F)
+
+        m = np.array([nodes[k].Measurement.V.M[:,0] for k in range(N)])
+        V = np.array([nodes[k].Measurement.Cov.M for k in range(N)])
+        H = np.array([self.H(k).M for k in range(N)])
+        chi2 = SmoothedChi2(m,V,H,AS,CS)/2.
+
+        for k in range(N):
+            sstate = KFState(KFVector.Wrap(AS[k][:,np.newaxis]),KFMatrix.Wrap(CS[k]))
+            sstate.Chi2 = chi2[k]
+            states[k]["S"] = sstate
+
+        if trc.on: trc.debug("Smooth-> N = {0} chi2 = {1}",N,chi2)
+
+        return 0
 
     def SigmaThetaMs(self,P,L):
         """
@@ -363,10 +423,9 @@ class KalmanFilter(object):
             lgx.debug("+++KalmanFilter:SigmaThetaMs+++: Error calculating tms: P = {0}, beta = {1}, L = {2}".format(P,beta,L))
             raise;
 
-        lgx.info("SigmaThetaMs->  L={0} P={1} beta={2}, tms={3}".
-            format(L,P,beta,tms))
-
-        cond_pause(debug)
+        if trc.on:
+            trc.info("SigmaThetaMs->  L={0} P={1} beta={2}, tms={3}",L,P,beta,tms)
+            trc.pause()
 
         return tms
 
@@ -7,14 +7,14 @@ The program run using the alex framework
 """
 
 from math import *
-import random
+import numpy as np
 from copy import deepcopy
 
 from alex.alex import IAlg
 from alex.alex import Alex
 from alex.rootsvc import ROOTSvc
 
-from KFBase import KFVector, KFMatrix, KFMatrixNull, KFMatrixUnitary
+from KFBase import KFVector, KFMatrix, KFMatrixNull, KFMatrixUnitary, Random
 from kfnext import NEXT, nextgenerator, nextfilter, V0, H0, simplegenerator, simplefilter
 from kfgenerator import zavesample,zrunsample
 from kffilter import randomnode, KFData, KFNode
@@ -42,32 +42,36 @@ MTYPE = 'filter'
 NBLOCK = 5
 #MTYPE = 'smooth'
 
-def genele(ene = 2.5):
+def genele(ene = 2.5, rng = None):
     """ generate an electron with a kinection energy (ene).
     return a list of states (x,y,z,ux,uy,ux,ene), 
     where ux,uy,uz are the cos-director and ene is the kinetic energy
+    rng is the random stream of the event (see Random.stream)
     """
-    theta = random.uniform(0.,pi)
-    phi = random.uniform(0,2.*pi)
+    if (rng is None): rng = np.random
+    theta = rng.uniform(0.,pi)
+    phi = rng.uniform(0,2.*pi)
     ux,uy,uz = sin(theta)*cos(phi),sin(theta)*sin(phi),cos(theta)
     #ux,uy,uz=0.,0.,1.
     state0 = (0.,0.,0.,ux,uy,uz,ene)
-    states = gnextgen.generate(state0)
+    states = gnextgen.generate(state0,rng)
     # print 'genele-states-'states
     return states
 
-def genbeta(ene = 2.5, emin=0.1):
+def genbeta(ene = 2.5, emin=0.1, rng = None):
     """ generate a double beta (two electrons) with total kinetic energy (ene).
     Return a list with two list of states with (x,y,z,ux,uy,uz,ene)
     where ux,uy,uz are the cos-director and ene is the kinetic energy
+    rng is the random stream of the event (see Random.stream)
     """
-    ei0 = random.uniform(emin,ene-emin)
+    if (rng is None): rng = np.random
+    ei0 = rng.uniform(emin,ene-emin)
     ei0 = 1.7
     ei1 = ene-ei0
     e0 = min(ei0,ei1)
     e1 = max(ei0,ei1)
-    states1 = genele(e0)
-    states2 = genele(e1)
+    states1 = genele(e0,rng)
+    states2 = genele(e1,rng)
     # print 'genbeta-states1 ',states1
     # print 'genbeta-states2 ',states2
     return [states1,states2]
@@ -88,18 +92,20 @@ def createzdigits(states,zs):
     # note that it removes the first state!
     return (digits,zstates[1:])
 
-def createhits(digits,xres=0.1):
+def createhits(digits,xres=0.1,rng=None):
     """ from the list of digits (x,y,z,delta-ene), return a list of hits.
     Each hit is computed with a given resolution
     A hit is a KFData with a vector (x,y) and a cov-matrix. 
     Hit also has an attribute with the delta-ene (dene)
+    rng is the random stream of the event (see Random.stream)
     """
     hits = []
-    for digit in digits:
+    V = (xres*xres)*KFMatrixUnitary(2)
+    sms = Random.covs(V,len(digits),rng)
+    for digit,sm in zip(digits,sms):
         x,y,z,dene = digit
-        x = x+random.gauss(0.,xres)
-        y = y+random.gauss(0.,xres)
-        V = (xres*xres)*KFMatrixUnitary(2)
+        x = x+sm[0]
+        y = y+sm[1]
         hit = KFData(KFVector([x,y]),V,zrun=z)
         hit.dene = dene
         hits.append(hit)
@@ -167,7 +173,7 @@ def fitnodes(nodes):
     gnextfit.clear()
     gnextfit.setnodes(nodes)
     cc = gnextfit.fit(state0)
-    kf = deepcopy(gnextfit)
+    kf = gnextfit.snapshot()
     #print 'fitnodes ',cc    
     return cc,kf
 
@@ -241,19 +247,48 @@ def foms(nodes):
     ac = achiv0(nodes)
     return chi,chib,ac
 
+class ScanPart(object):
+    """ a part of the track at a split of the scan (see FitScanNodes),
+    in the order of its fit (starting at the split).
+    chi2s are the filter chi2 of its nodes, state is the filter state at
+    the split, and foms (chi,chib,ac) its figures of merit (see foms)
+    """
+
+    def __init__(self,nodes,chis,state,foms):
+        self.nodes = nodes
+        self.chi2s = chis
+        self.state = state
+        self.foms = foms
+        return
+
+def fitpart(nodes):
+    """ fit the nodes of a part (see fitnodes) and return it as a ScanPart
+    """
+    cc,kf = fitnodes(nodes)
+    chis = np.array(map(lambda nd: nd.chi2.get('filter',np.nan),kf.nodes))
+    state = kf.nodes[0].getstate('filter')
+    return ScanPart(kf.nodes,chis,state,foms(kf.nodes))
+
 #------------------------
 #    algorithms
 #------------------------
 
 class GenerateBeta(IAlg):
     """ Algorithm to generate states (x,y,z,ux,uy,uz,p)
+    The event ievt is generated with the stream (seed,ievt), also used 
+    to smear its hits (sim/rng)
     """
     def define(self):
         self.E0 = 2.5 # MeV
+        self.seed = 1
+        self.ievt = 0
         return
 
     def execute(self):
-        states = [genele(self.E0),]
+        rng = Random.stream(self.seed,self.ievt)
+        self.ievt+=1
+        states = [genele(self.E0,rng),]
+        self.evt['sim/rng'] = rng
         self.evt['sim/states'] = states
         val = map(lambda st: (len(st),st[0],st[-1]),states)
         self.msg.verbose(self.name,val)
@@ -261,14 +296,21 @@ class GenerateBeta(IAlg):
 
 class GenerateDoubleBeta(IAlg):
     """ Algorithm to generate a doble beta event
+    The event ievt is generated with the stream (seed,ievt), also used 
+    to smear its hits (sim/rng)
     """
 
     def define(self):
         self.E0 = 2.5 # MeV
+        self.seed = 1
+        self.ievt = 0
         return
 
     def execute(self):
-        states = genbeta(self.E0)
+        rng = Random.stream(self.seed,self.ievt)
+        self.ievt+=1
+        states = genbeta(self.E0,rng=rng)
+        self.evt['sim/rng'] = rng
         self.evt['sim/states'] = states
         data = map(lambda seg: (len(seg),seg[0],seg[-1]),states)
         self.msg.verbose(self.name,' states ',data)
@@ -324,7 +366,7 @@ class CreateNodes(IAlg):
         hits, nods = [],[]
         for i,dig in enumerate(digs):
             zst = zsts[i]
-            hit = createhits(dig)
+            hit = createhits(dig,self.xres,self.evt['sim/rng'])
             nod = createnodes(hit,H0,zst)
             hits.append(hit)
             nods.append(nod)
@@ -375,7 +417,7 @@ class DoubleBetaNodes(IAlg):
         dig.reverse(); zst.reverse()
         dig+=deepcopy(digs[1]); zst+=deepcopy(zsts[1])
         #print ' digs - total ',len(dig)
-        hits = [createhits(dig),]
+        hits = [createhits(dig,rng=self.evt['sim/rng']),]
         nods = [createnodes(hits[0],H0,zst),]
         ok = len(nods)>0
         if (ok):
@@ -413,6 +455,7 @@ class FitNodes(IAlg):
 
 class FitScanNodes(IAlg):
     """ Algorithm to do a scan along the track and fit in both directions
+    (the two parts of every split are fitted, see fitpart)
     """
 
     def define(self):
@@ -438,17 +481,14 @@ class FitScanNodes(IAlg):
         #print 'inodes ',inodes
         vals = {}
         for inode in inodes:
-            rnodes = deepcopy(nodes[:inode])
+            rnodes = map(lambda node: node.snapshot(),nodes[:inode])
             rnodes.reverse()
-            fnodes = deepcopy(nodes[inode:])
-            #print ' forward ',inode
-            fcc,fkf = fitnodes(fnodes)
-            #print ' reverse ',inode
-            rcc,rkf = fitnodes(rnodes)
-            vals[inode-nver]=(rkf,fkf)
+            fnodes = map(lambda node: node.snapshot(),nodes[inode:])
+            rpart,fpart = fitpart(rnodes),fitpart(fnodes)
+            vals[inode-nver]=(rpart,fpart)
             self.msg.verbose('scan i ',inode-nver)
-            self.msg.verbose('scan r ',rcc,achi(rkf.nodes))
-            self.msg.verbose('scan f ',fcc,achi(fkf.nodes))
+            if (rpart): self.msg.verbose('scan r ',rpart.foms)
+            if (fpart): self.msg.verbose('scan f ',fpart.foms)
         self.evt['rec/kfs/scan']=vals
         return True
 
@@ -785,9 +825,9 @@ class HistosScanNodes(IAlg):
         def ifoms(inode):
             rkf,fkf = vals[inode]
             rvals = [0.,0.,0.]
-            if (rkf): rvals = foms(rkf.nodes)
+            if (rkf): rvals = rkf.foms
             fvals = [0.,0.,0.]
-            if (fkf): fvals = foms(fkf.nodes)
+            if (fkf): fvals = fkf.foms
             return (rvals,fvals)
 
         vs = ifoms(0)
@@ -810,12 +850,10 @@ class HistosScanNodes(IAlg):
                 self.root.fill(self.prefix+'vtx_rchib',rchib)
                 self.root.fill(self.prefix+'vtx_fac',fac)
                 self.root.fill(self.prefix+'vtx_rac',rac)
-                fnodes = fkf.nodes
-                tchi2 = map(lambda nd: nd.getchi2(MTYPE),fnodes)
+                tchi2 = fkf.chi2s
                 for i in range(len(tchi2)): 
                     self.root.fill(self.prefix+'vtx_fchii_pf',i,tchi2[i])
-                rnodes = rkf.nodes
-                tchi2 = map(lambda nd: nd.getchi2(MTYPE),rnodes)
+                tchi2 = rkf.chi2s
                 for i in range(len(tchi2)): 
                     self.root.fill(self.prefix+'vtx_rchii_pf',i,tchi2[i])
             if (inode<=-5):
@@ -825,8 +863,7 @@ class HistosScanNodes(IAlg):
                 self.root.fill(self.prefix+'vnv_fchi',fchi,vfchi)
                 self.root.fill(self.prefix+'vnv_fchib',fchib,vfchib)
                 self.root.fill(self.prefix+'vnv_fac',fac,vfac)
-                fnodes = fkf.nodes
-                tchi2 = map(lambda nd: nd.getchi2(MTYPE),fnodes)
+                tchi2 = fkf.chi2s
                 for i in range(len(tchi2)): 
                     self.root.fill(self.prefix+'nvtx_fchii_pf',i,tchi2[i])
             if (inode>=5):
@@ -836,8 +873,7 @@ class HistosScanNodes(IAlg):
                 self.root.fill(self.prefix+'vnv_rchi',rchi,vrchi)
                 self.root.fill(self.prefix+'vnv_rchib',rchib,vrchib)
                 self.root.fill(self.prefix+'vnv_rac',rac,vrac)
-                rnodes = rkf.nodes
-                tchi2 = map(lambda nd: nd.getchi2(MTYPE),rnodes)
+                tchi2 = rkf.chi2s
                 for i in range(len(tchi2)): 
                     self.root.fill(self.prefix+'nvtx_rchii_pf',i,tchi2[i])
 
@@ -1010,9 +1046,9 @@ class EventDisplayScan(IAlg):
         def ifoms(inode):
             rkf,fkf = vals[inode]
             rvals = 0.,0.,0.
-            if (rkf): rvals = foms(rkf.nodes)
+            if (rkf): rvals = rkf.foms
             fvals = 0.,0.,0.
-            if (fkf): fvals = foms(fkf.nodes)
+            if (fkf): fvals = fkf.foms
             return (rvals,fvals)
 
         vs = ifoms(0)
@@ -6,7 +6,7 @@ from KFBase import KFVector, KFMatrix, KFMatrixNull, KFMatrixUnitary
 from kfnext import NEXT, nextgenerator, nextfilter, V0, H0
 from kfnext import simplegenerator, simplefilter
 from kfgenerator import zsample,zransample,zavesample,zsegments,zrunsegments
-from kffilter import randomnode, KFData
+from kffilter import randomnodes, KFData
 from kfzline import zstate
 from math import *
 from troot import tcanvas
@@ -118,7 +118,7 @@ class GenerateNodes(IAlg):
         digits = self.evt['sim/digits']   
         if (not digits): return False
         zstates = map(zstate,digits)
-        nodes = map(lambda st: randomnode(st,H0,self.V),zstates)
+        nodes = randomnodes(zstates,H0,self.V)
         de = digits[0][-1]+digits[-1][-1] # reverse the energy
         for node in nodes: 
             node.hit.ene = node.getstate('true').vec[4]
@@ -303,14 +303,14 @@ class KFFit2(IAlg):
         seg2 = segnodes[-1]
         ok1,kf1 = self.fitsegment(seg1)
         if ok1: 
-            kfs.append(deepcopy(kf1))
+            kfs.append(kf1.snapshot())
             print " forward ",ok1,kf1.cleanchi2('filter'),kf1.cleanchi2('smooth')
         seg2.reverse()
         for nd in seg2: nd.hit.ene = nd.hit.rene
         #for nd in seg2: print ' z ene ',nd.zrun,nd.hit.ene
         ok2,kf2 = self.fitsegment(seg2)
         if ok2: 
-            kfs.append(deepcopy(kf2))
+            kfs.append(kf2.snapshot())
             print " reverse ",ok2,kf2.cleanchi2('filter'),kf2.cleanchi2('smooth')
         ok = (len(kfs)>=2)
         if (ok): self.evt['rec/kfs']=kfs
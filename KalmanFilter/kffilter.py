@@ -1,5 +1,6 @@
-from KFBase import KFVector, KFMatrix, KFMatrixNull, KFMatrixUnitary, Random 
+from KFBase import KFVector, KFMatrix, KFMatrixNull, KFMatrixUnitary, Random, GainUpdate, Transport
 from math import *
+from copy import copy
 
 """
 Generic implemantation of a Kalman Filter
@@ -11,6 +12,7 @@ User needs to set the KFNodes into the KFilter
 
 DEBUG = False
 WARNING = True
+UPDATE = 'information' # KFNode.predict update: 'information' or 'gain'
 
 def debug(comment,arg=''):
     if (DEBUG): print "INFO ",comment,arg
@@ -54,40 +56,75 @@ class KFData(object):
         """ copy a KFData object
         """
         return KFData(self.vec,self.cov,self.zrun,self.pars)
+
+    def withvalue(self,i,value):
+        """ return a new KFData with the element i of the vector set to value
+        (the cov-matrix and the pars are shared)
+        """
+        state = copy(self)
+        state.vec = KFVector(self.vec)
+        state.vec[i] = value
+        return state
     
-    def random(self):
+    def random(self,rng=None):
+        """ random vector from the state (rng is the random stream, see Random.stream)
+        """
         x0 = KFVector(self.vec)
-        sx = Random.cov(self.cov)
+        sx = Random.cov(self.cov,rng)
         x = x0+sx
         debug('kfdata.random x',x)
         return x
 
-def randomhit(state,H,V):
+def randomhit(state,H,V,rng=None):
     """ generate a random hit from this state, the proyection H matrix and the variance resolution matrix V
+    (rng is the random stream, see Random.stream)
     """
     x = state.vec
     zrun = state.zrun
     m0 = H*x
-    sm = Random.cov(V)
+    sm = Random.cov(V,rng)
     mm = m0+sm
     hit = KFData(mm,V,zrun)
     debug('randomhit x,hit ',(x,hit))
     return hit
 
-def randomnode(state,H,V):
+def randomnode(state,H,V,rng=None):
     """ generate a random node from this state, the proyection H matrix and the variance resolution matrix V
+    (rng is the random stream, see Random.stream)
     """
-    hit = randomhit(state,H,V)
+    hit = randomhit(state,H,V,rng)
     node = KFNode(hit,H)
     node.setstate('true',state)
     debug('randomnode x,node ',node)
     return node
 
+def randomnodes(states,H,V,rng=None):
+    """ generate the random nodes of a list of states, as randomnode, with
+    the smearing of all the hits drawn at once
+    (rng is the random stream, see Random.stream)
+    """
+    sms = Random.covs(V,len(states),rng)
+    nodes = []
+    for state,sm in zip(states,sms):
+        mm = H*state.vec+KFVector(sm)
+        hit = KFData(mm,V,state.zrun)
+        node = KFNode(hit,H)
+        node.setstate('true',state)
+        nodes.append(node)
+    debug('randomnodes nodes ',len(nodes))
+    return nodes
+
 
 class KFModel(object):    
     """ virtual class to define an state, its propagatiopn, F and Q matrices
+    A model declares the structure of its F matrix in fstructure (see 
+    KFBase.FSTRUCTURES): the propagation skips the products that it makes
+    trivial, and an identity or constant F is built once (a model that
+    keeps the unitary FMatrix can declare 'identity')
     """
 
+    fstructure = 'general'
+
     def validstep(self,state,zrun):
         """ check is this step is valid
         """
@@ -102,6 +139,17 @@ class KFModel(object):
         debug('kfmodel.Fmatrix ',F)
         return F
 
+    def transport(self,xvec,zrun):
+        """ returns the F matrix of a step (FMatrix, or the one built the first
+        time if it is identity or constant, see fstructure)
+        """
+        if (self.fstructure not in ('identity','constant')):
+            return self.FMatrix(xvec,zrun)
+        if (not hasattr(self,'fmatrices')): self.fmatrices = {}
+        n = xvec.Length()
+        if (n not in self.fmatrices): self.fmatrices[n] = self.FMatrix(xvec,zrun)
+        return self.fmatrices[n]
+
     def QMatrix(self,xvec,zrun,pars=None):
         """ return the Q, noise matrix, null by default
         """
@@ -117,19 +165,16 @@ class KFModel(object):
         if (not ok): 
             warning( "kfmodel.propagate not possible ",(zrun,state.vec))
             return ok,None,None,None
-        x = KFVector(state.vec)
-        C = KFMatrix(state.cov)
+        x = state.vec
+        C = state.cov
         deltaz = self.deltazrun(state,zrun)
-        F = self.FMatrix(x,deltaz)
-        FT = F.Transpose()
+        F = self.transport(x,deltaz)
         #print ' F ',F
-        #print ' FT ',FT
         Q = self.QMatrix(x,deltaz)
         #print ' Q ',Q
-        xp = F*x
+        xp,Cp = Transport(x,C,F,self.fstructure,deltaz)
         #print ' xp ',xp
-        Cp = F*C*FT
-        if (Q): Cp = Cp+Q
+        if (Q): Cp += Q
         #print ' Cp ',Cp
         pstate = KFData(xp,Cp,zrun,state.pars)
         #print ' propagated state ',pstate
@@ -149,6 +194,9 @@ class KFModel(object):
 class KFNode(object):
     """ note to store a mesurements and the kalman states
     It has generate, filter and smooth methods
+    The states (KFData) are stored by reference: a state is never modified
+    once stored (a new state is stored instead), so that nodes and fits can
+    share them (see snapshot)
     """
 
     names = ['none','true','pred','filter','smooth','rpred','rfilter']
@@ -182,7 +230,7 @@ class KFNode(object):
         """
         if (name not in KFNode.names):
             print ' state name  ',name,' not in KNode!'
-        self.states[name]=state.copy()
+        self.states[name]=state
         self.status = name
         return
 
@@ -194,6 +242,16 @@ class KFNode(object):
         self.chi2[name]=chi2
         return
 
+    def snapshot(self):
+        """ return a copy of the node that shares its hit data and states
+        (the states and chi2 stored later in this node are not in the copy)
+        """
+        node = copy(self)
+        node.hit = copy(self.hit)
+        node.states = dict(self.states)
+        node.chi2 = dict(self.chi2)
+        return node
+
     def getstate(self,name):
         """ get the state with name ('pred','fiter','rfilter','smooth')
         """
@@ -230,17 +288,18 @@ class KFNode(object):
         debug('kfnode.param ',(name,xx,cc))
         return xx,cc
 
-    def generate(self,state):
+    def generate(self,state,rng=None):
         """ generate a node from this state 
         (state is stored as true in the node)
+        rng is the random stream (see Random.stream)
         """
         C = state.cov
-        x = state.random()
+        x = state.random(rng)
         n,m = C.M.shape
         C0 = KFMatrixNull(n,m)
         gstate = KFData(x,C0,self.zrun,pars=state.pars)
         V = self.hit.cov
-        knode = randomnode(gstate,self.hmatrix,V)
+        knode = randomnode(gstate,self.hmatrix,V,rng)
         #print ' m0 ',m0,' sm ',sm,' m ',m
         #hit = KFData(m,V,self.zrun)
         #print ' initial state ',state
@@ -254,6 +313,7 @@ class KFNode(object):
         return the filter state at this node and the chi2
         """
         #print ' KFNode predict at ',self.zrun
+        if (UPDATE == 'gain'): return self.gainpredict(state)
         x = state.vec
         C = state.cov
         Ci = C.Inverse()
@@ -284,6 +344,21 @@ class KFNode(object):
         chi2 = chi2[0]
         debug('kfnode.predict state,chi2 ',(fstate,chi2))
         return fstate,chi2
+
+    def gainpredict(self,state):
+        """ as predict but using the gain form of the update (no inverses):
+        S = V + H C H^T, K = C H^T S^-1 and the Joseph form for Cf
+        """
+        x = state.vec.M[:,0]
+        C = state.cov.M
+        m = self.hit.vec.M[:,0]
+        V = self.hit.cov.M
+        H = self.hmatrix.M
+        xf,Cf,chi2meas,chi2ms = GainUpdate(x,C,m,V,H)
+        fstate = KFData(xf,Cf,self.zrun,pars=state.pars)
+        chi2 = float(chi2meas+chi2ms)
+        debug('kfnode.gainpredict state,chi2 ',(fstate,chi2))
+        return fstate,chi2
         
     def smooth(self,node1):
         """ node is the next node already smoothed
@@ -374,10 +449,20 @@ class KFFilter(object):
         """
         return len(self.nodes)
 
+    def snapshot(self):
+        """ return a copy of the filter with snapshots of its nodes (see
+        KFNode.snapshot): it keeps the result of the fit when the filter
+        or the nodes are used again for another fit
+        """
+        kf = copy(self)
+        kf.nodes = map(lambda node: node.snapshot(),self.nodes)
+        return kf
+
 
-    def generate(self,state0):
+    def generate(self,state0,rng=None):
         """ starting from a seed state, state0, 
         generate nodes at zruns of the nodes
+        rng is the random stream (see Random.stream)
         """
         knodes = []
         state = state0.copy()
@@ -388,9 +473,9 @@ class KFFilter(object):
                 warning("kfilter.generate end due to propagation at ",zrun)
                 debug('kfilter.generate nodes ',len(knodes))
                 return knodes
-            knode = node.generate(state)
+            knode = node.generate(state,rng)
             knodes.append(knode)
-            state = knode.getstate('true').copy()
+            state = knode.getstate('true')
         debug('kfilter.generate nodes ',len(knodes))
         return knodes
 
@@ -415,7 +500,7 @@ class KFFilter(object):
             node.setchi2('filter',fchi2)
             tchi2+=fchi2
             self.model.user_filter(node)
-            state = node.getstate('filter').copy()
+            state = node.getstate('filter')
             ii+=1
         self.status='filter'
         debug("kfilter.filter ok,chi2 ",(ok,tchi2))
@@ -457,7 +542,7 @@ class KFFilter(object):
             debug("kfilter.smoother ok,chi2 ",(False,tchi2))
             return False,tchi2
         fstate = self.nodes[-1].getstate('filter')
-        self.nodes[-1].setstate('smooth',fstate.copy())
+        self.nodes[-1].setstate('smooth',fstate)
         self.nodes[-1].setchi2('smooth',self.nodes[-1].getchi2('filter'))
         ks = range(0,len(self.nodes)-1)
         ks.reverse()
@@ -2,7 +2,7 @@ from KFBase import KFVector
 from KFBase import KFMatrix,KFMatrixNull,KFMatrixUnitary,Random 
 from kffilter import KFData,KFNode,KFModel,KFFilter
 from math import *
-import random
+import numpy as np
 
 """
 KalmanFilter implementation for NEXT
@@ -52,7 +52,9 @@ class KFGenerator:
         self.emin = emin 
         return
 
-    def step(self,state0):
+    def step(self,state0,rng=None):
+        """ makes a step from state0 (rng is the random stream, see Random.stream)
+        """
         x0,y0,z0,ux0,uy0,uz0,ee0 = state0
         de,ds = self.eloss.deltax(ee0,self.deltae)
         ok = self.msnoiser.validstep(ee0,ds)
@@ -65,121 +67,149 @@ class KFGenerator:
         #print ' ee0 ',ee0
         #print ' de, ds ',de,ds
         pp = kinmomentum(ee0)
-        xvf,uvf = self.msnoiser.XUrandom(pp,ds,xv0,uv0)
+        xvf,uvf = self.msnoiser.XUrandom(pp,ds,xv0,uv0,rng)
         x,y,z=xvf; ux,uy,uz=uvf
         ee = ee0-de
         state = [x,y,z,ux,uy,uz,ee]
         debug('kgenerator.step state ',state)
         return ok,state
 
-    def generate(self,state0):
-        """ generate nstates starting from state0, each one with an delta e loss
+    def generate(self,state0,rng=None):
+        """ generate nstates starting from state0, each one with an delta e loss.
+        rng is the random stream of the particle (see Random.stream): 
+        by default the global numpy one.
+        The energy losses and lengths of the steps do not depend on the MS:
+        they are computed first, and the MS of all the steps is generated at
+        once (see MSNoise.XUtrack)
         """
         state = list(state0)
         states = [state]
-        ok,ee = True,state[-1]
-        while (ok and ee>self.emin):
-            ok,state = self.step(state0)
-            if (ok): states.append(state)
-            state0 = list(state)
-            ee = state[-1]
+        ee,enes,dss = state[-1],[],[]
+        while (ee>self.emin):
+            de,ds = self.eloss.deltax(ee,self.deltae)
+            ok = self.msnoiser.validstep(ee,ds)
+            if (not ok): break
+            enes.append(ee); dss.append(ds)
+            ee = ee-de
+        if (len(dss)==0): return states
+        pps = map(kinmomentum,enes)
+        xs,us = self.msnoiser.XUtrack(pps,dss,state[0:3],state[3:6],rng)
+        enes = enes[1:]+[ee]
+        for x,u,ee in zip(xs.tolist(),us.tolist(),enes):
+            states.append(x+u+[ee])
         debug('kfgenerator.generate states ',len(states))
         return states
 
+def statearray(states):
+    """ return the list of states (x,y,z,ux,uy,uz,ene) as a (n,7) array
+    (the samplers convert the states once, and accept either)
+    """
+    return np.asarray(states,dtype=float).reshape(-1,7)
+
+def zsteps(states):
+    """ return the states at the start and at the end of each step, st0, st1,
+    as (n-1,7) arrays
+    """
+    xs = statearray(states)
+    return xs[:-1],xs[1:]
+
+def zcross(st0,st1,z):
+    """ return the mask of the steps (st0,st1) that cross z (z can be an
+    array with one z per step): z0<=z<z1 forward, z0>=z>z1 backward
+    """
+    z0,z1 = st0[:,2],st1[:,2]
+    return ((z0<=z) & (z<z1)) | ((z0>=z) & (z>z1))
+
 def stateatz(states,z):
-    def getzi(st0,st1):
-        x0,y0,z0,ux0,uy0,uz0,ee0=st0
-        x1,y1,z1,ux1,uy1,uz1,ee1=st1
-        ok = False
-        if (z0<=z and z<z1): ok =True
-        if (z0>=z and z>z1): ok = True
-        if (ok): return z
+    """ return the state at z, interpolated in the last step that crosses z
+    """
+    st0,st1 = zsteps(states)
+    isteps = np.flatnonzero(zcross(st0,st1,z))
+    if (len(isteps)==0):
+        warning("kfgenerator.stateatz no step crosses z ",z)
         return None
-    def zstate(st0,st1,z):
-        x0,y0,z0,ux0,uy0,uz0,ee0=st0
-        x1,y1,z1,ux1,uy1,uz1,ee1=st1
-        if (z-z0 == 0.): return st0
-        dz = (z-z0)/(z1-z0)
-        x = x0+(x1-x0)*dz
-        y = y0+(y1-y0)*dz
-        ux = ux0+(ux1-ux0)*dz
-        uy = uy0+(uy1-uy0)*dz
-        uz = uz0+(uz1-uz0)*dz
-        uu = sqrt(ux*ux+uy*uy+uz*uz)
-        ux=ux/uu;uy=uy/uu;uz=uz/uu
-        ee = ee0-(ee0-ee1)*(z-z0)/(z1-z0)
-        dene = ee-ee0
-        stz = [x,y,z,ux,uy,uz,ee]
-        #print " st0 ",st0
-        #print " st1 ",st1
-        #print " stz ",stz
-        return stz
-    nn = len(states)
-    for ii in range(nn-1):
-        st0,st1 = states[ii],states[ii+1]
-        zi = getzi(st0,st1)
-        if (not zi): continue
-        zst =  zstate(st0,st1,zi)
+    zst = zinterpolate(st0[isteps[-1:]],st1[isteps[-1:]],z)[0].tolist()
     debug("kfgenerator.stateatz state ",zst)
     return zst
 
+def zinterpolate(st0,st1,z):
+    """ return the states at z (one per step, z can be an array), linearly
+    interpolated between the states at the start and end of the steps, st0,
+    st1, (n,7) arrays. The state at the start is returned if z is its z
+    """
+    x0,y0,z0,ux0,uy0,uz0,ee0 = st0.T
+    x1,y1,z1,ux1,uy1,uz1,ee1 = st1.T
+    dz = (z-z0)/(z1-z0)
+    x = x0+(x1-x0)*dz
+    y = y0+(y1-y0)*dz
+    ux = ux0+(ux1-ux0)*dz
+    uy = uy0+(uy1-uy0)*dz
+    uz = uz0+(uz1-uz0)*dz
+    uu = np.sqrt(ux*ux+uy*uy+uz*uz)
+    ux=ux/uu;uy=uy/uu;uz=uz/uu
+    ee = ee0-(ee0-ee1)*(z-z0)/(z1-z0)
+    zst = np.column_stack((x,y,z*np.ones(len(z0)),ux,uy,uz,ee))
+    return np.where((z-z0 == 0.)[:,np.newaxis],st0,zst)
 
 def zrunsample(states,zs,epsilon=0.01):
-    """ sample the states, return states at zs positions
+    """ sample the states, return states at zs positions: a state for each
+    z in zs crossed by a step, in the order of the track. The crossings are
+    located in the sorted zs, for all the steps at once, in the direction of
+    each step (forward: z0<=z<z1, backward z0>=z>z1), so the turns of the
+    track need no special treatment.
+    Two consecutive states at the same z (the track turns between them) are
+    moved epsilon apart in the direction of the track
     """
-    zstates = []
-    nn = len(states)
-    def getzi(st0,st1):
-        x0,y0,z0,ux0,uy0,uz0,ee0=st0
-        x1,y1,z1,ux1,uy1,uz1,ee1=st1
-        for zi in zs:
-            ok = False
-            if (z0<=zi and zi<z1): ok =True
-            if (z0>=zi and zi>z1): ok = True
-            if (ok):
-                #print ' zi! ',z0,zi,z1
-                return zi
-        return None
-    def zstate(st0,st1,z):
-        x0,y0,z0,ux0,uy0,uz0,ee0=st0
-        x1,y1,z1,ux1,uy1,uz1,ee1=st1
-        x = x0+(ux0/uz0)*(z-z0)
-        y = y0+(uy0/uz0)*(z-z0)
-        ux = ux0+ux1*(z-z0)/(z1-z0)
-        uy = uy0+uy1*(z-z0)/(z1-z0)
-        uz = uz0+uz1*(z-z0)/(z1-z0)
-        uu = sqrt(ux*ux+uy*uy+uz*uz)
-        ux=ux/uu;uy=uy/uu;uz=uz/uu
-        ee = ee0-(ee0-ee1)*(z-z0)/(z1-z0)
-        dene = ee-ee0
-        stz = (x,y,z,ux,uy,uz,ee)
-        #print " st0 ",st0
-        #print " st1 ",st1
-        #print " stz ",stz
-        return stz
+    st0,st1 = zsteps(states)
+    zs = np.sort(np.asarray(zs,dtype=float))
+    z0,z1 = st0[:,2],st1[:,2]
+    fwd = z1>z0
+    # the range [i0,i1) of zs crossed by each step
+    i0 = np.where(fwd,np.searchsorted(zs,z0,'left'),np.searchsorted(zs,z1,'right'))
+    i1 = np.where(fwd,np.searchsorted(zs,z1,'left'),np.searchsorted(zs,z0,'right'))
+    ns = np.maximum(i1-i0,0)
+    ns[z1==z0] = 0
+    if (ns.sum()==0): return []
+    # one entry per crossing: the step and the z, ordered along the step
+    isteps = np.repeat(np.arange(len(ns)),ns)
+    k = np.arange(ns.sum())-np.repeat(np.cumsum(ns)-ns,ns)
+    izs = np.where(fwd[isteps],i0[isteps]+k,i1[isteps]-1-k)
+    zstates = zrunstate(st0[isteps],st1[isteps],zs[izs])
+    # (in place, each z depends on the previous one, once moved)
+    zz = zstates[:,2]
     udir = +1.
-    for ii in range(0,nn-1):
-        st0,st1 = states[ii],states[ii+1]
-        zi = getzi(st0,st1)
-        if (not zi): continue
-        zst =  zstate(st0,st1,zi)
-        zst = list(zst)
-        if (len(zstates)>0): 
-            zp = zstates[-1]
-            zzp,zzn = zp[2],zst[2]
-            if (zzn>zzp): udir=+1.
-            elif (zzn<zzp): udir = -1.
-            elif (zzn==zzp): zst[2]=zst[2]+udir*epsilon
-        zstates.append(zst)
+    for i in range(1,len(zz)):
+        if (zz[i]>zz[i-1]): udir = +1.
+        elif (zz[i]<zz[i-1]): udir = -1.
+        else: zz[i] = zz[i]+udir*epsilon
+    zstates = zstates.tolist()
     debug("kfgenerator.zsample zstates ",zstates)
     return zstates
+
+def zrunstate(st0,st1,z):
+    """ return the states at z (one per step), the position extrapolated from
+    the state at the start of the step, st0, along its direction
+    """
+    x0,y0,z0,ux0,uy0,uz0,ee0 = st0.T
+    x1,y1,z1,ux1,uy1,uz1,ee1 = st1.T
+    x = x0+(ux0/uz0)*(z-z0)
+    y = y0+(uy0/uz0)*(z-z0)
+    ux = ux0+ux1*(z-z0)/(z1-z0)
+    uy = uy0+uy1*(z-z0)/(z1-z0)
+    uz = uz0+uz1*(z-z0)/(z1-z0)
+    uu = np.sqrt(ux*ux+uy*uy+uz*uz)
+    ux=ux/uu;uy=uy/uu;uz=uz/uu
+    ee = ee0-(ee0-ee1)*(z-z0)/(z1-z0)
+    return np.column_stack((x,y,z,ux,uy,uz,ee))
     
-def zransample(states,p=0.2):
+def zransample(states,p=0.2,rng=None):
     """ sample random the states with a given probability
+    (rng is the random stream, see Random.stream)
     """
+    if (rng is None): rng = np.random
     zs = []
     for state in states:
-        pi = random.uniform(0.,1.)
+        pi = rng.uniform(0.,1.)
         if (pi<=p): zs.append(state)
     debug("kfgenerator.zrunsample zstates ",zstates)
     return zs
@@ -201,23 +231,29 @@ def zavesample_old(states,n=4):
     return zs
     
 def zavesample(states,n=4):
+    """ sample the states: the first and last states, and between them, for
+    each group of n states, the state at the average z of the group
+    (interpolated in the last step of the group that crosses it)
+    """
     z0,zf = states[0],states[-1]
-    states = states[1:-1]
-    zsts = [z0]
-    ns = len(states)
-    mm = int(ns/n)
-    for i in range(mm):
-        istates = states[i*n:min((i+1)*n,ns)]
-        iz = sum(map(lambda st: st[2],istates))/len(istates)
-        izst = stateatz(istates,iz)
-        #print 'zavesamples2 i states \n'
-        #for state in istates: print '\t ',state
-        #print 'zavesamples2 i zi ',iz
-        #print 'zavesmaples2 i states ',izst
-        zsts.append(izst)
-    zsts.append(zf)
+    xs = statearray(states)[1:-1]
+    mm = int(len(xs)/n)
+    xs = xs[:mm*n].reshape(mm,n,7)
+    # (the z of the states are added in order, as sum does)
+    iz = xs[:,0,2]
+    for k in range(1,n): iz = iz+xs[:,k,2]
+    iz = iz/n
+    st0,st1 = xs[:,:-1],xs[:,1:]
+    cross = zcross(st0.reshape(-1,7),st1.reshape(-1,7),np.repeat(iz,n-1)).reshape(mm,n-1)
+    ok = cross.any(axis=1)
+    if (not ok.all()):
+        warning("kfgenerator.zavesample groups with no step at their z ",np.flatnonzero(~ok))
+    # the last step that crosses the average z of each group
+    ilast = (n-2)-np.argmax(cross[:,::-1],axis=1)
+    igroups = np.arange(mm)
+    izsts = zinterpolate(st0[igroups,ilast][ok],st1[igroups,ilast][ok],iz[ok])
+    zsts = [z0]+izsts.tolist()+[zf]
     debug('kfgenerator.zavesamples zsts ',zsts)
-    #print 'zavesmaples2 states ',zsts
     return zsts
 
 def zsegments(states):
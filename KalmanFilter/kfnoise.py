@@ -7,11 +7,9 @@ from KFBase import KFVector
 from KFBase import KFMatrix, KFMatrixNull, KFMatrixUnitary
 from KFBase import Random
 from math import *
-import random
 import numpy as np
 from scipy.interpolate import interp1d as sc_interpol
 from scipy.optimize import bisect as sc_root
-from scipy.integrate import quad as sc_integrate
 from exceptions import ZeroDivisionError
 
 DEBUG = False
@@ -55,6 +53,19 @@ def thetams(p,dis,X0,mass=0.511):
     debug('thetams p, udis, theta ',(p,udis,tms))
     return tms
 
+def thetasms(p,dis,X0,mass=0.511):
+    """ return the theta MS angles, as thetams, for arrays of momenta (p)
+    and distances (dis)
+    """
+    dis = np.abs(np.asarray(dis,dtype=float))
+    p = np.asarray(p,dtype=float)
+    if (X0 <=0.): return np.zeros(dis.shape)
+    udis = np.where(dis>0.,dis,1.)/X0
+    ene = np.sqrt(mass**2+p**2)
+    beta = p/ene
+    tms = (13.6)/(p*1.*beta)*np.sqrt(udis)*(1+0.038*np.log(udis))
+    return np.where(dis>0.,tms,0.)
+
 def UMatrix(udir):
     """ returns the rotation matrix that transfrom vectors in the track ref. system to the global system
     """
@@ -77,6 +88,17 @@ def UMatrix(udir):
     debug('UMatrix udir, U ',(udir,U))
     return U    
 
+def UMatrices(udir):
+    """ returns the rotation matrices of UMatrix, a (n,3,3) array, for the
+    (n,3) array of unit directions udir
+    """
+    ux,uy,uz = udir.T
+    vv = np.sqrt(uz*uz+ux*ux)
+    v = np.column_stack((uz/vv,np.zeros(len(vv)),-ux/vv))
+    w = np.column_stack((-uy*ux/vv,vv,-uy*uz/vv))
+    w = w/np.sqrt(np.sum(w*w,axis=1))[:,np.newaxis]
+    return np.stack((v,w,udir),axis=2)
+
 class MSNoise:
     """ Multiple scattering helper class
     it provides thetams, cov, random values 
@@ -129,30 +151,33 @@ class MSNoise:
         debug('msnoiser.Q0Matrix p,dis,Q ',(p,dis,Q))
         return Q
 
-    def random(self,p,dis):
+    def random(self,p,dis,rng=None):
         """ generate multiple scattering random variables in x,theta.
         x is the transverse direction
         and theta the angle.
+        rng is the random stream (see Random.stream)
         """
+        if (rng is None): rng = np.random
         theta0 = MS.theta(p,dis)
         rho = sqrt(3.)/2.
-        z1,z2 = random.gauss(0.,1.),random.gauss(0.,1.)
+        z1,z2 = rng.normal(0.,1.,2)
         y = z1*dis*theta0/sqrt(12.)+z2*dis*theta0/2.
         theta = z2*theta0
         debug('msnoise.random p,dis,x,theta ',(p,dis,y,theta))
         return y,theta
     
-    def XUrandom(self,p,dis,x0,udir):
+    def XUrandom(self,p,dis,x0,udir,rng=None):
         """ return a position and direction (in the global system) 
         after a random MS of a particle with momentum p
-        that traverses a distance dis with a direction udir
+        that traverses a distance dis with a direction udir.
+        rng is the random stream (see Random.stream)
         """
         udir.Unit()
         U = UMatrix(udir)
         #print ' U ',U
         Q0 = self.Q0Matrix(p,dis)
         #print ' Q0 ',Q0
-        x1,x2,t1,t2 = Random.cov(Q0)
+        x1,x2,t1,t2 = Random.cov(Q0,rng)
         #print ' x1,x2,t1,t2 ',x1,x2,t1,t2
         t1 = tan(t1); t2 = tan(t2); nor = sqrt(1.+t1*t1+t2*t2)
         xt = KFVector([x1,x2,0.]) 
@@ -171,6 +196,146 @@ class MSNoise:
             print 'msnoise.XUrandom xf,uf ',xf,uf
         return xf,uf
 
+    def thetas(self,p,dis):
+        """ return theta of ms for arrays of momenta (p) and distances (dis)
+        """
+        return thetasms(p,dis,self.X0,self.mass)
+
+    def XUlocals(self,p,dis,rng=None):
+        """ return the random MS displacements and directions, in the track
+        system, of particles with momenta p that traverse distances dis
+        (arrays with one entry per step). Returns two (n,3) arrays.
+        The 4 normal numbers of each step are drawn at once, in the order of
+        XUrandom, and correlated with the Cholesky factor of Q0Matrix, which
+        is known: for each transverse coordinate
+          x = dis*theta0/sqrt(3)*z1
+          t = theta0*(sqrt(3)/2*z1+1/2*z2)
+        rng is the random stream (see Random.stream)
+        """
+        if (rng is None): rng = np.random
+        dis = np.asarray(dis,dtype=float)
+        theta0 = self.thetas(p,dis)
+        zs = rng.normal(0.,1.,(len(dis),4))
+        lx = (dis*theta0/sqrt(3.))[:,np.newaxis]
+        x12 = lx*zs[:,0:2]
+        t12 = np.tan(theta0[:,np.newaxis]*(0.5*sqrt(3.)*zs[:,0:2]+0.5*zs[:,2:4]))
+        nor = np.sqrt(1.+np.sum(t12*t12,axis=1))[:,np.newaxis]
+        xt = np.column_stack((x12,np.zeros(len(dis))))
+        ut = np.column_stack((t12/nor,1./nor))
+        return xt,ut
+
+    def XUrandoms(self,p,dis,x0,udir,rng=None):
+        """ return the positions and directions (in the global system), (n,3)
+        arrays, after a random MS of particles with momenta p that traverse
+        distances dis with directions udir, from positions x0 (arrays with one
+        entry or row per particle). Each particle has one independent step,
+        as in XUrandom.
+        rng is the random stream (see Random.stream)
+        """
+        xt,ut = self.XUlocals(p,dis,rng)
+        udir = np.asarray(udir,dtype=float)
+        udir = udir/np.sqrt(np.sum(udir*udir,axis=1))[:,np.newaxis]
+        U = UMatrices(udir)
+        xf = np.asarray(x0,dtype=float)+np.asarray(dis,dtype=float)[:,np.newaxis]*udir
+        xf = xf+np.einsum('nij,nj->ni',U,xt)
+        uf = np.einsum('nij,nj->ni',U,ut)
+        return xf,uf
+
+    def XUtrack(self,p,dis,x0,udir,rng=None):
+        """ return the positions and directions (in the global system), (n,3)
+        arrays, of a particle after each of its steps, that start at x0 with
+        direction udir: the momentum and distance of each step are the
+        arrays p, dis. The random MS of all the steps is drawn at once (see
+        XUlocals); only the rotations to the global system are done step
+        by step, as the direction of a step is the result of the previous one.
+        rng is the random stream (see Random.stream)
+        """
+        xt,ut = self.XUlocals(p,dis,rng)
+        x,y,z = map(float,x0)
+        ux,uy,uz = map(float,udir)
+        xs = np.zeros((len(dis),3))
+        us = np.zeros((len(dis),3))
+        for i,(ds,(x1,x2,x3),(t1,t2,t3)) in enumerate(zip(dis,xt.tolist(),ut.tolist())):
+            uu = sqrt(ux*ux+uy*uy+uz*uz)
+            ux = ux/uu; uy = uy/uu; uz = uz/uu
+            # the columns of UMatrix(u): v, w, u
+            vv = sqrt(uz*uz+ux*ux)
+            vx = uz/vv; vy = 0.; vz = -ux/vv
+            wx = -uy*ux/vv; wy = vv; wz = -uy*uz/vv
+            ww = sqrt(wx*wx+wy*wy+wz*wz)
+            wx = wx/ww; wy = wy/ww; wz = wz/ww
+            x = x+ds*ux+vx*x1+wx*x2
+            y = y+ds*uy+vy*x1+wy*x2
+            z = z+ds*uz+vz*x1+wz*x2
+            ux,uy,uz = vx*t1+wx*t2+ux*t3,vy*t1+wy*t2+uy*t3,vz*t1+wz*t2+uz*t3
+            xs[i] = x,y,z
+            us[i] = ux,uy,uz
+        return xs,us
+
+class RangeTable:
+    """ CSDA range of a material: R(E) = int_0^E dE/(dE/dx)
+    dE/dx is the cubic interpolation of a stopping power table (MeV cm2/g)
+    times the density rho (g/cm3). The range is integrated once, on the
+    nodes of the table (each interval divided in nsub), with Gauss-Legendre.
+    range(E) and inverse_range(R) take arrays
+    """
+
+    def __init__(self,evals,dEdxvals,rho,nsub=8,ngauss=8):
+        """ construction of the range table from the stopping power table
+        (evals,dEdxvals) and the density rho
+        """
+        self.dedx = sc_interpol(evals,dEdxvals*rho,kind='cubic')
+        self.emax = evals[-1]
+        self.xg,self.wg = np.polynomial.legendre.leggauss(ngauss)
+        # nodes: the table energies, each interval divided in nsub
+        frac = np.arange(nsub)/float(nsub)
+        self.enodes = np.append((evals[:-1,np.newaxis]+
+            np.diff(evals)[:,np.newaxis]*frac).ravel(),evals[-1])
+        self.rnodes = np.zeros(len(self.enodes))
+        self.rnodes[1:] = np.cumsum(self.integral(self.enodes[:-1],self.enodes[1:]))
+        return
+
+    def integral(self,e0,e1):
+        """ int_e0^e1 dE/(dE/dx) with Gauss-Legendre (e0,e1 in one interval)
+        """
+        e0 = np.asarray(e0,dtype=float); e1 = np.asarray(e1,dtype=float)
+        h = 0.5*(e1-e0); c = 0.5*(e1+e0)
+        ee = c[...,np.newaxis]+h[...,np.newaxis]*self.xg
+        return h*np.sum(self.wg/self.dedx(ee),axis=-1)
+
+    def range(self,ene):
+        """ return the range (cm) of a particle of kinetic energy ene (MeV)
+        """
+        ene = np.clip(np.asarray(ene,dtype=float),0.,self.emax)
+        i = np.clip(np.searchsorted(self.enodes,ene,side='right')-1,0,len(self.enodes)-2)
+        return self.rnodes[i]+self.integral(self.enodes[i],ene)
+
+    def inverse_range(self,rng,niter=3):
+        """ return the kinetic energy (MeV) of a particle of range rng (cm)
+        """
+        rng = np.clip(np.asarray(rng,dtype=float),0.,self.rnodes[-1])
+        i = np.clip(np.searchsorted(self.rnodes,rng,side='right')-1,0,len(self.rnodes)-2)
+        # linear guess in the interval, then Newton with dR/dE = 1/(dE/dx)
+        e0,e1 = self.enodes[i],self.enodes[i+1]
+        ene = e0+(e1-e0)*(rng-self.rnodes[i])/(self.rnodes[i+1]-self.rnodes[i])
+        for it in range(niter):
+            ene = np.clip(ene-(self.range(ene)-rng)*self.dedx(ene),e0,e1)
+        return ene
+
+# range tables already integrated, by (table file, density)
+RANGETABLES = {}
+
+def rangetable(fname,rho):
+    """ return the range table of the stopping power table in file fname
+    (E in MeV, dE/dx in MeV cm2/g) at density rho (g/cm3)
+    """
+    if ((fname,rho) not in RANGETABLES):
+        xesp_tbl = np.loadtxt(fname)
+        evals = np.insert(xesp_tbl[:,0],0,0.0)
+        dEdxvals = np.insert(xesp_tbl[:,1],0,xesp_tbl[0,1])
+        RANGETABLES[(fname,rho)] = RangeTable(evals,dEdxvals,rho)
+    return RANGETABLES[(fname,rho)]
+
 class ELoss:
     """ empty class for energy loss
     """
@@ -203,13 +368,9 @@ class HPXeELoss(ELoss):
         """
         self.rho = rho
         self.enemin=enemin
-        # Read in the stopping power and interpolate.
-        xesp_tbl = np.loadtxt("xe_estopping_power_NIST.dat");
-        self.evals = xesp_tbl[:,0]
-        self.dEdxvals = xesp_tbl[:,1];
-        self.evals = np.insert(self.evals,0,0.0);
-        self.dEdxvals = np.insert(self.dEdxvals,0,self.dEdxvals[0]);
-        self.xesp = sc_interpol(self.evals,self.dEdxvals*self.rho,kind='cubic')
+        # Read in the stopping power, interpolate and integrate the range.
+        self.rtable = rangetable("xe_estopping_power_NIST.dat",self.rho)
+        self.xesp = self.rtable.dedx
         # this is the dE/dx(E) function
         return 
 
@@ -250,6 +411,6 @@ class HPXeELoss(ELoss):
         enef = max(0.,ene0-deltaene)
         de = ene0-enef
         #dis = 0.5*(de/0.03556)
-        dis = sc_integrate(lambda ee: 1./self.xesp(ee),enef,ene0,limit=1000)[0]
+        dis = float(self.rtable.range(ene0)-self.rtable.range(enef))
         debug('HPXeELoss.deltax ene,de,ds ',(ene0,de,dis))
         return de,dis
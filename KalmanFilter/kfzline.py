@@ -61,6 +61,8 @@ class KFZLine(KFModel):
     """ StraightLine propagation of a ZState
     """
 
+    fstructure = 'zline'
+
     def __init__(self,noiser=None,eloss=None,eres=1.):
         """ constructor of a ZLine propoagator for a (x,y,tx,ty,ene) statte with
         para the forward(+1)/backward(-1) sense along z
@@ -163,7 +165,7 @@ class KFZLine(KFModel):
         if (not 'filter' in node.states.keys()): return
         xf = node.getstate('filter')
         ene0 = node.hit.ene
-        xf.vec[4] = ene0 # set the energy value
+        node.setstate('filter',xf.withvalue(4,ene0)) # set the energy value
         debug('ZLineMode.user_filter',ene0)
         return
 
@@ -174,6 +176,6 @@ class KFZLine(KFModel):
         if (not 'smooth' in node.states.keys()): return
         xf = node.getstate('smooth')
         ene0 = node.hit.ene
-        xf.vec[4] = ene0 # set the energy value
+        node.setstate('smooth',xf.withvalue(4,ene0)) # set the energy value
         debug('ZLineMode.user_smooth',ene0)
         return
\ No newline at end of file
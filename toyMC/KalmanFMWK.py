@@ -40,7 +40,7 @@ class KalmanNode:
     def __init__( self, step = 0, hit = KalmanMeasurement(),
                   pred_state = KalmanMeasurement(), filt_state = KalmanMeasurement(), smooth_state = KalmanMeasurement(),
                   pred_resid = KalmanMeasurement(), filt_resid = KalmanMeasurement(), smooth_resid = KalmanMeasurement(),
-                  chi2       = -1, cumchi2 = -1 ):
+                  chi2       = -1, cumchi2 = -1, smooth_chi2 = -1 ):
         self.step = step
         self.hit = hit
         self.pred_state   = pred_state
@@ -51,6 +51,7 @@ class KalmanNode:
         self.smooth_resid = smooth_resid
         self.chi2         = chi2
         self.cumchi2      = cumchi2
+        self.smooth_chi2  = smooth_chi2
 
     def __str__( self ):
         return '''step number {0}
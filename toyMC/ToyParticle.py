@@ -4,12 +4,42 @@ scattering toy Monte Carlo
 Josh, Spring, 2014
 """
 from KMCParticle import KMCParticle
+from KStore import KStore
 
 from math import *
 from abc import ABCMeta, abstractmethod
 import random
+import os
 import numpy as np
 
+# Columns of the track files and of the "trk" table of the track store
+TRACK_COLUMNS = [("x0","<f8"),("y0","<f8"),("zi","<f8"),("zf","<f8"),
+                 ("ux","<f8"),("uy","<f8"),("uz","<f8"),
+                 ("E","<f8"),("deltaE","<f8"),("deltaX","<f8")]
+
+def TrackFileName(fnb_trk,trk_name):
+    """
+    The store of the (forward) tracks of run trk_name in directory fnb_trk
+    """
+    return "{0}/trk_{1}.kts".format(fnb_trk,trk_name)
+
+def TrackStore(fnb_trk,trk_name):
+    """
+    The track store of run trk_name, or None if the tracks are text files
+    """
+    fname = TrackFileName(fnb_trk,trk_name)
+    if os.path.isfile(fname): return KStore(fname)
+    return None
+
+def ReadTrackTable(fnb_trk,trk_name,ntrk,tstore=None):
+    """
+    The table (x0 y0 zi zf ux uy uz E deltaE deltaX) of track ntrk, from the
+    track store tstore or from the track text file
+    """
+    if tstore is not None:
+        return tstore.Array(ntrk,"trk")
+    return np.loadtxt("{0}/{1}_{2}.dat".format(fnb_trk,trk_name,ntrk))
+
 class ToyParticle(KMCParticle):
     __metaclass__ = ABCMeta
 
@@ -19,10 +49,12 @@ class ToyParticle(KMCParticle):
     Josh, Spring, 2014
     """
 
-    def __init__(self,tfile,rev,smearVector,sample=5):
+    def __init__(self,tfile,rev,smearVector,sample=5,rng=None):
         """
         Initialize the particle
-        tfile: the name of the file containing the track
+        tfile: the name of the file containing the track, or the track
+        table (see ReadTrackTable)
+        rng: the random stream used to smear the hits (see KMCParticle)
         
         The particle is assumed to be an electron
         Pressure is measured in bar and is used to scale histograms
@@ -37,7 +69,7 @@ class ToyParticle(KMCParticle):
         #  V0, Vf, trackLength, and TrueHits
         self.THits = self.__ReadTrack(tfile)
 
-        KMCParticle.__init__(self,smearVector,sample)
+        KMCParticle.__init__(self,smearVector,sample,rng)
         
 
     def Name(self):
@@ -129,7 +161,7 @@ class ToyParticle(KMCParticle):
         """
         True hits left by this particle in the detector. The particle trajectory could have been
         affected by MS, Eloss and the effect of B, but there is no detector resolution.
-        hit = np.array(x,y,z,edep)
+        (N,4) array, hit = (x,y,z,edep)
         """
         return self.THits
         
@@ -139,11 +171,12 @@ class ToyParticle(KMCParticle):
         the corresponding TrueHits array.
         """
         
-        TrueHits = []
-        
         # Read in the track file.
         # x0 y0 zi zf ux uy uz E deltaE deltaX
-        trktbl = np.loadtxt(tfile);
+        if(isinstance(tfile,np.ndarray)):
+            trktbl = tfile;
+        else:
+            trktbl = np.loadtxt(tfile);
         trk_x0 = trktbl[:,0];
         trk_y0 = trktbl[:,1];
         trk_zi = trktbl[:,2];
@@ -172,13 +205,10 @@ class ToyParticle(KMCParticle):
         self.V0 = np.array([x0,y0,(zi0+zf0)/2.])
         self.Vf = np.array([xf,yf,(zif+zff)/2.])
         
-        # Construct the TrueHits list.
-        tlen = 0.
-        for x0,y0,zi,zf,ux,uy,uz,deltaE,deltaX in zip(trk_x0,trk_y0,trk_zi,trk_zf,trk_ux,trk_uy,trk_uz,trk_deltaE,trk_deltaX):
-            hit = np.array([x0,y0,zi,deltaE])
-            tlen += deltaX*sqrt(1 + (uz*ux)**2 + (uz*uy)**2)
-            TrueHits.append(hit)
+        # Construct the TrueHits array, (x0,y0,zi,deltaE) for each slice.
+        TrueHits = np.column_stack((trk_x0,trk_y0,trk_zi,trk_deltaE))
+        TrueHits.flags.writeable = False
         
-        self.trackLength = tlen
+        self.trackLength = np.sum(trk_deltaX*np.sqrt(1 + (trk_uz*trk_ux)**2 + (trk_uz*trk_uy)**2))
         
         return TrueHits;
\ No newline at end of file
@@ -12,6 +12,7 @@ import os
 from mpl_toolkits.mplot3d import Axes3D
 from math import *
 from trackdefs import *
+from KFitStore import KFitReader
 from scipy.interpolate import interp1d
 
 from abc import ABCMeta, abstractmethod
@@ -64,13 +65,16 @@ rprof_sigma = interp1d(rproftbl[:,0],rproftbl[:,2],kind='linear');
 # Run the profile analysis for each track.
 splot_fchi2F = []; splot_fchi2R = [];
 splot_rchi2F = []; splot_rchi2R = [];
+# Forward and reverse fits (from the run store or the text files).
+ffits = KFitReader("{0}/{1}".format(fit_outdir,trk_name),trk_name);
+rfits = KFitReader("{0}/{1}/rev".format(fit_outdir,trk_name),trk_name);
 for ntrk in range(num_tracks):
     
     print "-- Profile analysis for track {0}\n".format(ntrk);
     
     # Read in the forward fit.
     # segID k p1p p2p p3p p4p chi2p p1f p2f p3f p4f chi2f
-    fittbl = np.loadtxt("{0}/{1}/fit_{2}_{3}.dat".format(fit_outdir,trk_name,trk_name,ntrk));
+    fittbl = ffits.FitTable(ntrk);
     fit_seg = fittbl[:,0];
     fit_k = fittbl[:,1];
     fit_x0 = fittbl[:,2];
@@ -89,7 +93,7 @@ for ntrk in range(num_tracks):
     
     # Read in the reverse fit.
     # segID k p1p p2p p3p p4p chi2p p1f p2f p3f p4f chi2f
-    rfittbl = np.loadtxt("{0}/{1}/rev/fit_{2}_{3}.dat".format(fit_outdir,trk_name,trk_name,ntrk));
+    rfittbl = rfits.FitTable(ntrk);
     rfit_seg = rfittbl[:,0];
     rfit_k = rfittbl[:,1];
     rfit_x0 = rfittbl[:,2];
@@ -11,6 +11,7 @@ import os
 from mpl_toolkits.mplot3d import Axes3D
 from math import *
 from trackdefs import *
+from KFitStore import KFitReader
 
 from abc import ABCMeta, abstractmethod
 import logging 
@@ -62,13 +63,16 @@ prof_fkon = []; prof_fchi2 = [];
 prof_rkon = []; prof_rchi2 = [];
 prof_fckon = []; prof_fcfxy = [];
 prof_rckon = []; prof_rcfxy = [];
+# Forward and reverse fits (from the run store or the text files).
+ffits = KFitReader("{0}/{1}".format(fit_outdir,trk_name),trk_name);
+rfits = KFitReader("{0}/{1}/rev".format(fit_outdir,trk_name),trk_name);
 for ntrk in range(num_tracks):
     
     logging.debug("-- Segment analysis for track {0}\n".format(ntrk));
         
     # Read in the forward fit.
     # segID k p1p p2p p3p p4p chi2p p1f p2f p3f p4f chi2f
-    fittbl = np.loadtxt("{0}/{1}/fit_{2}_{3}.dat".format(fit_outdir,trk_name,trk_name,ntrk));
+    fittbl = ffits.FitTable(ntrk);
     fit_seg = fittbl[:,0];
     fit_k = fittbl[:,1];
     fit_x0 = fittbl[:,2];
@@ -89,7 +93,7 @@ for ntrk in range(num_tracks):
  
     # Read in the reverse fit.
     # segID k p1p p2p p3p p4p chi2p p1f p2f p3f p4f chi2f
-    rfittbl = np.loadtxt("{0}/{1}/rev/fit_{2}_{3}.dat".format(fit_outdir,trk_name,trk_name,ntrk));
+    rfittbl = rfits.FitTable(ntrk);
     rfit_seg = rfittbl[:,0];
     rfit_k = rfittbl[:,1];
     rfit_x0 = rfittbl[:,2];
@@ -110,7 +114,7 @@ for ntrk in range(num_tracks):
 
     # Read in the segment data for the forward fit.
     # segID nPts chi2avg chi2min chi2max
-    segtbl = np.loadtxt("{0}/{1}/seg_{2}_{3}.dat".format(fit_outdir,trk_name,trk_name,ntrk));
+    segtbl = ffits.SegTable(ntrk);
     
     # Ensure there are multiple lines.
     if(len(segtbl.shape) == 1):
@@ -128,7 +132,7 @@ for ntrk in range(num_tracks):
     
     # Read in the segment data for the reverse fit.
     # segID nPts chi2avg chi2min chi2max
-    rsegtbl = np.loadtxt("{0}/{1}/rev/seg_{2}_{3}.dat".format(fit_outdir,trk_name,trk_name,ntrk));
+    rsegtbl = rfits.SegTable(ntrk);
     if(len(rsegtbl.shape) == 1):
         rseg_ID = []; rseg_ID.append(rsegtbl[0]);
         rseg_npts = []; rseg_npts.append(rsegtbl[1]);
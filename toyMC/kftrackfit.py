@@ -6,24 +6,33 @@ Attempts a Kalman filter fit on a track using KFTrackFitter
 Fit output format:
     
     fit file: k p1p p2p p3p p4p chi2p p1f p2f p3f p4f chi2f
+        (+ p1s p2s p3s p4s chi2s if the fit is smoothed)
     segment file:
         
+    or, with fit_store, the same columns in one store per run (KFitStore)
+
     All distances are in cm
 
 """
+import os
+# The fit matrices are 4x4: BLAS threads only compete with the fit workers.
+for blas in ("OMP_NUM_THREADS","OPENBLAS_NUM_THREADS","MKL_NUM_THREADS"):
+    os.environ.setdefault(blas,"1")
+
 import sys
 import numpy as np
 import scipy.integrate as integrate
-import random as rd
-import os
 from math import *
 from trackdefs import *
 from scipy.interpolate import interp1d
 
-from ToyParticle import ToyParticle
-from KTrackFitter import KTrackFitter
-from KFBase import KFVector
+from ToyParticle import ToyParticle, TrackStore, ReadTrackTable
+from KTrackFitter import KTrackFitter, FitBatch
+from KFitStore import KFitStoreWriter, Chunk, FitFileName
+from KFBase import KFVector, Random
 from KFWolinFilter import KFWolinFilter
+from KPipeline import KPipeline, KStage
+from KJournal import KJournal, JournalFileName
 
 from KLog import *
 #create logger
@@ -33,7 +42,13 @@ lgx.addHandler(ch)
 debug = Debug.info.value
 
 # File names.
-if(rev_trk):
+fnb_rfit = "{0}/{1}/rev/".format(fit_outdir,trk_name)
+if(fit_bidir):
+    print "\n\n-- WORKING ON FORWARD AND REVERSED TRACKS --\n\n"
+    rev_trk = False
+    fnb_trk = "{0}/{1}".format(trk_outdir,trk_name)
+    fnb_fit = "{0}/{1}".format(fit_outdir,trk_name)
+elif(rev_trk):
     print "\n\n-- WORKING ON REVERSED TRACKS --\n\n"
     #fnb_trk = "{0}/rev/".format(trk_outdir)
     fnb_trk = "{0}/{1}/".format(trk_outdir,trk_name)
@@ -49,47 +64,23 @@ if(not os.path.isdir(fit_outdir)): os.mkdir(fit_outdir);
 if(not os.path.isdir("{0}/{1}".format(fit_outdir,trk_name))): os.mkdir("{0}/{1}".format(fit_outdir,trk_name));
 if(not os.path.isdir("{0}/{1}/rev".format(fit_outdir,trk_name))): os.mkdir("{0}/{1}/rev".format(fit_outdir,trk_name));
 
-# Create num_tracks tracks.
-for ntrk in range(num_tracks):
-
-    logging.info("\n\n-- Track {0} --\n\n".format(ntrk))
-
-    # Create a ToyParticle for this track.
-    logging.debug("-- Creating ToyParticle...")
-    tfile = "{0}/{1}_{2}.dat".format(fnb_trk,trk_name,ntrk)
-    tpart = ToyParticle(tfile,rev_trk,np.array([sigma_xm,sigma_ym,0.0]),0)
-    
-    # Set up a KFTrackFitter to fit this track, and fit the requested number of times.
-    fSegments = []; fHits = tpart.SmearedHits(rev_trk)
-    for ft in range(nfits):
-        
-        print "--> Fit {0} of {1}".format(ft,nfits)
-        
-        # Create a KalmanFilter to be used to do the fitting
-        logging.debug("-- Creating KFWolinFilter...")
-        kfilter = KFWolinFilter("KFWolinFilter");
-        
-        logging.debug("-- Creating KTrackFitter...")
-        tfitter = KTrackFitter(kfilter,fHits,np.array([sigma_xm,sigma_ym]),tpart,chi2_lim,10.)
-    
-        # Perform the fit.
-        logging.debug("-- Performing fit...")
-        fHits = tfitter.Fit()
-        
-        ##########
-        ktrack = tfitter.Track
-        
-        # Save the segments.
-        fSegments = tfitter.Segments
-
-    # Write the fit files.
-    f_ftrk = open("{0}/fit_{1}_{2}.dat".format(fnb_fit,trk_name,ntrk),"w")
-    f_fseg = open("{0}/seg_{1}_{2}.dat".format(fnb_fit,trk_name,ntrk),"w")
-    f_ftrk.write("# segID k x0 y0 z0 p1p p2p p3p p4p chi2p p1f p2f p3f p4f chi2f cfxy cftxy\n")
+def WriteFit(ntrk,segments,fnb_fit=fnb_fit):
+    """
+    Writes the fit and segment files of track ntrk (renamed into place once
+    written, so that a fit file is never left half written)
+    """
+    fn_ftrk = "{0}/fit_{1}_{2}.dat".format(fnb_fit,trk_name,ntrk)
+    fn_fseg = "{0}/seg_{1}_{2}.dat".format(fnb_fit,trk_name,ntrk)
+    f_ftrk = open(fn_ftrk+".tmp","w")
+    f_fseg = open(fn_fseg+".tmp","w")
+    # the header follows the segments (the reverse fit is not smoothed)
+    smooth = len(segments) > 0 and all(seg.IsSmoothed() for seg in segments)
+    if(smooth):
+        f_ftrk.write("# segID k x0 y0 z0 p1p p2p p3p p4p chi2p p1f p2f p3f p4f chi2f cfxy cftxy edep p1s p2s p3s p4s chi2s\n")
+    else:
+        f_ftrk.write("# segID k x0 y0 z0 p1p p2p p3p p4p chi2p p1f p2f p3f p4f chi2f cfxy cftxy\n")
     f_fseg.write("# segID nPts chi2avg chi2min chi2max\n")
     
-    segments = fSegments
-    
     for seg in segments:
         
         # Get the mean, min, and max chi2 values for each segment.
@@ -104,13 +95,139 @@ for ntrk in range(num_tracks):
         f_fseg.write("{0} {1} {2} {3} {4}\n".format(seg.seg_id,len(seg.seg_k),mean_chi2,min_chi2,max_chi2));
         
         # Print the track file lines for each segment point: include the smeared hits.
-        for k,x0,y0,z0,p1p,p2p,p3p,p4p,chi2p,p1f,p2f,p3f,p4f,chi2f,cfxy,cftxy,edep in zip(seg.seg_k,seg.seg_x0,seg.seg_y0,seg.seg_z0,seg.seg_p1p,seg.seg_p2p,seg.seg_p3p,seg.seg_p4p,seg.seg_pchisq,seg.seg_p1f,seg.seg_p2f,seg.seg_p3f,seg.seg_p4f,seg.seg_fchisq,seg.seg_cfxy,seg.seg_cftxy,seg.seg_edep):
+        for i,(k,x0,y0,z0,p1p,p2p,p3p,p4p,chi2p,p1f,p2f,p3f,p4f,chi2f,cfxy,cftxy,edep) in enumerate(zip(seg.seg_k,seg.seg_x0,seg.seg_y0,seg.seg_z0,seg.seg_p1p,seg.seg_p2p,seg.seg_p3p,seg.seg_p4p,seg.seg_pchisq,seg.seg_p1f,seg.seg_p2f,seg.seg_p3f,seg.seg_p4f,seg.seg_fchisq,seg.seg_cfxy,seg.seg_cftxy,seg.seg_edep)):
             if(isinstance(chi2f,KFVector)):
                 chi2 = chi2f[2];
             else:
                 chi2 = chi2f;
-            f_ftrk.write("{0} {1} {2} {3} {4} {5} {6} {7} {8} {9} {10} {11} {12} {13} {14} {15} {16} {17}\n".format(seg.seg_id,k,x0,y0,z0,p1p,p2p,p3p,p4p,chi2p,p1f,p2f,p3f,p4f,chi2f,cfxy,cftxy,edep));
+            f_ftrk.write("{0} {1} {2} {3} {4} {5} {6} {7} {8} {9} {10} {11} {12} {13} {14} {15} {16} {17}".format(seg.seg_id,k,x0,y0,z0,p1p,p2p,p3p,p4p,chi2p,p1f,p2f,p3f,p4f,chi2f,cfxy,cftxy,edep));
+            if(smooth):
+                f_ftrk.write(" {0} {1} {2} {3} {4}".format(seg.seg_p1s[i],seg.seg_p2s[i],seg.seg_p3s[i],seg.seg_p4s[i],seg.seg_schisq[i]));
+            f_ftrk.write("\n");
 
     # Close the files.
     f_ftrk.close();
     f_fseg.close();
+    os.rename(fn_ftrk+".tmp",fn_ftrk);
+    os.rename(fn_fseg+".tmp",fn_fseg);
+
+# The generated tracks (from the run store or the text files).
+tstore = TrackStore(fnb_trk,trk_name)
+
+def ReadTracks(batch):
+    """
+    Reads the tracks in batch and creates their ToyParticles. Returns
+    (batch, ToyParticles, smeared hits)
+    """
+    logging.info("\n\n-- Tracks {0} to {1} --\n\n".format(batch[0],batch[-1]))
+
+    # Create a ToyParticle for each track.
+    logging.debug("-- Creating ToyParticles...")
+    tparts = []; bHits = []
+    for ntrk in batch:
+        tfile = ReadTrackTable(fnb_trk,trk_name,ntrk,tstore)
+        # the smearing of a track depends only on (fit_seed, ntrk), so that
+        #  the fits do not depend on how the tracks are scheduled
+        tpart = ToyParticle(tfile,rev_trk,np.array([sigma_xm,sigma_ym,0.0]),0,Random.stream(fit_seed,ntrk))
+        tparts.append(tpart)
+        bHits.append(tpart.SmearedHits(rev_trk))
+
+    return batch,tparts,bHits
+
+def FitTracks(tracks):
+    """
+    Fits the tracks read by ReadTracks (fit_batch tracks at a time at most)
+    and writes their fit files. Returns the list of (ntrk, number of
+    segments) and, if fit_store, the forward and reverse (fit_bidir) chunks
+    of the fits
+    """
+    batch,tparts,bHits = tracks
+    
+    # Set up a KFTrackFitter for each track, and fit the batch the requested number of times.
+    for ft in range(nfits):
+        
+        print "--> Fit {0} of {1}".format(ft,nfits)
+        
+        logging.debug("-- Creating KTrackFitters...")
+        tfitters = []
+        for tpart,fHits in zip(tparts,bHits):
+            kfilter = KFWolinFilter("KFWolinFilter");
+            tfitters.append(KTrackFitter(kfilter,fHits,np.array([sigma_xm,sigma_ym]),tpart,chi2_lim,10.))
+    
+        # Perform the fit.
+        logging.debug("-- Performing fit...")
+        if(fit_bidir):
+            # the refits start from the forward fitted hits
+            bHits = [fh for fh,rh in FitBatch(tfitters,bidirectional=True)]
+        else:
+            bHits = FitBatch(tfitters)
+
+    # Smooth the last fit.
+    if(fit_smooth):
+        for tfitter in tfitters: tfitter.Smooth()
+
+    # Write the fit files (or the chunks of the store, written by the driver).
+    chunks = (None,None)
+    if(fit_store):
+        chunks = (Chunk([(ntrk,tfitter.Segments) for ntrk,tfitter in zip(batch,tfitters)],fit_smooth),
+                  Chunk([(ntrk,tfitter.RevSegments) for ntrk,tfitter in zip(batch,tfitters)]) if fit_bidir else None)
+    else:
+        for ntrk,tfitter in zip(batch,tfitters):
+            WriteFit(ntrk,tfitter.Segments)
+            if(fit_bidir): WriteFit(ntrk,tfitter.RevSegments,fnb_rfit)
+
+    return [(ntrk,len(tfitter.Segments)) for ntrk,tfitter in zip(batch,tfitters)],chunks
+
+# The tracks fitted are committed to the journal of the run (see KJournal):
+#  a resumed run (fit_resume, or python kftrackfit.py --resume) fits only the
+#  tracks that the journal does not have.
+resume = fit_resume or "--resume" in sys.argv[1:]
+journal = KJournal(JournalFileName(fnb_fit,trk_name),resume)
+fstores = []
+if(fit_store):
+    fstores = [FitFileName(fnb_fit,trk_name)]+([FitFileName(fnb_rfit,trk_name)] if fit_bidir else [])
+journal.Restore(fstores)
+tracks = journal.Remaining(range(num_tracks))
+if(resume):
+    print "-- Resuming: {0} of {1} tracks already fitted".format(num_tracks-len(tracks),num_tracks)
+
+# Split the tracks in chunks of at most fit_batch tracks, small enough to
+#  give every worker several chunks.
+nchunk = max(1,min(fit_batch,int(ceil(len(tracks)/(4.*fit_workers)))))
+chunks = [tracks[i:i+nchunk] for i in range(0,len(tracks),nchunk)]
+
+# The chunks stream through a pipeline (see KPipeline): the tracks are read
+#  by one thread, fitted by fit_workers workers (processes if more than one)
+#  and written by this process.
+pipeline = KPipeline([KStage("read",ReadTracks),
+                      KStage("fit",FitTracks,fit_workers,fit_workers > 1)],fit_queue,fit_ordered)
+print "-- Fitting {0} tracks in {1} chunks with {2} workers".format(len(tracks),len(chunks),fit_workers)
+
+# One store per direction for the whole run (appended to if resumed).
+if(fit_store):
+    smode = "a" if resume else "w"
+    stores = (KFitStoreWriter(FitFileName(fnb_fit,trk_name),fit_smooth,mode=smode),
+              KFitStoreWriter(FitFileName(fnb_rfit,trk_name),mode=smode) if fit_bidir else None)
+
+nfitted = num_tracks-len(tracks)
+def WriteTracks(result):
+    """
+    Writes the chunks of the fits of a batch of tracks (the result of
+    FitTracks) to the stores, and commits the tracks to the journal
+    """
+    global nfitted
+    fitted,chunks = result
+    nfitted += len(fitted)
+    if(fit_store):
+        for store,chunk in zip(stores,chunks):
+            if(chunk is not None): store.WriteChunk(chunk)
+    journal.Commit([ntrk for ntrk,nseg in fitted],fstores)
+    print "-- Fitted tracks {0} to {1}, {2} segments ({3} of {4} tracks)".format(fitted[0][0],fitted[-1][0],sum(nseg for ntrk,nseg in fitted),nfitted,num_tracks)
+
+pipeline.Run(chunks,WriteTracks)
+print pipeline.Report()
+
+if(fit_store):
+    for store in stores:
+        if(store is not None): store.Close()
+journal.Close()
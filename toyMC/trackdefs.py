@@ -17,6 +17,7 @@ import logging
 # -------------------------------------------------------------------------------------------------------
 
 rev_trk = False;  # Set to true to fit reverse tracks and false to fit forward tracks (for kftrackfit.py only)
+fit_bidir = False;  # Set to true to fit forward and reverse tracks in one pass (overrides rev_trk, for kftrackfit.py only)
 
 # Output directories
 trk_outdir = "/Users/Gonzalo/Dropbox/Gonzalo/Facultade/NEXT/KalmanFilter/output/tracks";
@@ -28,6 +29,9 @@ plt_outdir = "/Users/Gonzalo/Dropbox/Gonzalo/Facultade/NEXT/KalmanFilter/output/
 
 trk_name = "singlebeta";   # name assigned to this run; will be used in naming the output files
 num_tracks = 100;     # number of tracks to generate and/or fit
+gen_batch = 1000;     # number of tracks generated in lockstep by trackgen.py
+gen_seed = 0;         # run seed of trackgen.py: the scattering of track ntrk is drawn from the stream (gen_seed, ntrk)
+trk_store = False;    # write the generated tracks to one store per run, trk_<trk_name>.kts, instead of text files
 
 chi2_low = 1.0e-5;     # lower chi2 boundary for certain chi2 analyses
 chi2_outlier = 40.;     # upper chi2 boundary for chi2 profile and other analyses
@@ -38,6 +42,14 @@ sigma_xm = 0.1;       # x measurement error for fitting to toyMC tracks
 sigma_ym = 0.1;       # y measurement error for fitting to toyMC tracks
 
 nfits = 1;
+fit_batch = 1000;   # number of tracks fitted in lockstep (see KTrackFitter.FitBatch)
+fit_smooth = False; # smooth the fits and add the smoothed states to the fit files
+fit_workers = 1;    # number of worker processes fitting tracks in parallel (1 = fit in a thread of this process)
+fit_ordered = True; # write the fits in track order (False = as the workers complete them)
+fit_queue = 4;      # number of chunks of tracks that wait in front of each stage of the fit pipeline (see KPipeline)
+fit_seed = 1;       # run seed: the smearing of track ntrk is drawn from the stream (fit_seed, ntrk)
+fit_store = False;  # write the fits of a run to one store, fit_<trk_name>.kfs (see KFitStore), instead of text files
+fit_resume = False; # resume the run from its journal, fit_<trk_name>.kjr: fit only the tracks not fitted yet (also python kftrackfit.py --resume)
 
 # -------------------------------------------------------------------------------------------------------
 # Less frequently modified parameters:
@@ -1,7 +1,7 @@
 """
 trackgen.py
 
-Generates tracks with multiple scattering.
+Generates tracks with multiple scattering, gen_batch tracks at a time.
 
 Track output format:
     
@@ -16,15 +16,21 @@ Track output format:
     
     All distances are in cm
 
+    With trk_store the (forward) tracks go to one store per run,
+    trk_<trk_name>.kts, with the same columns (see ToyParticle.TrackStore).
+
 """
 import sys
 import numpy as np
 import scipy.integrate as integrate
-import random as rd
 import os
 from math import *
 from trackdefs import *
 from scipy.interpolate import interp1d
+from kfnoise import rangetable
+from KFBase import Random
+from KStore import KStoreWriter, Chunk
+from ToyParticle import TRACK_COLUMNS, TrackFileName
 
 from abc import ABCMeta, abstractmethod
 import logging 
@@ -34,195 +40,144 @@ if(not os.path.isdir(trk_outdir)): os.mkdir(trk_outdir);
 if(not os.path.isdir("{0}/{1}".format(trk_outdir,trk_name))): os.mkdir("{0}/{1}".format(trk_outdir,trk_name));
 if(not os.path.isdir("{0}/{1}/rev".format(trk_outdir,trk_name))): os.mkdir("{0}/{1}/rev".format(trk_outdir,trk_name));
 
-# Read in the stopping power and interpolate.
-xesp_tbl = np.loadtxt("data/xe_estopping_power_NIST.dat");
+# Read in the stopping power and integrate the range table.
 rho = pc_rho0*(Pgas/(Tgas/273.15))*(pc_m_Xe/pc_NA);
-e_vals = xesp_tbl[:,0];
-dEdx_vals = xesp_tbl[:,1];
-e_vals = np.insert(e_vals,0,0.0);
-dEdx_vals = np.insert(dEdx_vals,0,dEdx_vals[0]);
-xesp = interp1d(e_vals,dEdx_vals*rho,kind='cubic');
+xerange = rangetable("data/xe_estopping_power_NIST.dat",rho);
 
 print "xenon density is rho = {0} g/cm^3; Lr = {1} cm".format(rho,Lr);
 
-# Create num_tracks tracks.
-for ntrk in range(num_tracks):
-    
-    # Declare arrays for the track.
-    # x0 y0 zi zf ux uy uz E deltaE deltaX
-    trk_x = []; trk_y = []; trk_zi = []; trk_zf = [];
-    trk_ux = []; trk_uy = []; trk_uz = [];
-    trk_E = []; trk_deltaE = []; trk_deltaX = [];
-
-    # Initialize the track.
-    te = E_0-me;
-    tx = 0.; ty = 0.; tz = -10.;
-    ux = 0.; uy = 0.; uz = 1.;
-    
-    logging.debug("\n\n-- Track {0} --\n\n".format(ntrk));
-    
-    # Continue until 0 energy.
-    while(te > E_tol):
-
-        # Compute the current momentum of the track.
-        ptrk = sqrt((te + 0.511)**2 - 0.511**2); 
-        
-        # Determine the energy loss for this step.        
-        if(te < eslice):
-            deltaE = te;
-        else:
-            deltaE = eslice;
-        te -= deltaE;
-        if(te < 0.): te = 0.;
-        
-        logging.debug("-> Energy = {0}, energy loss: {1}".format(te,deltaE));
-
-        # Determine the distance of this step.
-        deltaX = integrate.quad(lambda ee: 1./xesp(ee),te,te+deltaE,limit=1000)[0]
-        
+# The energy steps are the same for all tracks: compute their lengths once,
+#  as differences of the range table.
+step_E = []; step_te = []; step_deltaE = [];
+te = E_0-me;
+while(te > E_tol):
+    step_E.append(te);
+    if(te < eslice):
+        deltaE = te;
+    else:
+        deltaE = eslice;
+    te -= deltaE;
+    if(te < 0.): te = 0.;
+    step_te.append(te); step_deltaE.append(deltaE);
+step_deltaX = xerange.range(np.array(step_te)+np.array(step_deltaE)) - xerange.range(step_te);
+for deltaX in step_deltaX:
+    if(deltaX/Lr < 0.0009 or deltaX/Lr > 100.):
+        print "WARNING: L/Lr = {0} out of range of validity of the formula.".format(deltaX/Lr);
+
+def GenerateTracks(ntrks):
+    """
+    Generates the tracks ntrks in lockstep. All the tracks take the same
+    energy steps, so they all have len(step_te) steps. Returns a dictionary
+    of (len(ntrks),steps) arrays with the columns of the track files
+
+    The scattering angles of track ntrk are drawn from its own stream
+    (gen_seed, ntrk): a track does not depend on the batch it is generated in
+    """
+    nsteps = len(step_te);
+    trk = dict((name,np.zeros((len(ntrks),nsteps))) for name,dtype in TRACK_COLUMNS);
+
+    # Draw the (unit) scattering angles of each track, (tracks,steps,2).
+    zms = np.array([Random.stream(gen_seed,ntrk).normal(0.,1.,(nsteps,2)) for ntrk in ntrks]);
+
+    # Initialize the tracks.
+    tx = np.zeros(len(ntrks)); ty = np.zeros(len(ntrks)); tz = np.full(len(ntrks),-10.);
+    ux = np.zeros(len(ntrks)); uy = np.zeros(len(ntrks)); uz = np.ones(len(ntrks));
+
+    for i,(tE,te,deltaE,deltaX) in enumerate(zip(step_E,step_te,step_deltaE,step_deltaX)):
+
+        # Compute the current momentum of the tracks.
+        ptrk = sqrt((tE + 0.511)**2 - 0.511**2);
+
         # Make the step.
         dx = deltaX*ux; dy = deltaX*uy; dz = deltaX*uz;
-        
-        logging.debug("-> Step: deltaX = {0}; dx = {1}, dy = {2}, dz = {3}".format(deltaX,dx,dy,dz));
-        
+
         # Record the variables for the step.
-        trk_x.append(tx + dx/2.);
-        trk_y.append(ty + dy/2.);
-        trk_zi.append(tz);
-        trk_zf.append(tz + dz);
-        trk_ux.append(ux);
-        trk_uy.append(uy);
-        trk_uz.append(uz);
-        trk_E.append(te + deltaE);
-        trk_deltaE.append(deltaE);
-        trk_deltaX.append(deltaX);
-        
+        trk["x0"][:,i] = tx + dx/2.;
+        trk["y0"][:,i] = ty + dy/2.;
+        trk["zi"][:,i] = tz;
+        trk["zf"][:,i] = tz + dz;
+        trk["ux"][:,i] = ux;
+        trk["uy"][:,i] = uy;
+        trk["uz"][:,i] = uz;
+        trk["E"][:,i] = te + deltaE;
+        trk["deltaE"][:,i] = deltaE;
+        trk["deltaX"][:,i] = deltaX;
+
         # Update the positions.
-        tx += dx; ty += dy; tz += dz;
-        
+        tx = tx + dx; ty = ty + dy; tz = tz + dz;
+
         # Determine the scattering angles in the frame in which the track
         #  direction is aligned with the z-axis.
         sigma_theta = SigmaThetaMs(ptrk,deltaX/Lr);
-        if(deltaX/Lr < 0.0009 or deltaX/Lr > 100.):
-            print "WARNING: L/Lr = {0} out of range of validity of the formula.".format(deltaX/Lr);
-        thetaX = rd.gauss(0,sigma_theta);
-        thetaY = rd.gauss(0,sigma_theta);
-        tanX = tan(thetaX);
-        tanY = tan(thetaY);
-        
-        logging.debug("-> sigma(theta) = {0}; tanX = {1}, tanY = {2}".format(sigma_theta,tanX,tanY));
-        
-        # Compute the direction cosines of the rotation matrix to move to the lab frame.
-        nxy = sqrt(ux**2 + uy**2);
-        if(nxy > 0.):
-            alpha1 = uy/nxy; alpha2 = -ux*uz/nxy; alpha3 = ux;
-            beta1 = -ux/nxy; beta2 = -uy*uz/nxy; beta3 = uy;
-            gamma1 = 0.; gamma2 = nxy; gamma3 = uz;
-        else:
-            # Special case; the direction vector is the x-axis.  Choose
-            #  the orthonormal basis as the normal unit vectors.
-            alpha1 = 1.; alpha2 = 0.; alpha3 = 0.;
-            beta1 = 0.; beta2 = 1.; beta3 = 0.;
-            gamma1 = 0.; gamma2 = 0.; gamma3 = 1.;
-        
-        logging.debug("-> alpha1 = {0}, alpha2 = {1}, alpha3 = {2}".format(alpha1,alpha2,alpha3));
-        logging.debug("-> alpha1 = {0}, alpha2 = {1}, alpha3 = {2}".format(alpha1,alpha2,alpha3));
-        logging.debug("-> beta1 = {0}, beta2 = {1}, beta3 = {2}".format(beta1,beta2,beta3));
-        logging.debug("-> gamma1 = {0}, gamma2 = {1}, gamma3 = {2}".format(gamma1,gamma2,gamma3));
+        tanX = np.tan(sigma_theta*zms[:,i,0]);
+        tanY = np.tan(sigma_theta*zms[:,i,1]);
+
+        # Compute the direction cosines of the rotation matrices to move to the lab frame.
+        #  Special case (nxy = 0): the direction vector is the z-axis; choose
+        #  the orthonormal basis as the normal unit vectors.
+        nxy = np.sqrt(ux**2 + uy**2);
+        rot = nxy > 0.;
+        nxyr = np.where(rot,nxy,1.);
+        alpha1 = np.where(rot,uy/nxyr,1.); alpha2 = np.where(rot,-ux*uz/nxyr,0.); alpha3 = np.where(rot,ux,0.);
+        beta1 = np.where(rot,-ux/nxyr,0.); beta2 = np.where(rot,-uy*uz/nxyr,1.); beta3 = np.where(rot,uy,0.);
+        gamma2 = np.where(rot,nxy,0.); gamma3 = np.where(rot,uz,1.);
 
         # Determine direction vector components in the reference (lab) frame.
-        nrm = sqrt(tanX**2 + tanY**2 + 1);
+        nrm = np.sqrt(tanX**2 + tanY**2 + 1);
         xp = (alpha1*tanX + alpha2*tanY + alpha3)/nrm;
         yp = (beta1*tanX + beta2*tanY + beta3)/nrm;
-        zp = (gamma1*tanX + gamma2*tanY + gamma3)/nrm;
-        
-        # Set the new direction vector.
-        nrm = sqrt(xp**2 + yp**2 + zp**2);
+        zp = (gamma2*tanY + gamma3)/nrm;
+
+        # Set the new direction vectors.
+        nrm = np.sqrt(xp**2 + yp**2 + zp**2);
         ux = xp/nrm;
         uy = yp/nrm;
         uz = zp/nrm;
-    
-    # Print out the track.
-    fn_trk = "{0}/{1}/{2}_{3}.dat".format(trk_outdir,trk_name,trk_name,ntrk);
+
+    return trk;
+
+def WriteTrack(fn_trk,trk):
+    """
+    Writes a track (dictionary of columns) to the text file fn_trk
+    """
     f_trk = open(fn_trk,"w");
     f_trk.write("# x0 y0 zi zf ux uy uz E deltaE deltaX\n");
-    for x0_f,y0_f,zi_f,zf_f,ux_f,uy_f,uz_f,E_f,deltaE_f,deltaX_f in zip(trk_x,trk_y,trk_zi,trk_zf,trk_ux,trk_uy,trk_uz,trk_E,trk_deltaE,trk_deltaX):
-        f_trk.write("{0} {1} {2} {3} {4} {5} {6} {7} {8} {9}\n".format(x0_f,y0_f,zi_f,zf_f,ux_f,uy_f,uz_f,E_f,deltaE_f,deltaX_f));
+    for row in zip(*[trk[name] for name,dtype in TRACK_COLUMNS]):
+        f_trk.write("{0} {1} {2} {3} {4} {5} {6} {7} {8} {9}\n".format(*row));
     f_trk.close();
-    
-    # -----------------------------------------------------------------------
-    # Create the reversed track.
-    # -----------------------------------------------------------------------
-    
-    # Reverse all lists.
-    trk_x.reverse(); trk_y.reverse(); trk_zi.reverse(); trk_zf.reverse();
-    trk_ux.reverse(); trk_uy.reverse(); trk_uz.reverse();
-    trk_E.reverse(); trk_deltaE.reverse(); trk_deltaX.reverse();
-    
-    # Get the initial direction.
-    zi0 = (trk_zi[0] + trk_zf[0])/2.;
-    zi1 = (trk_zi[1] + trk_zf[1])/2.;
-    ux = (trk_x[1] - trk_x[0]);
-    uy = (trk_y[1] - trk_y[0]);
-    uz = (zi1 - zi0);
-    imag = sqrt(ux**2 + uy**2 + uz**2);
-    ux /= imag;
-    uy /= imag;
-    uz /= imag;
-    
-#    # Rotate the entire track such that the initial direction is the z-direction.
-#    nxy = sqrt(ux**2 + uy**2);
-#    if(nxy > 0.):
-#        alpha1 = uy/nxy; alpha2 = -ux*uz/nxy; alpha3 = ux;
-#        beta1 = -ux/nxy; beta2 = -uy*uz/nxy; beta3 = uy;
-#        gamma1 = 0.; gamma2 = nxy; gamma3 = uz;
-#    else:
-#        # Special case; the direction vector is the x-axis.  Choose
-#        #  the orthonormal basis as the normal unit vectors.
-#        alpha1 = 1.; alpha2 = 0.; alpha3 = 0.;
-#        beta1 = 0.; beta2 = 1.; beta3 = 0.;
-#        gamma1 = 0.; gamma2 = 0.; gamma3 = 1.;
-    
-    # Shift the origin and rotate the track.
-    rtrk_x = []; rtrk_y = []; rtrk_zi = []; rtrk_zf = [];
-    rtrk_ux = []; rtrk_uy = []; rtrk_uz = [];
-    rtrk_E = []; rtrk_deltaE = []; rtrk_deltaX = [];
-    tx0 = trk_x[0]; ty0 = trk_y[0]; tz0 = trk_zf[0];
-    for x0_f,y0_f,zi_f,zf_f,ux_f,uy_f,uz_f,E_f,deltaE_f,deltaX_f in zip(trk_x,trk_y,trk_zi,trk_zf,trk_ux,trk_uy,trk_uz,trk_E,trk_deltaE,trk_deltaX):
-        
-        # Shift the origin and reflect.
-        x0 = -1*(x0_f - tx0);
-        y0 = -1*(y0_f - ty0);
-        zi0 = -1*(zi_f - tz0);
-        zf0 = -1*(zf_f - tz0);
-        z0 = (zi0 + zf0)/2.;
-
-#        # Rotate.
-#        xf = alpha1*x0 + alpha2*y0 + alpha3*z0;
-#        yf = beta1*x0 + beta2*y0 + beta3*z0;
-#        zif = gamma1*x0 + gamma2*y0 + gamma3*zi0;
-#        zff = gamma1*x0 + gamma2*y0 + gamma3*zf0;
-        
-        # Store the shifted and reflected values: note flip zi <-> zf
-        rtrk_x.append(x0);
-        rtrk_y.append(y0);
-        rtrk_zi.append(zf0);
-        rtrk_zf.append(zi0);
-        
-        # For now keep the old direction vectors (this is not something we will have in the real data).
-        rtrk_ux.append(ux_f);
-        rtrk_uy.append(uy_f);
-        rtrk_uz.append(uz_f);
-        
-        # Keep the old E, deltaE and deltaX.
-        rtrk_E.append(E_f);
-        rtrk_deltaE.append(deltaE_f);
-        rtrk_deltaX.append(deltaX_f);
-
-    # Print the reversed track.
-    fn_rtrk = "{0}/{1}/rev/{2}_{3}.dat".format(trk_outdir,trk_name,trk_name,ntrk);
-    f_rtrk = open(fn_rtrk,"w");
-    f_rtrk.write("# x0 y0 zi zf ux uy uz E deltaE deltaX\n");
-    for x0_f,y0_f,zi_f,zf_f,ux_f,uy_f,uz_f,E_f,deltaE_f,deltaX_f in zip(rtrk_x,rtrk_y,rtrk_zi,rtrk_zf,rtrk_ux,rtrk_uy,rtrk_uz,rtrk_E,trk_deltaE,trk_deltaX):
-        f_rtrk.write("{0} {1} {2} {3} {4} {5} {6} {7} {8} {9}\n".format(x0_f,y0_f,zi_f,zf_f,ux_f,uy_f,uz_f,E_f,deltaE_f,deltaX_f));
-    f_rtrk.close();
+
+def ReverseTrack(trk):
+    """
+    The reversed track: the origin is shifted to the end of the track and
+    the track is reflected (zi <-> zf); the direction vectors, E, deltaE and
+    deltaX are kept (this is not something we will have in the real data)
+    """
+    rtrk = dict((name,trk[name][::-1]) for name in ("ux","uy","uz","E","deltaE","deltaX"));
+    tx0 = trk["x0"][-1]; ty0 = trk["y0"][-1]; tz0 = trk["zf"][-1];
+    rtrk["x0"] = -1*(trk["x0"][::-1] - tx0);
+    rtrk["y0"] = -1*(trk["y0"][::-1] - ty0);
+    rtrk["zi"] = -1*(trk["zf"][::-1] - tz0);
+    rtrk["zf"] = -1*(trk["zi"][::-1] - tz0);
+    return rtrk;
+
+# Create num_tracks tracks, gen_batch tracks at a time.
+if(trk_store):
+    tstore = KStoreWriter(TrackFileName("{0}/{1}".format(trk_outdir,trk_name),trk_name),[("trk",TRACK_COLUMNS)],mode="w");
+for ntrk0 in range(0,num_tracks,gen_batch):
+
+    ntrks = range(ntrk0,min(ntrk0+gen_batch,num_tracks));
+    logging.debug("\n\n-- Tracks {0} to {1} --\n\n".format(ntrks[0],ntrks[-1]));
+    trk = GenerateTracks(ntrks);
+
+    # Print out the tracks (and the reversed tracks).
+    if(trk_store):
+        nsteps = len(step_te);
+        tstore.WriteChunk(Chunk(ntrks,{"trk":(nsteps*np.arange(len(ntrks)+1),
+                                              dict((name,trk[name].ravel()) for name in trk))}));
+    else:
+        for i,ntrk in enumerate(ntrks):
+            itrk = dict((name,trk[name][i]) for name in trk);
+            WriteTrack("{0}/{1}/{2}_{3}.dat".format(trk_outdir,trk_name,trk_name,ntrk),itrk);
+            WriteTrack("{0}/{1}/rev/{2}_{3}.dat".format(trk_outdir,trk_name,trk_name,ntrk),ReverseTrack(itrk));
+if(trk_store):
+    tstore.Close();
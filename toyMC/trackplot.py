@@ -14,6 +14,8 @@ from mpl_toolkits.mplot3d import Axes3D
 from math import *
 from scipy.interpolate import interp1d
 from trackdefs import *
+from KFitStore import KFitReader
+from ToyParticle import TrackStore, ReadTrackTable
 
 from abc import ABCMeta, abstractmethod
 import logging 
@@ -47,6 +49,10 @@ if(not os.path.isdir("{0}/{1}/rev".format(plt_outdir,trk_name))):
 # Keep a running list of the values of chi2.
 chi2_totlist = [];
 
+# The tracks and fits (from the run stores or the text files).
+tstore = TrackStore(fnb_trk,trk_name);
+fits = KFitReader(fnb_fit,trk_name);
+
 # Create num_tracks tracks.
 for ntrk in range(num_tracks):
     
@@ -59,7 +65,7 @@ for ntrk in range(num_tracks):
     # Read in the track.
     # x0 y0 zi zf ux uy uz E deltaE deltaX
     if(not plt_smearedHits):
-        trktbl = np.loadtxt("{0}/{1}_{2}.dat".format(fnb_trk,trk_name,ntrk));
+        trktbl = ReadTrackTable(fnb_trk,trk_name,ntrk,tstore);
         trk_x0 = trktbl[:,0];
         trk_y0 = trktbl[:,1];
         trk_zi = trktbl[:,2];
@@ -76,7 +82,7 @@ for ntrk in range(num_tracks):
     
     # Read in the fit.
     # segID k p1p p2p p3p p4p chi2p p1f p2f p3f p4f chi2f
-    fittbl = np.loadtxt("{0}/fit_{1}_{2}.dat".format(fnb_fit,trk_name,ntrk));
+    fittbl = fits.FitTable(ntrk);
     fit_seg = fittbl[:,0];
     fit_k = fittbl[:,1];
     fit_x0 = fittbl[:,2];